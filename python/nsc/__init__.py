@@ -1,2 +1,2 @@
-__all__ = ['utils','phot','coadd','calibrate','query','modelmag','combine','download']
+__all__ = ['utils','phot','coadd','calibrate','query','modelmag','combine','download','extinction','zeropoint','tarbundle','daosession','benchmark']
 __version__ = '1.0.0'
@@ -0,0 +1,938 @@
+#!/usr/bin/env python
+#
+# BENCHMARK.PY - Throughput benchmarks on synthetic exposures and catalogs
+#
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import logging
+import platform
+import subprocess
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from astropy.time import Time
+from astropy.wcs import WCS
+from argparse import ArgumentParser
+from . import utils
+
+# Typical instrument properties, the chip sizes are in pixels
+INSTRUMENTS = {'c4d': {'dtinstru':'decam','pixscale':0.27,'nx':2046,'ny':4094,'gain':4.0,'rdnoise':7.0,
+                       'saturate':40000.0,'filter':'g DECam SDSS c0001 4720.0 1520.0','band':'g'},
+               'k4m': {'dtinstru':'mosaic3','pixscale':0.258,'nx':4096,'ny':4032,'gain':1.8575,'rdnoise':6.0,
+                       'saturate':50000.0,'filter':'zd DECam SDSS c0008 9300.0 1200.0','band':'z'},
+               'ksb': {'dtinstru':'90prime','pixscale':0.45,'nx':4032,'ny':4096,'gain':1.4,'rdnoise':7.0,
+                       'saturate':60000.0,'filter':'g','band':'g'}}
+
+# Photometric zero-point of the synthetic images, mag for 1 ADU/sec
+ZEROPOINT = 25.0
+
+
+def chiplayout(instrument='c4d'):
+    """
+    Get the chip layout of an instrument.  DECam uses the chip offsets and
+    the gain, read noise and saturation of each chip from the params files,
+    Mosaic3 and 90Prime are 2x2 mosaics.
+
+    Parameters
+    ----------
+    instrument : str, optional
+       The instrument code, 'c4d', 'k4m' or 'ksb'.  Default is 'c4d'.
+
+    Returns
+    -------
+    chips : astropy table
+       Table with CCDNUM, EXTNAME, XOFF and YOFF (chip center offsets in degrees),
+       GAIN, RDNOISE and SATURATE.
+
+    Example
+    -------
+
+    chips = chiplayout('c4d')
+
+    """
+    inst = INSTRUMENTS[instrument]
+    if instrument=='c4d':
+        xyoff = Table.read(utils.datadir()+'params/decam_chip_xyoff.fits')
+        chipdata = Table.read(utils.datadir()+'params/decam_chip_data.fits')
+        dum,ind1,ind2 = np.intersect1d(xyoff['CHIP'],chipdata['ccdnum'],return_indices=True)
+        chips = Table()
+        chips['CCDNUM'] = np.array(xyoff['CHIP'][ind1]).astype(int)
+        chips['EXTNAME'] = np.array(chipdata['name'][ind2]).astype(str)
+        chips['XOFF'] = np.array(xyoff['XOFF'][ind1],float)
+        chips['YOFF'] = np.array(xyoff['YOFF'][ind1],float)
+        chips['GAIN'] = np.array(chipdata['gain'][ind2],float)
+        chips['RDNOISE'] = np.array(chipdata['rdnoise'][ind2],float)
+        chips['SATURATE'] = np.array(chipdata['saturation'][ind2],float)
+        chips.sort('CCDNUM')
+    else:
+        # 2x2 mosaic with small gaps
+        dx = 0.5*inst['nx']*inst['pixscale']/3600+0.005
+        dy = 0.5*inst['ny']*inst['pixscale']/3600+0.005
+        chips = Table()
+        chips['CCDNUM'] = np.arange(4)+1
+        chips['EXTNAME'] = ['ccd'+str(i+1) for i in range(4)]
+        chips['XOFF'] = np.array([-dx,dx,-dx,dx])
+        chips['YOFF'] = np.array([dy,dy,-dy,-dy])
+        chips['GAIN'] = inst['gain']
+        chips['RDNOISE'] = inst['rdnoise']
+        chips['SATURATE'] = inst['saturate']
+    return chips
+
+
+def randommags(num,mlo=15.0,mhi=24.0,slope=0.35,rng=None):
+    """ Random magnitudes with a power-law luminosity function, N(<m) ~ 10^(slope*m)."""
+    if rng is None: rng=np.random.default_rng()
+    u = rng.uniform(size=num)
+    a,b = 10**(slope*mlo),10**(slope*mhi)
+    return np.log10(a+u*(b-a))/slope
+
+
+def psfimage(im,x,y,flux,fwhm,psf='gaussian',beta=2.5):
+    """
+    Add stars with a Gaussian or Moffat PSF to an image (in place).
+
+    Parameters
+    ----------
+    im : numpy array
+       The 2D image.
+    x, y : numpy array
+       The 0-based star centers in pixels.
+    flux : numpy array
+       The total star fluxes.
+    fwhm : float
+       The PSF FWHM in pixels.
+    psf : str, optional
+       'gaussian' (the default) or 'moffat'.
+    beta : float, optional
+       The Moffat beta parameter.  Default is 2.5.
+
+    Returns
+    -------
+    im : numpy array
+       The image with the stars added.
+
+    Example
+    -------
+
+    im = psfimage(im,x,y,flux,4.0,'moffat')
+
+    """
+    ny,nx = im.shape
+    if psf=='moffat':
+        alpha = 0.5*fwhm/np.sqrt(2**(1/beta)-1)
+        rad = int(np.ceil(4*fwhm))
+    else:
+        sigma = fwhm/2.3548
+        rad = int(np.ceil(3*fwhm))
+    # Pixel offsets of the stamp
+    yy,xx = np.mgrid[-rad:rad+1,-rad:rad+1]
+    for i in range(len(x)):
+        ix,iy = int(np.round(x[i])),int(np.round(y[i]))
+        x0,x1 = max(ix-rad,0),min(ix+rad+1,nx)
+        y0,y1 = max(iy-rad,0),min(iy+rad+1,ny)
+        if x0>=x1 or y0>=y1: continue
+        dx = xx[y0-iy+rad:y1-iy+rad,x0-ix+rad:x1-ix+rad]+ix-x[i]
+        dy = yy[y0-iy+rad:y1-iy+rad,x0-ix+rad:x1-ix+rad]+iy-y[i]
+        rr = dx**2+dy**2
+        if psf=='moffat':
+            prof = (beta-1)/(np.pi*alpha**2)*(1+rr/alpha**2)**(-beta)
+        else:
+            prof = np.exp(-0.5*rr/sigma**2)/(2*np.pi*sigma**2)
+        im[y0:y1,x0:x1] += flux[i]*prof
+    return im
+
+
+def chipheader(chip,instrument,nx,ny,ra,dec,fwhm):
+    """ Make the header of one chip with a TAN WCS centered on the chip."""
+    inst = INSTRUMENTS[instrument]
+    pixscale = inst['pixscale']
+    head = fits.Header()
+    head['EXTNAME'] = chip['EXTNAME']
+    head['CCDNUM'] = int(chip['CCDNUM'])
+    head['CTYPE1'] = 'RA---TAN'
+    head['CTYPE2'] = 'DEC--TAN'
+    head['CRVAL1'] = (ra+chip['XOFF']/np.cos(np.deg2rad(dec))) % 360
+    head['CRVAL2'] = dec+chip['YOFF']
+    head['CRPIX1'] = 0.5*(nx+1)
+    head['CRPIX2'] = 0.5*(ny+1)
+    head['CD1_1'] = -pixscale/3600
+    head['CD1_2'] = 0.0
+    head['CD2_1'] = 0.0
+    head['CD2_2'] = pixscale/3600
+    if instrument=='c4d':
+        for a in ['A','B']:
+            head['GAIN'+a] = chip['GAIN']
+            head['RDNOISE'+a] = chip['RDNOISE']
+            head['SATURAT'+a] = chip['SATURATE']
+        head['FWHM'] = fwhm/pixscale
+    else:
+        head['GAIN'] = chip['GAIN']
+        head['RDNOISE'] = chip['RDNOISE']
+        head['SEEING1'] = fwhm
+    head['SATURATE'] = chip['SATURATE']
+    head['DATASEC'] = '[1:%d,1:%d]' % (nx,ny)
+    return head
+
+
+def primaryheader(instrument,dateobs,exptime,expnum):
+    """ Make the primary header of an exposure."""
+    inst = INSTRUMENTS[instrument]
+    t = Time(dateobs,format='isot')
+    phead = fits.Header()
+    phead['DTINSTRU'] = inst['dtinstru']
+    phead['INSTRUME'] = inst['dtinstru']
+    phead['DATE-OBS'] = dateobs
+    phead['MJD-OBS'] = t.mjd
+    phead['EXPTIME'] = exptime
+    phead['FILTER'] = inst['filter']
+    phead['AIRMASS'] = 1.2
+    phead['EXPNUM'] = expnum
+    phead['OBJECT'] = 'benchmark'
+    phead['PLVER'] = 'V4.8.2'
+    phead['WCSCAL'] = 'Successful'
+    if instrument=='ksb':
+        phead['DTACQNAM'] = '/data1/batch/bok/'+t.strftime('%Y%m%d')+'/d'+str(expnum)[-4:]+'.0001.fits.fz'
+    return phead
+
+
+def expbase(instrument,dateobs):
+    """ The InstCal base name of an exposure, e.g. c4d_160825_043133_ooi_g_v1."""
+    t = Time(dateobs,format='isot')
+    return instrument+'_'+t.strftime('%y%m%d_%H%M%S')+'_ooi_'+INSTRUMENTS[instrument]['band']+'_v1'
+
+
+def randomstars(head,nx,ny,density,exptime=90.0,rng=None):
+    """
+    Random stars on one chip.
+
+    Parameters
+    ----------
+    head : header
+       The chip header with the WCS and CCDNUM.
+    nx, ny : int
+       The chip size in pixels.
+    density : float
+       The number of stars per square degree.
+    exptime : float, optional
+       The exposure time in seconds.  Default is 90.
+    rng : numpy Generator, optional
+       The random number generator.
+
+    Returns
+    -------
+    truth : astropy table
+       Table with ccdnum, x, y (0-based), ra, dec, mag and flux (ADU).
+
+    Example
+    -------
+
+    truth = randomstars(head,2046,4094,2e4)
+
+    """
+    if rng is None: rng=np.random.default_rng()
+    pixscale = np.sqrt(np.abs(head['CD1_1']*head['CD2_2']))
+    area = nx*ny*pixscale**2
+    nstars = rng.poisson(density*area)
+    truth = Table()
+    truth['ccdnum'] = np.zeros(nstars,int)+int(head['CCDNUM'])
+    truth['x'] = rng.uniform(-0.5,nx-0.5,nstars)
+    truth['y'] = rng.uniform(-0.5,ny-0.5,nstars)
+    ra,dec = WCS(head).pixel_to_world_values(truth['x'],truth['y'])
+    truth['ra'] = ra
+    truth['dec'] = dec
+    truth['mag'] = randommags(nstars,rng=rng)
+    truth['flux'] = 10**(-0.4*(truth['mag']-ZEROPOINT))*exptime
+    return truth
+
+
+def mkexposure(outdir,instrument='c4d',density=2e4,fwhm=1.2,psf='gaussian',beta=2.5,
+               chipscale=0.25,nchips=None,ra=150.0,dec=-30.0,exptime=90.0,sky=1000.0,
+               dateobs='2016-08-25T04:31:33.0',expnum=100000,compress=False,seed=0):
+    """
+    Create a synthetic InstCal-like exposure: flux, weight and mask
+    multi-extension FITS files with stars, sky, noise, bad columns and
+    saturated pixels.
+
+    Parameters
+    ----------
+    outdir : str
+       The output directory.
+    instrument : str, optional
+       The instrument code, 'c4d', 'k4m' or 'ksb'.  Default is 'c4d'.
+    density : float, optional
+       The number of stars per square degree.  Default is 2e4.
+    fwhm : float, optional
+       The seeing FWHM in arcsec.  Default is 1.2.
+    psf : str, optional
+       The PSF profile, 'gaussian' (the default) or 'moffat'.
+    beta : float, optional
+       The Moffat beta parameter.  Default is 2.5.
+    chipscale : float, optional
+       Scale factor of the chip sizes.  Default is 0.25.
+    nchips : int, optional
+       Only make the first `nchips` chips.  By default all chips are made.
+    ra, dec : float, optional
+       The pointing center in degrees.  Default is 150, -30.
+    exptime : float, optional
+       The exposure time in seconds.  Default is 90.
+    sky : float, optional
+       The sky level in ADU.  Default is 1000.
+    dateobs : str, optional
+       The observation date and time.
+    expnum : int, optional
+       The exposure number.  Default is 100000.
+    compress : bool, optional
+       Write tile-compressed (.fits.fz) files.  Default is False.
+    seed : int, optional
+       The random number seed.  Default is 0.
+
+    Returns
+    -------
+    expinfo : dict
+       Dictionary with the base name, the flux, weight and mask filenames,
+       the chip size and the table of true star values.
+
+    Example
+    -------
+
+    expinfo = mkexposure('/tmp/bench','c4d',density=5e4,chipscale=0.25)
+
+    """
+    rng = np.random.default_rng(seed)
+    inst = INSTRUMENTS[instrument]
+    chips = chiplayout(instrument)
+    if nchips is not None: chips=chips[0:nchips]
+    nx = int(inst['nx']*chipscale)
+    ny = int(inst['ny']*chipscale)
+    fwhmpix = fwhm/inst['pixscale']
+    base = expbase(instrument,dateobs)
+    if os.path.exists(outdir)==False: os.makedirs(outdir)
+
+    phead = primaryheader(instrument,dateobs,exptime,expnum)
+    fhdu = fits.HDUList([fits.PrimaryHDU(header=phead)])
+    whdu = fits.HDUList([fits.PrimaryHDU(header=phead)])
+    mhdu = fits.HDUList([fits.PrimaryHDU(header=phead)])
+    imhdu = fits.CompImageHDU if compress else fits.ImageHDU
+    truth = []
+    for c in chips:
+        head = chipheader(c,instrument,nx,ny,ra,dec,fwhm)
+        tab = randomstars(head,nx,ny,density,exptime,rng=rng)
+        im = np.zeros((ny,nx),float)+sky
+        psfimage(im,tab['x'],tab['y'],tab['flux'],fwhmpix,psf=psf,beta=beta)
+        # Noise, in ADU
+        var = np.maximum(im,0)/c['GAIN']+(c['RDNOISE']/c['GAIN'])**2
+        im += rng.normal(size=im.shape)*np.sqrt(var)
+        # Mask, CP V3.5.0+ integer values
+        #  1 = bad pixel, 3 = saturated
+        mask = np.zeros((ny,nx),np.int32)
+        badcol = rng.integers(0,nx,2)
+        mask[:,badcol] = 1
+        im[:,badcol] = rng.uniform(0,c['SATURATE'],(ny,2))
+        satpix = (im > c['SATURATE'])
+        im[satpix] = c['SATURATE']
+        mask[satpix] = 3
+        wt = 1/var
+        wt[mask>0] = 0.0
+        fhdu.append(imhdu(im.astype(np.float32),header=head))
+        whdu.append(imhdu(wt.astype(np.float32),header=head))
+        mhdu.append(imhdu(mask,header=head))
+        truth.append(tab)
+    truth = utils.vstack(truth)
+
+    ext = '.fits.fz' if compress else '.fits'
+    fluxfile = os.path.join(outdir,base+ext)
+    wtfile = os.path.join(outdir,base.replace('_ooi_','_oow_')+ext)
+    maskfile = os.path.join(outdir,base.replace('_ooi_','_ood_')+ext)
+    for f,hdu in zip([fluxfile,wtfile,maskfile],[fhdu,whdu,mhdu]):
+        hdu.writeto(f,overwrite=True)
+    return {'base':base,'instrument':instrument,'fluxfile':fluxfile,'wtfile':wtfile,
+            'maskfile':maskfile,'nx':nx,'ny':ny,'fwhm':fwhm,'truth':truth}
+
+
+def mkrefcat(truth,band='g',maglim=21.0,seed=0):
+    """
+    Make a Gaia-like reference catalog with XP synthetic photometry
+    from the true star values, in the format calibrate() expects.
+
+    Parameters
+    ----------
+    truth : astropy table
+       The table of true star values with ra, dec and mag.
+    band : str, optional
+       The filter of the synthetic photometry column.  Default is 'g'.
+    maglim : float, optional
+       Only stars brighter than this are included.  Default is 21.0.
+    seed : int, optional
+       The random number seed.  Default is 0.
+
+    Returns
+    -------
+    ref : astropy table
+       The reference catalog.
+
+    Example
+    -------
+
+    ref = mkrefcat(expinfo['truth'])
+
+    """
+    rng = np.random.default_rng(seed)
+    gd, = np.where(truth['mag'] < maglim)
+    ref = Table()
+    ref['source'] = np.arange(len(gd))+1
+    ref['ra'] = np.array(truth['ra'][gd])
+    ref['dec'] = np.array(truth['dec'][gd])
+    ref['ra_error'] = 0.1
+    ref['dec_error'] = 0.1
+    ref['pmra'] = 0.0
+    ref['pmdec'] = 0.0
+    color = rng.uniform(0.5,1.5,len(gd))
+    ref['gmag'] = np.array(truth['mag'][gd])
+    ref['bp'] = ref['gmag']+0.4*color
+    ref['rp'] = ref['gmag']-0.6*color
+    ref['gsynth_'+band+'mag'] = np.array(truth['mag'][gd])+rng.normal(0,0.01,len(gd))
+    ref['e_gsynth_'+band+'mag'] = 0.01
+    return ref
+
+
+def mkeqnfile(outfile,instrument='c4d',bands=['u','g','r','i','z','Y']):
+    """ Write a model magnitude equation file that uses the XP synthetic magnitudes directly."""
+    with open(outfile,'w') as f:
+        f.write('BAND INSTRUMENT DECRANGE COLOREQN COLORANGE MODELMAGEQN QUALITYCUTS\n')
+        for b in bands:
+            col = 'GSYNTH_'+b.upper()+'MAG'
+            f.write('  %s  %s  [-90,90]  BP-RP  [-10,10]  %s  %s<50\n' % (b,instrument,col,col))
+    return outfile
+
+
+def mkmeasexp(rootdir,instrument='c4d',density=2e4,fwhm=1.2,nchips=None,ra=150.0,dec=-30.0,
+              exptime=90.0,sky=1000.0,dateobs='2016-08-25T04:31:33.0',expnum=100000,
+              version='v4',seed=0):
+    """
+    Create a measured NSC exposure directory, the way nsc_instcal_measure leaves it,
+    directly from random stars (no images).  This is the input of calibrate().
+
+    The directory is `rootdir`/nsc/instcal/`version`/`instrument`/`night`/`base`/
+    and has the <base>_meas.fits chip catalogs, the <base>_header.fits chip
+    headers and the <base>.log logfile.
+
+    Parameters
+    ----------
+    rootdir : str
+       The root directory.
+    instrument : str, optional
+       The instrument code, 'c4d', 'k4m' or 'ksb'.  Default is 'c4d'.
+    density : float, optional
+       The number of stars per square degree.  Default is 2e4.
+    fwhm : float, optional
+       The seeing FWHM in arcsec.  Default is 1.2.
+    nchips : int, optional
+       Only make the first `nchips` chips.  By default all chips are made,
+       calibrate() needs at least 59 DECam chips.
+    ra, dec : float, optional
+       The pointing center in degrees.  Default is 150, -30.
+    exptime : float, optional
+       The exposure time in seconds.  Default is 90.
+    sky : float, optional
+       The sky level in ADU.  Default is 1000.
+    dateobs : str, optional
+       The observation date and time.
+    expnum : int, optional
+       The exposure number.  Default is 100000.
+    version : str, optional
+       The NSC version.  Default is 'v4'.
+    seed : int, optional
+       The random number seed.  Default is 0.
+
+    Returns
+    -------
+    expdir : str
+       The exposure directory.
+    truth : astropy table
+       The table of true star values.
+
+    Example
+    -------
+
+    expdir,truth = mkmeasexp('/tmp/bench',density=5e4)
+
+    """
+    rng = np.random.default_rng(seed)
+    inst = INSTRUMENTS[instrument]
+    chips = chiplayout(instrument)
+    if nchips is not None: chips=chips[0:nchips]
+    nx,ny = inst['nx'],inst['ny']
+    pixscale = inst['pixscale']
+    fwhmpix = fwhm/pixscale
+    base = expbase(instrument,dateobs)
+    night = Time(dateobs,format='isot').strftime('%Y%m%d')
+    expdir = os.path.join(rootdir,'nsc','instcal',version,instrument,night,base)
+    if os.path.exists(expdir)==False: os.makedirs(expdir)
+
+    phead = primaryheader(instrument,dateobs,exptime,expnum)
+    mhdu = fits.HDUList([fits.PrimaryHDU()])
+    hhdu = fits.HDUList([fits.PrimaryHDU()])
+    truth = []
+    # Noise pixels under the PSF
+    npix = np.pi*fwhmpix**2
+    for c in chips:
+        head = chipheader(c,instrument,nx,ny,ra,dec,fwhm)
+        tab = randomstars(head,nx,ny,density,exptime,rng=rng)
+        nstars = len(tab)
+        # Measurement errors
+        noise = np.sqrt(tab['flux']/c['GAIN']+npix*(sky/c['GAIN']+(c['RDNOISE']/c['GAIN'])**2))
+        magerr = np.array(1.087*noise/tab['flux'])
+        coorderr = np.sqrt((0.664*fwhm*magerr/1.087)**2+0.02**2)/3600
+        mag = np.array(ZEROPOINT-2.5*np.log10(tab['flux'])+rng.normal(size=nstars)*magerr)
+        x = np.array(tab['x'])+rng.normal(size=nstars)*coorderr*3600/pixscale
+        y = np.array(tab['y'])+rng.normal(size=nstars)*coorderr*3600/pixscale
+        cra,cdec = WCS(head).pixel_to_world_values(x,y)
+        cat = Table()
+        cat['number'] = np.arange(nstars)+1
+        cat['x_image'] = x+1
+        cat['y_image'] = y+1
+        cat['alpha_j2000'] = cra
+        cat['delta_j2000'] = cdec
+        cat['xpsf'] = x+1
+        cat['ypsf'] = y+1
+        cat['rapsf'] = cra
+        cat['decpsf'] = cdec
+        cat['magpsf'] = mag
+        cat['errpsf'] = magerr
+        cat['sky'] = sky
+        cat['iter'] = 4
+        cat['chi'] = np.abs(rng.normal(1.0,0.1,nstars))
+        cat['sharp'] = rng.normal(0.0,0.05,nstars)
+        cat['mag_auto'] = mag
+        cat['magerr_auto'] = magerr
+        cat['mag_iso'] = mag
+        cat['magerr_iso'] = magerr
+        cat['mag_aper'] = np.outer(mag,np.ones(5))+np.array([0.6,0.3,0.1,0.05,0.0])
+        cat['magerr_aper'] = np.outer(magerr,np.ones(5))
+        cat['background'] = sky
+        cat['a_world'] = 0.5*fwhm/3600
+        cat['b_world'] = 0.5*fwhm/3600
+        cat['theta_world'] = rng.uniform(-90,90,nstars)
+        cat['erra_world'] = coorderr
+        cat['errb_world'] = coorderr
+        cat['errtheta_world'] = 1.0
+        cat['fwhm_world'] = fwhm/3600
+        cat['flags'] = np.zeros(nstars,np.int16)
+        cat['imaflags_iso'] = np.zeros(nstars,np.int32)
+        cat['class_star'] = 0.98
+        for n in cat.colnames: cat[n].name = n.upper()
+        newhdu = fits.table_to_hdu(cat)
+        newhdu.header['extname'] = str(c['CCDNUM'])
+        newhdu.header['ccdnum'] = int(c['CCDNUM'])
+        mhdu.append(newhdu)
+        newhead = phead.copy()
+        newhead.extend(head,update=True)
+        newhead['extname'] = str(c['CCDNUM'])
+        hhdu.append(fits.ImageHDU(header=newhead))
+        truth.append(tab)
+    truth = utils.vstack(truth)
+    mhdu.writeto(os.path.join(expdir,base+'_meas.fits'),overwrite=True)
+    hhdu.writeto(os.path.join(expdir,base+'_header.fits'),overwrite=True)
+    # calibrate() gets the original image names from the logfile
+    night = Time(dateobs,format='isot').strftime('%Y%m%d')
+    archdir = '/archive/pipeline/Q'+night[:6]+'/DEC'+night[2:4]+'B/'+night+'/'
+    with open(os.path.join(expdir,base+'.log'),'w') as f:
+        f.write('Copying InstCal images downloaded from Astro Data Archive\n')
+        f.write('  '+archdir+base+'.fits.fz\n')
+        f.write('  '+archdir+base.replace('_ooi_','_oow_')+'.fits.fz\n')
+        f.write('  '+archdir+base.replace('_ooi_','_ood_')+'.fits.fz\n')
+    return expdir,truth
+
+
+def mkmulticat(nobj=10000,nexp=10,ra=150.0,dec=-30.0,radius=0.2,fwhm=1.2,seed=0):
+    """
+    Make a multi-epoch measurement catalog like the one combine()
+    clusters: `nexp` exposures of the same `nobj` objects, each with
+    detection losses, astrometric errors and a small proper motion.
+
+    Parameters
+    ----------
+    nobj : int, optional
+       The number of objects.  Default is 10000.
+    nexp : int, optional
+       The number of exposures.  Default is 10.
+    ra, dec : float, optional
+       The center of the region in degrees.  Default is 150, -30.
+    radius : float, optional
+       The half-width of the region in degrees.  Default is 0.2.
+    fwhm : float, optional
+       The seeing FWHM in arcsec.  Default is 1.2.
+    seed : int, optional
+       The random number seed.  Default is 0.
+
+    Returns
+    -------
+    cat : numpy structured array
+       The measurement catalog with the combine() column names.
+
+    Example
+    -------
+
+    cat = mkmulticat(50000,20)
+
+    """
+    rng = np.random.default_rng(seed)
+    ora = ra+rng.uniform(-radius,radius,nobj)/np.cos(np.deg2rad(dec))
+    odec = dec+rng.uniform(-radius,radius,nobj)
+    omag = randommags(nobj,rng=rng)
+    pmra = rng.normal(0,5,nobj)     # mas/yr
+    pmdec = rng.normal(0,5,nobj)
+    mjd = 57000.0+np.sort(rng.uniform(0,5*365.0,nexp))
+    # Fainter objects are detected less often
+    pdet = np.clip(1.2-0.1*(omag-18),0.1,1.0)
+    det = rng.uniform(size=(nexp,nobj)) < pdet
+    ncat = int(np.sum(det))
+    dt = np.dtype([('MEASID',(str,30)),('OBJLABEL',int),('EXPOSURE',(str,40)),('CCDNUM',int),('FILTER',(str,2)),
+                   ('MJD',float),('RA',float),('RAERR',np.float32),('DEC',float),('DECERR',np.float32),
+                   ('MAG_AUTO',np.float32),('MAGERR_AUTO',np.float32),('ASEMI',np.float32),('ASEMIERR',np.float32),
+                   ('BSEMI',np.float32),('BSEMIERR',np.float32),('THETA',np.float32),('THETAERR',np.float32),
+                   ('FWHM',np.float32),('FLAGS',np.int16),('CLASS_STAR',np.float32)])
+    cat = np.zeros(ncat,dtype=dt)
+    cnt = 0
+    for i in range(nexp):
+        ind, = np.where(det[i])
+        n = len(ind)
+        cat1 = cat[cnt:cnt+n]
+        magerr = np.clip(0.01*10**(0.4*(omag[ind]-20)),0.001,0.5)
+        coorderr = np.sqrt((0.664*fwhm*magerr/1.087)**2+0.02**2)   # arcsec
+        delt = (mjd[i]-57000.0)/365.2425
+        cat1['MEASID'] = ['exp%d.%d' % (i,j) for j in range(n)]
+        cat1['OBJLABEL'] = -1
+        cat1['EXPOSURE'] = 'c4d_exp%03d' % i
+        cat1['CCDNUM'] = 1
+        cat1['FILTER'] = 'g'
+        cat1['MJD'] = mjd[i]
+        cat1['RA'] = (ora[ind]+(delt*pmra[ind]/3.6e6+rng.normal(size=n)*coorderr/3600)/np.cos(np.deg2rad(dec)))
+        cat1['DEC'] = odec[ind]+delt*pmdec[ind]/3.6e6+rng.normal(size=n)*coorderr/3600
+        cat1['RAERR'] = coorderr
+        cat1['DECERR'] = coorderr
+        cat1['MAG_AUTO'] = omag[ind]+rng.normal(size=n)*magerr
+        cat1['MAGERR_AUTO'] = magerr
+        cat1['ASEMI'] = 0.5*fwhm
+        cat1['BSEMI'] = 0.5*fwhm
+        cat1['ASEMIERR'] = coorderr
+        cat1['BSEMIERR'] = coorderr
+        cat1['THETA'] = rng.uniform(-90,90,n)
+        cat1['THETAERR'] = 1.0
+        cat1['FWHM'] = fwhm
+        cat1['CLASS_STAR'] = 0.98
+        cat[cnt:cnt+n] = cat1
+        cnt += n
+    return cat
+
+
+def findbinaries(bindir=None,names=['sex','daophot','allstar']):
+    """ Return the list of the external programs that can't be found."""
+    missing = []
+    for n in names:
+        path = shutil.which(n,path=bindir) if bindir is not None else shutil.which(n)
+        if path is None: missing.append(n)
+    return missing
+
+
+def _runstage(timer,stage,func,**tags):
+    """
+    Run and time one benchmark stage.  The status of the stage ('ok',
+    'skipped: <reason>' or 'failed: <error>') is added to its row.
+    """
+    status = 'ok'
+    try:
+        with timer(stage,**tags):
+            out = func()
+    except ImportError as e:
+        status = 'skipped: '+str(e)
+        out = None
+    except Exception as e:
+        status = 'failed: '+e.__class__.__name__+' '+str(e)
+        out = None
+    timer.rows[-1]['status'] = status
+    print('%-22s %8.2f sec  %s' % (stage,timer.rows[-1]['wall'],status))
+    return out
+
+
+def benchmeasure(workdir,expinfo,timer,bindir=None,**tags):
+    """
+    Benchmark nsc_instcal_measure on a synthetic exposure.  If SExtractor
+    and DAOPHOT are installed the full Exposure.run() is timed.  Otherwise
+    the python stages are timed on their own (setup, loading the chips,
+    the DAOPHOT option files and images and sep aperture photometry at the
+    true star positions).
+    """
+    from . import phot
+    from .nsc_instcal_measure import Exposure
+    origdir = os.getcwd()
+    rootlogger = logging.getLogger()
+    handlers = list(rootlogger.handlers)
+    os.chdir(workdir)
+    try:
+        exp = Exposure(expinfo['fluxfile'],expinfo['wtfile'],expinfo['maskfile'],'v4',None)
+        if len(findbinaries(bindir))==0:
+            _runstage(timer,'measure.run',exp.run,**tags)
+            return
+        missing = ','.join(findbinaries(bindir))
+        _runstage(timer,'measure.setup',exp.setup,**tags)
+        truth = expinfo['truth']
+        chips = []
+        def loadchips():
+            for i in range(1,exp.nexten):
+                exp.loadchip(i,fluxfile='flux%d.fits' % i,wtfile='wt%d.fits' % i,maskfile='mask%d.fits' % i)
+                chips.append(exp.chip)
+        def daoprep():
+            for chip in chips:
+                chip.meta['FWHM'] = expinfo['fwhm']
+                chip.mkopt()
+                chip.mkdaoim()
+                ind, = np.where(truth['ccdnum']==chip.ccdnum)
+                cat = Table()
+                cat['NUMBER'] = np.arange(len(ind))+1
+                cat['X_IMAGE'] = np.array(truth['x'][ind])+1
+                cat['Y_IMAGE'] = np.array(truth['y'][ind])+1
+                cat['MAG_AUTO'] = np.array(truth['mag'][ind])
+                chip.sextodao(cat,outfile=chip.base+'_dao.coo',format='coo')
+        def aperphot():
+            for chip in chips:
+                phot.sepaperphot(chip.daofile,chip.base+'_dao.coo',outfile=chip.base+'_dao.ap',
+                                 optfile=chip.base+'_dao.opt',logger=exp.logger)
+        _runstage(timer,'measure.loadchip',loadchips,**tags)
+        _runstage(timer,'measure.daoprep',daoprep,**tags)
+        _runstage(timer,'measure.sepaperphot',aperphot,**tags)
+        for s in ['runsex','daophot','allstar']:
+            timer.rows.append(dict(timer.tags,**tags,stage='measure.'+s,success=False,
+                                   status='skipped: '+missing+' not found'))
+        if exp.workdir is not None and os.path.exists(exp.workdir):
+            shutil.rmtree(exp.workdir)
+    finally:
+        os.chdir(origdir)
+        # Exposure.setup() adds its handlers to the root logger
+        for h in list(rootlogger.handlers):
+            if h not in handlers:
+                rootlogger.removeHandler(h)
+                h.close()
+
+
+def benchcalibrate(workdir,timer,instrument='c4d',density=2e4,**tags):
+    """
+    Benchmark calibrate() on a synthetic measured exposure.  If the SFD
+    dust maps are not installed a flat E(B-V) HEALPix map is used instead.
+    """
+    import healpy as hp
+    from . import calibrate,extinction
+    tags.update(instrument=instrument,density=density)
+    expdir,truth = mkmeasexp(workdir,instrument,density)
+    ref = mkrefcat(truth,INSTRUMENTS[instrument]['band'])
+    eqnfile = mkeqnfile(os.path.join(workdir,'modelmag_equations.txt'),instrument)
+    tags['nmeas'] = len(truth)
+    # the synthetic exposure doesn't need the production directories
+    rootdirs = [os.path.join(workdir,'')]*3
+    oldmap,oldmapfile = extinction._ebvmap,extinction._ebvmapfile
+    try:
+        extinction.getebv(truth['ra'][:1],truth['dec'][:1])
+        tags['ebvmap'] = 'sfd'
+    except (OSError,ValueError):
+        ebvfile = os.path.join(workdir,'ebvmap.npy')
+        np.save(ebvfile,np.zeros(hp.nside2npix(64),np.float32)+0.05)
+        extinction.loadebvmap(ebvfile)
+        tags['ebvmap'] = 'flat'
+    try:
+        _runstage(timer,'calibrate',lambda: calibrate.calibrate(expdir,ref,eqnfile,redo=True,rootdirs=rootdirs),**tags)
+    finally:
+        extinction._ebvmap,extinction._ebvmapfile = oldmap,oldmapfile
+
+
+def benchcombine(timer,nobj=10000,nexp=10,**tags):
+    """
+    Benchmark the combine() clustering and the object measurements.  The
+    object loop of combine() runs inline, meancoords(), propermotion() and
+    moments() are timed in its place.
+    """
+    cat = mkmulticat(nobj,nexp)
+    tags['nmeas'] = len(cat)
+    def cluster():
+        from . import combine
+        return combine.hybridcluster(cat)
+    out = _runstage(timer,'combine.cluster',cluster,**tags)
+    if out is None:
+        for s in ['meancoords','propermotion','moments']:
+            timer.rows.append(dict(timer.tags,**tags,stage='combine.'+s,success=False,
+                                   status='skipped: clustering did not run'))
+        return
+    from . import combine
+    labels,obj = out
+    for s in ['meancoords','propermotion','moments']:
+        _runstage(timer,'combine.'+s,lambda: getattr(combine,s)(cat,labels),**tags)
+
+
+def gitversion():
+    """ Return the git commit of the package, or '' if it is not a git checkout."""
+    try:
+        out = subprocess.run(['git','rev-parse','HEAD'],cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True,text=True,timeout=10)
+        return out.stdout.strip()
+    except Exception:
+        return ''
+
+
+def runbenchmarks(outdir,densities=[5e3,2e4,8e4],instruments=['c4d'],stages=['measure','calibrate','combine'],
+                  chipscale=0.25,nchips=4,nexp=10,bindir=None,outfile=None,clean=True):
+    """
+    Run the benchmark suite: nsc_instcal_measure on synthetic exposures,
+    calibrate() on synthetic measured exposures and the combine()
+    clustering on synthetic multi-epoch catalogs, at several source
+    densities.  Stages that can't run (missing programs or packages) are
+    recorded as skipped instead of stopping the run.
+
+    Parameters
+    ----------
+    outdir : str
+       The working directory.  The synthetic data are written here.
+    densities : list, optional
+       The source densities in stars per square degree.  Default is [5e3,2e4,8e4].
+    instruments : list, optional
+       The instruments to benchmark.  Default is ['c4d'].
+    stages : list, optional
+       The stages to run, 'measure', 'calibrate' and 'combine'.  Default is all.
+    chipscale : float, optional
+       Scale factor of the chip sizes of the synthetic images.  Default is 0.25.
+    nchips : int, optional
+       Number of chips of the synthetic images.  Default is 4.
+    nexp : int, optional
+       Number of exposures of the combine() catalogs.  Default is 10.
+    bindir : str, optional
+       The directory with the sex, daophot and allstar programs.  By default they are
+       found in the PATH.
+    outfile : str, optional
+       The output JSON file.  Default is `outdir`/benchmark.json.
+    clean : bool, optional
+       Delete the synthetic data at the end.  Default is True.
+
+    Returns
+    -------
+    results : dict
+       The host and software information and the list of timed stages.
+
+    Example
+    -------
+
+    results = runbenchmarks('/tmp/bench',densities=[2e4])
+
+    """
+    if os.path.exists(outdir)==False: os.makedirs(outdir)
+    outdir = os.path.abspath(outdir)
+    if outfile is None: outfile=os.path.join(outdir,'benchmark.json')
+    timer = utils.StageTimer()
+    for inst in instruments:
+        for density in densities:
+            tags = {'instrument':inst,'density':float(density)}
+            print('---- '+inst+'  density=%d stars/deg2 ----' % density)
+            workdir = os.path.join(outdir,inst+'_%d' % density)
+            if os.path.exists(workdir)==False: os.makedirs(workdir)
+            if 'measure' in stages:
+                t0 = time.time()
+                expinfo = mkexposure(os.path.join(workdir,'images'),inst,density,
+                                     chipscale=chipscale,nchips=nchips)
+                print('Synthetic exposure with %d stars made in %.2f sec' % (len(expinfo['truth']),time.time()-t0))
+                benchmeasure(workdir,expinfo,timer,bindir=bindir,nmeas=len(expinfo['truth']),**tags)
+            if 'calibrate' in stages:
+                benchcalibrate(workdir,timer,**tags)
+            if 'combine' in stages:
+                # same number of objects as a DECam field at this density
+                nobj = int(density*0.16)
+                benchcombine(timer,nobj,nexp,**tags)
+            if clean: shutil.rmtree(workdir)
+
+    results = {'host':socket.gethostname(),'platform':platform.platform(),
+               'python':platform.python_version(),'numpy':np.__version__,
+               'nsc':gitversion(),'date':Time.now().isot,
+               'stages':[{k:(v.item() if isinstance(v,np.generic) else v) for k,v in r.items()}
+                         for r in timer.rows]}
+    with open(outfile,'w') as f:
+        json.dump(results,f,indent=1)
+    print('Results written to '+outfile)
+    return results
+
+
+def compare(newfile,reffile,threshold=0.2):
+    """
+    Compare the wall times of two benchmark runs.
+
+    Parameters
+    ----------
+    newfile : str
+       The JSON results of the new run.
+    reffile : str
+       The JSON results of the reference run.
+    threshold : float, optional
+       Fractional slowdown that counts as a regression.  Default is 0.2.
+
+    Returns
+    -------
+    tab : astropy table
+       Table of stage, instrument, density, the two wall times, their ratio
+       and a regression flag, for the stages that ran in both.
+
+    Example
+    -------
+
+    tab = compare('benchmark.json','benchmark_ref.json')
+
+    """
+    def load(filename):
+        with open(filename,'r') as f:
+            res = json.load(f)
+        return {(r['stage'],r.get('instrument'),r.get('density')):r for r in res['stages']
+                if r.get('status')=='ok'}
+    new = load(newfile)
+    ref = load(reffile)
+    keys = [k for k in new if k in ref]
+    tab = Table()
+    tab['stage'] = [k[0] for k in keys]
+    tab['instrument'] = [str(k[1]) for k in keys]
+    tab['density'] = [k[2] for k in keys]
+    tab['wall'] = [new[k]['wall'] for k in keys]
+    tab['refwall'] = [ref[k]['wall'] for k in keys]
+    tab['ratio'] = tab['wall']/np.maximum(tab['refwall'],1e-6)
+    tab['regression'] = tab['ratio'] > 1+threshold
+    for r in tab:
+        print('%-22s %4s %8d %8.2f %8.2f %6.2f %s' % (r['stage'],r['instrument'],r['density'],r['wall'],
+                                                    r['refwall'],r['ratio'],'SLOWER' if r['regression'] else ''))
+    return tab
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Run the NSC throughput benchmarks on synthetic data')
+    parser.add_argument('--outdir', type=str, nargs=1, default='bench', help='Working directory')
+    parser.add_argument('--densities', type=str, nargs=1, default='5000,20000,80000', help='Comma-separated source densities (stars/deg2)')
+    parser.add_argument('--instruments', type=str, nargs=1, default='c4d', help='Comma-separated instruments')
+    parser.add_argument('--stages', type=str, nargs=1, default='measure,calibrate,combine', help='Comma-separated stages')
+    parser.add_argument('--chipscale', type=float, nargs=1, default=0.25, help='Scale factor of the chip sizes')
+    parser.add_argument('--nchips', type=int, nargs=1, default=4, help='Number of chips of the synthetic images')
+    parser.add_argument('--nexp', type=int, nargs=1, default=10, help='Number of exposures for combine')
+    parser.add_argument('--bindir', type=str, nargs=1, default=None, help='Directory with sex/daophot/allstar')
+    parser.add_argument('--outfile', type=str, nargs=1, default=None, help='Output JSON file')
+    parser.add_argument('--compare', type=str, nargs=1, default=None, help='Reference JSON file to compare to')
+    parser.add_argument('--keep', action='store_true', help='Keep the synthetic data')
+    args = parser.parse_args()
+
+    def getarg(val):
+        return val[0] if isinstance(val,list) else val
+    outdir = getarg(args.outdir)
+    densities = [float(d) for d in getarg(args.densities).split(',')]
+    instruments = getarg(args.instruments).split(',')
+    stages = getarg(args.stages).split(',')
+    outfile = getarg(args.outfile)
+    results = runbenchmarks(outdir,densities,instruments,stages,chipscale=getarg(args.chipscale),
+                            nchips=getarg(args.nchips),nexp=getarg(args.nexp),bindir=getarg(args.bindir),
+                            outfile=outfile,clean=not args.keep)
+    if args.compare is not None:
+        if outfile is None: outfile=os.path.join(outdir,'benchmark.json')
+        compare(outfile,getarg(args.compare))
@@ -1,131 +1,31 @@
 #!/usr/bin/env python
 
 import os
+import io
 import time
 import numpy as np
 from glob import glob
 import healpy as hp
 from astropy.io import fits
-from astropy.table import Table
+from astropy.table import Table,vstack
 from astropy.wcs import WCS
 from astropy.coordinates import SkyCoord
 from astropy.time import Time
 from dlnpyutils import utils as dln,coords
-from dustmaps.sfd import SFDQuery
 from scipy.optimize import curve_fit
 from scipy import stats
 import subprocess
 import traceback
 import shutil
-from . import utils,query,modelmag
+import multiprocessing
+from . import utils,query,modelmag,extinction,zeropoint,tarbundle
 
-def concatenate(expdir,deletetruncated=False):
+def concatenate(expdir,deletetruncated=False,ncpu=None):
     """
     Combine multiple chip-level measurement files into a single multi-extension FITS file.
+    See utils.concatmeas().
     """
-    if os.path.exists(expdir)==False:
-        print(expdir,'not found')
-        return
-
-    print('Concatenate FITS files for ',expdir)
-    
-    curdir = os.getcwd()
-    
-    # Is this a tar file
-    if os.path.isdir(expdir)==False and expdir.endswith('.tar.gz') or expdir.endswith('.tgz'):
-        print('This is a tar file.  Uncompressing.')
-        tarfile = os.path.basename(expdir)
-        base = tarfile.replace('.tgz','').replace('.tar.gz','')
-        nightdir = os.path.abspath(os.path.dirname(expdir))
-        expdir = nightdir+'/'+base
-        os.chdir(nightdir)        
-        res = subprocess.run(['tar','xvf',tarfile],capture_output=True)
-        if res.returncode==0:
-            print('success: removing',tarfile)
-            os.remove(tarfile)
-        else:
-            print('problem untarring',tarfile)
-            import pdb; pdb.set_trace()
-
-    os.chdir(expdir)
-    base = os.path.basename(expdir)
-    outfile = base+'_meas.fits'
-    if os.path.exists(outfile):
-        print(outfile,'already exists')
-        os.chdir(curdir)
-        return
-    fitsfiles1 = glob('*_?.fits')
-    fitsfiles1.sort()
-    fitsfiles2 = glob('*_??.fits')
-    fitsfiles2.sort()
-    fitsfiles = fitsfiles1+fitsfiles2
-    # c4d, too few files
-    if len(fitsfiles)<59 and expdir.find('/c4d/')>-1:
-        #print(len(fitsfiles),'fits files found. not enough.  skipping')
-        print(len(fitsfiles),'fits files found.  Truncated.  Deleting')
-        shutil.rmtree(expdir)
-        os.chdir(curdir)
-        return
-    # ksb/k4m, too few files
-    if len(fitsfiles)<4 and (expdir.find('/k4m/')>-1 or expdir.find('/ksb/')>-1):
-        print(len(fitsfiles),'fits files found.  Truncated.  Deleting')
-        shutil.rmtree(expdir)
-        os.chdir(curdir)
-        return
-    chdu = fits.HDUList()
-    hhdu = fits.HDUList()
-    hhdu.append(fits.PrimaryHDU())
-    for i in range(len(fitsfiles)):
-        hdu1 = fits.open(fitsfiles[i])
-        tab1 = Table.read(fitsfiles[i])
-        base1 = os.path.basename(fitsfiles[i])
-        print('{:3d} {:s} {:8d}'.format(i+1,base1,len(tab1)))
-        ccdnum = base1[:-5].split('_')[-1]
-        newhdu = fits.table_to_hdu(Table(hdu1[1].data))
-        newhdu.header['extname'] = ccdnum
-        newhdu.header['ccdnum'] = ccdnum
-        newhead = hdu1[0].header.copy()
-        newhead['extname'] = ccdnum
-        chdu.append(newhdu)
-        hhdu.append(fits.ImageHDU(header=newhead))
-        hdu1.close()
-    print('Writing',outfile)
-    chdu.writeto(outfile,overwrite=True)
-    chdu.close()
-    houtfile = base+'_header.fits'
-    print('Writing',houtfile)
-    hhdu.writeto(houtfile,overwrite=True)
-    hhdu.close()
-    # Confirm that it is there
-    if os.path.exists(outfile) and os.path.exists(houtfile):
-        # Delete fits files
-        print('Deleting',len(fitsfiles),'individual fits files')
-        for f in fitsfiles:
-            if os.path.exists(f): os.remove(f)
-        # Tar up the rest of the files
-        # leave out meas.fits, log
-        logfile = base+'.log'
-        tarfile = base+'.tgz'
-        allfiles = glob('*')
-        allfiles = [f for f in allfiles if os.path.isfile(f)]
-        allfiles.sort()
-        if outfile in allfiles:
-            allfiles.remove(outfile)
-        if houtfile in allfiles:
-            allfiles.remove(houtfile)
-        if logfile in allfiles:
-            allfiles.remove(logfile)
-        if tarfile in allfiles:
-            allfiles.remove(tarfile)
-        cmd = ['tar','cvzf',tarfile]+allfiles
-        print('tarring',len(allfiles),'files in',tarfile)
-        res = subprocess.run(cmd,capture_output=True)
-        if res.returncode==0:
-            print('tar success')
-            print('Deleting tarred files')
-            for f in allfiles:
-                if os.path.exists(f): os.remove(f)
-    os.chdir(curdir)
+    return utils.concatmeas(expdir,deletetruncated=deletetruncated,ncpu=ncpu)
 
 def uncalcoord(ra,dec,chinfo):
     # Uncalibrate coordinates, only good measurements
@@ -408,48 +308,9 @@ def getzpterm(meas1,ref1,mmags,expinfo,chinfo,kind='modelmag'):
     return expinfo,chinfo
 
 
-def fitzpterm(mstr,expinfo,chinfo):
-    # Fit the global and ccd zero-points 
-     
-    n = len(mstr['col']) 
-    diff = mstr['model'] - mstr['mag']
-    err = mstr['err']
-    # Make a sigma cut 
-    med = np.median(diff) 
-    sig = dln.mad(diff) 
-    gd, = np.where(np.abs(diff-med) < 3*sig) 
-    x = np.zeros(n,float)
-    zpterm,zptermerr1 = dln.wtmean(diff[gd],err[gd],error=True)
-    zptermerr = dln.bootstrap(diff[gd],dln.wtmean,args=err[gd],indexargs=True)
-    # Save in exposure table
-    expinfo['zpterm'] = zpterm 
-    expinfo['zptermerr'] = zptermerr 
-    expinfo['zptermsig'] = sig 
-    expinfo['nrefmatch'] = n 
-    expinfo['ngoodrefmatch'] = len(gd)
-     
-    # Measure chip-level zpterm and variations 
-    nchips = len(chinfo) 
-    for i in range(nchips): 
-        ind1,ind2 = dln.match(chinfo['ccdnum'][i],mstr['ccdnum'])
-        nmatch = len(ind1)
-        if nmatch >= 5: 
-            gd1, = np.where(np.abs(diff[ind2]-med) < 3*sig) 
-            if len(gd1) >= 5: 
-                zpterm1, _ = dln.wtmean(diff[ind2[gd1]],err[ind2[gd1]],error=True)
-                zptermerr1 = dln.bootstrap(diff[ind2[gd1]],dln.wtmean,args=err[ind2[gd1]],indexargs=True)
-                chinfo['zpterm'][i] = zpterm1 
-                chinfo['zptermerr'][i] = zptermerr1 
-                chinfo['nrefmatch'][i] = nmatch 
-     
-    # Measure spatial variations 
-    gdchip, = np.where(chinfo['zpterm'] < 1000) 
-    if len(gdchip) > 1: 
-        expinfo['zpspatialvar_rms'] = np.std(chinfo['zpterm'][gdchip]) 
-        expinfo['zpspatialvar_range'] = np.max(chinfo['zpterm'][gdchip])-np.min(chinfo['zpterm'][gdchip]) 
-        expinfo['zpspatialvar_nccd'] = len(gdchip)
-
-    return expinfo,chinfo
+def fitzpterm(mstr,expinfo,chinfo,errmethod='bootstrap',nmatchcol='nrefmatch'):
+    """ Fit the global and ccd zero-points, see zeropoint.fitzpterm()."""
+    return zeropoint.fitzpterm(mstr,expinfo,chinfo,errmethod=errmethod,nmatchcol=nmatchcol)
 
 
 def selfcalzpterm(expdir,cat,expinfo,chinfo,logger=None,silent=False):
@@ -683,47 +544,7 @@ def selfcalzpterm(expdir,cat,expinfo,chinfo,logger=None,silent=False):
      
     # MEASURE THE ZERO-POINT 
     #----------------------- 
-    # Same as from fitzpterm()
-     
-    # Fit the global and ccd zero-points 
-    n = len(mstr['col']) 
-    diff = mstr['model'] - mstr['mag']
-    err = mstr['err']
-    # Make a sigma cut 
-    med = np.median(diff) 
-    sig = dln.mad(diff) 
-    gd, = np.where(np.abs(diff-med) < 3*sig) 
-    ngd = len(gd)
-    x = np.zeros(n,float)
-    zpterm, _ = dln.wtmean(diff[gd],err[gd],error=True)
-    zptermerr = dln.bootstrap(diff[gd],dln.wtmean,args=err[gd],indexargs=True)
-    # Save in exposure structure 
-    expinfo['zpterm'] = zpterm 
-    expinfo['zptermerr'] = zptermerr 
-    expinfo['zptermsig'] = sig 
-    expinfo['nrefmatch'] = n 
-    expinfo['ngoodrefmatch'] = ngd 
-     
-    # Measure chip-level zpterm and variations 
-    nchips = len(chinfo) 
-    for i in range(nchips): 
-        ind1,ind2 = dln.match(chinfo['ccdnum'][i],mstr['ccdnum'])
-        nmatch = len(ind1)
-        if nmatch >= 5: 
-            gd1, = np.where(np.abs(diff[ind2]-med) < 3*sig) 
-            if len(gd1) >= 5: 
-                zpterm1, _ = dln.wtmean(diff[ind2[gd1]],err[ind2[gd1]],error=True)
-                zptermerr1 = dln.bootstrap(diff[ind2[gd1]],dln.wtmean,args=err[ind2[gd1]],indexargs=True)
-                chinfo['zpterm'][i] = zpterm1 
-                chinfo['zptermerr'][i] = zptermerr1 
-                chinfo['nmatch'][i] = nmatch 
-     
-    # Measure spatial variations 
-    gdchip, = np.where(chinfo['zpterm'] < 1000) 
-    if len(gdchip) > 1: 
-        expinfo['zpspatialvar_rms'] = np.std(chinfo['zpterm'][gdchip]) 
-        expinfo['zpspatialvar_range'] = np.max(chinfo['zpterm'][gdchip]-np.min(chinfo['zpterm'][gdchip]))
-        expinfo['zpspatialvar_nccd'] = len(gdchip)
+    expinfo,chinfo = fitzpterm(mstr,expinfo,chinfo,nmatchcol='nmatch')
      
     # Print out the results 
     #if not keyword_set(silent) then begin 
@@ -737,14 +558,173 @@ def selfcalzpterm(expdir,cat,expinfo,chinfo,logger=None,silent=False):
      
     return expinfo,chinfo
 
+
+def selfcalregion(cats,expinfo,chinfos,dcr=0.5,logger=None):
+    """
+    Self-calibrate all the exposures in a region (e.g. HEALPix pixel)
+    at once.  The bright stars of all exposures are cross-matched once
+    and the zero-points of all exposures and chips are solved
+    simultaneously with a sparse least-squares system (ubercal).
+    Chips of exposures that were already calibrated with a reference
+    catalog (ZPTYPE 1 or 2) are used as anchors.
+
+    Parameters
+    ----------
+    cats : list
+       List of calibrated measurement tables (the _meas2.fits catalogs
+         written by calibrate()), one per exposure.
+    expinfo : astropy table
+       Exposure meta-data table with one row per exposure in CATS.
+    chinfos : list
+       List of chip meta-data tables, one per exposure.  The ZPTERM
+         values are the zero-points that were applied to the
+         magnitudes in CATS (0 for uncalibrated exposures).
+    dcr : float, optional
+       Cross-matching radius in arcsec.  Default is 0.5.
+    logger : logging object, optional
+       A logging object used for logging information.
+
+    Returns
+    -------
+    expinfo : astropy table
+       Exposure meta-data table updated with zero-point information
+         for the self-calibrated exposures.
+    chinfos : list
+       Chip meta-data tables updated with zero-point information.
+
+    Example
+    -------
+
+    expinfo,chinfos = selfcalregion(cats,expinfo,chinfos)
+
+    """
+
+    if logger is None:
+        logger = dln.basiclogger()
+    nexp = len(cats)
+    logger.info('Self-calibrating '+str(nexp)+' exposures in the region')
+
+    # Zero-point index for each exposure/chip pair
+    zpexp,zpccd,zpold,anchorzp = [],[],[],[]
+    for i in range(nexp):
+        calibrated = expinfo['zptype'][i] in [1,2] and expinfo['zpterm'][i] < 1000
+        for j in range(len(chinfos[i])):
+            zpexp.append(i)
+            zpccd.append(chinfos[i]['ccdnum'][j])
+            zp1 = chinfos[i]['zpterm'][j]
+            zpold.append(zp1 if zp1 < 1000 else 0.0)
+            if calibrated and zp1 < 1000:
+                anchorzp.append(zp1)
+            else:
+                anchorzp.append(np.nan)
+    zpexp = np.array(zpexp)
+    zpccd = np.array(zpccd)
+    zpold = np.array(zpold)
+    anchorzp = np.array(anchorzp)
+    nanchor = np.sum(np.isfinite(anchorzp))
+    logger.info(str(len(zpexp))+' exposure/chip zero-points, '+str(nanchor)+' anchors')
+    if nanchor == 0:
+        logger.info('No calibrated exposures in the region')
+        return expinfo,chinfos
+    if nanchor == len(zpexp):
+        logger.info('All exposures are already calibrated')
+        return expinfo,chinfos
+
+    # Gather the good, bright stars of all exposures
+    ra,dec,mag,err,zpid,expind = [],[],[],[],[],[]
+    for i in range(nexp):
+        cat = cats[i]
+        gd, = np.where((cat['imaflags_iso'] == 0) & ((cat['flags'] & 8)==0) & ((cat['flags'] & 16)==0) &
+                       np.isfinite(cat['magpsf']) & (cat['errpsf'] < 0.05) & np.isfinite(cat['ra']) &
+                       np.isfinite(cat['dec']) & (cat['fwhm'] < 2*expinfo['fwhm'][i]) &
+                       (~((cat['x'] > 1000) & (cat['ccdnum'] == 31))))
+        if len(gd)==0:
+            continue
+        # Map CCDNUM to the zero-point index, unknown chips get -1
+        ind, = np.where(zpexp==i)
+        zpind = np.zeros(np.max(zpccd[ind])+1,int)-1
+        zpind[zpccd[ind]] = ind
+        ccd = np.array(cat['ccdnum'][gd]).astype(int)
+        ok = (ccd >= 0) & (ccd < len(zpind))
+        zpid1 = np.where(ok,zpind[np.clip(ccd,0,len(zpind)-1)],-1)
+        gd = gd[zpid1 > -1]
+        zpid1 = zpid1[zpid1 > -1]
+        ra.append(np.array(cat['ra'][gd]))
+        dec.append(np.array(cat['dec'][gd]))
+        # remove the zero-point that was already applied
+        mag.append(np.array(cat['magpsf'][gd]) - zpold[zpid1])
+        err.append(np.array(cat['errpsf'][gd]))
+        zpid.append(zpid1)
+        expind.append(np.zeros(len(gd),int)+i)
+    if len(ra)==0:
+        logger.info('No good sources')
+        return expinfo,chinfos
+    ra,dec,mag,err = np.concatenate(ra),np.concatenate(dec),np.concatenate(mag),np.concatenate(err)
+    zpid,expind = np.concatenate(zpid),np.concatenate(expind)
+
+    # Cross-match once
+    starid,nstars = zeropoint.crossmatch_exposures(ra,dec,expind,dcr=dcr)
+    logger.info(str(len(ra))+' detections of '+str(nstars)+' stars')
+
+    # Only zero-points connected to an anchor through common stars can
+    #  be solved, the others would get an arbitrary (minimum-norm) value
+    connected = zeropoint.anchoredzp(starid,zpid,anchorzp)
+    use = connected[zpid]
+    logger.info(str(np.sum(connected))+' of '+str(len(connected))+' zero-points are connected to an anchor')
+    if np.sum(use & np.isnan(anchorzp[zpid])) == 0:
+        logger.warning('No uncalibrated exposures are connected to a calibrated one')
+        return expinfo,chinfos
+    zpterm,zptermerr,nzpstars,starmag = zeropoint.ubercal(mag[use],err[use],starid[use],zpid[use],
+                                                          anchorzp,logger=logger)
+    zpterm[~connected] = 999999.
+    zptermerr[~connected] = 999999.
+
+    # Stuff the results into the meta-data tables
+    for i in range(nexp):
+        if np.sum(np.isfinite(anchorzp[zpexp==i])) > 0:
+            continue
+        ind, = np.where(zpexp==i)
+        gd, = np.where(zpterm[ind] < 1000)
+        if len(gd)==0:
+            logger.warning(expinfo['base'][i]+' is not connected to any calibrated exposure.  Leaving it uncalibrated.')
+            continue
+        if len(gd) > 1:
+            expzp,expzperr = dln.wtmean(zpterm[ind[gd]],zptermerr[ind[gd]],error=True)
+        else:
+            expzp,expzperr = zpterm[ind[gd[0]]],0.0
+        expinfo['zpterm'][i] = expzp
+        expinfo['zptermerr'][i] = np.sqrt(expzperr**2+1/np.sum(1/zptermerr[ind[gd]]**2))
+        expinfo['nrefmatch'][i] = np.sum(nzpstars[ind])
+        expinfo['ngoodrefmatch'][i] = np.sum(nzpstars[ind])
+        expinfo['zptype'][i] = 3
+        if len(gd) > 1:
+            expinfo['zpspatialvar_rms'][i] = np.std(zpterm[ind[gd]])
+            expinfo['zpspatialvar_range'][i] = np.max(zpterm[ind[gd]])-np.min(zpterm[ind[gd]])
+            expinfo['zpspatialvar_nccd'][i] = len(gd)
+        # Chips without their own zero-point use the exposure zero-point
+        chzp = zpterm[ind].copy()
+        chzperr = zptermerr[ind].copy()
+        bd = chzp >= 1000
+        chzp[bd] = expinfo['zpterm'][i]
+        chzperr[bd] = expinfo['zptermerr'][i]
+        chinfos[i]['zpterm'] = chzp
+        chinfos[i]['zptermerr'] = chzperr
+        chinfos[i]['nrefmatch'] = nzpstars[ind]
+        logger.info('%s  ZPTERM=%7.4f+/-%7.4f  NCCD=%d' % (expinfo['base'][i],expinfo['zpterm'][i],
+                                                            expinfo['zptermerr'][i],len(gd)))
+
+    return expinfo,chinfos
+
+
 def loadheader(headfile):
     """
-    Load header file
+    Load header file.  headfile can be a filename, an open HDUList
+    or a list of header lines (e.g. read from a tar bundle).
     """
 
     # FITS file
-    if utils.file_isfits(headfile):
-        hdu = fits.open(headfile)
+    if isinstance(headfile,fits.HDUList) or (isinstance(headfile,str) and utils.file_isfits(headfile)):
+        hdu = fits.open(headfile) if isinstance(headfile,str) else headfile
         headdict = {}
         # Loop over the extendions
         for i in range(len(hdu)):
@@ -759,7 +739,10 @@ def loadheader(headfile):
         hdu.close()
     # ASCII file
     else:
-        headlines = dln.readlines(headfile)
+        if isinstance(headfile,str):
+            headlines = dln.readlines(headfile)
+        else:
+            headlines = headfile
         lo = dln.grep(headlines,'^SIMPLE  =',index=True)
         begind = dln.grep(headlines,'^XTENSION',index=True)
         begind = lo+begind
@@ -772,12 +755,12 @@ def loadheader(headfile):
             if i==0:
                 headdict['main'] = head
             else:
-                ccdum = head['CCDNUM']
+                ccdnum = head['CCDNUM']
                 headdict[ccdnum] = head
     return headdict
     
 def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
-              saveref=False,ncpu=1,photmethod=None,logger=None):
+              saveref=False,ncpu=1,photmethod=None,rootdirs=None,logger=None):
     """
     Perform photometry and astrometric calibration of an NSC exposure using
     external catalogs.
@@ -793,12 +776,17 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
     redo : bool, optional
        Perform the calibration again on this exposure.  Default is False.
     selfcal : bool, optional
-       Perform self-calibration instead of using external catalog.
+       Exposures without a reference zero-point are written out
+         uncalibrated (ZPTYPE=0, ZPTERM=0) so they can be
+         self-calibrated for the whole region with selfcalregion().
          Default is False.
     saveref : bool, optional
        Save the reference catalog.  Default is False.
     ncpu : int, optional
        Number of cpus to use.  Default is 1.
+    rootdirs : list, optional
+       The (dldir,mssdir,localdir) root directories.  By default
+         they are obtained for this host with utils.rootdirs().
     logger : logging object
        A logging object used for logging information.
 
@@ -817,7 +805,9 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
     """
     
     # Calibrate catalogs for one exposure
-    dldir,mssdir,localdir = utils.rootdirs()
+    if rootdirs is None:
+        rootdirs = utils.rootdirs()
+    dldir,mssdir,localdir = rootdirs
     
     # Make sure the directory exists 
     if os.path.exists(expdir) == False:
@@ -827,10 +817,19 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
 
     if expdir[-1]=='/':
         expdir = expdir[0:-1]
-    base = os.path.basename(expdir) 
+    # Tarred exposure bundle, members are read into memory and
+    #  the outputs are written to the night directory
+    if tarbundle.istarfile(expdir):
+        bundle = tarbundle.TarBundle(expdir)
+        base = bundle.base
+        outdir = os.path.dirname(os.path.abspath(expdir))
+    else:
+        bundle = None
+        base = os.path.basename(expdir)
+        outdir = expdir
     if logger is None:
         logger = dln.basiclogger()
-    outfile = expdir+'/'+base+'_meta.fits' 
+    outfile = outdir+'/'+base+'_meta.fits' 
     # get version number 
     lo = expdir.find('nsc/instcal/') 
     dum = expdir[lo+12:] 
@@ -870,20 +869,33 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
     logger.info('')
     logger.info('Step 1. Read in the catalogs')
     logger.info('-----------------------------')
-    # tar file
-    if expdir.endswith('.tar.gz'):
-        measfile = None
+    # tar file, read the members straight from the archive
+    if bundle is not None:
         logger.info('tar file')
-        exposure = os.path.basename(expdir).replace('.tar.gz','')
-        result = subprocess.run(['tar','tvf',expdir],capture_output=True)
-        res = result.stdout
-        if type(res) is bytes: res = res.decode()
-        res = res.split('\n')
-        tarfiles = [d.split()[-1] for d in res if d!='']
-        fitsfiles = [f for f in tarfiles if f.find('.fits')>-1]
-        nchips = len(fitsfiles)
-        logfile = exposure+'.log'
-        logfiletest = logfile in ' '.join(tarfiles)
+        catfiles = []
+        measmember = bundle.find('_meas.fits')
+        if measmember is not None:
+            measfile = expdir
+            mhdu = bundle.fitsopen(measmember)
+        else:
+            # Assemble the chip catalogs into an in-memory
+            #  multi-extension file like concatenate() makes
+            chipmembers = bundle.chipnames()
+            if len(chipmembers) == 0:
+                raise ValueError('No catalog files found')
+            measfile = expdir
+            mhdu = fits.HDUList()
+            mhdu.append(fits.PrimaryHDU())
+            for name,data in bundle.readmany(chipmembers).items():
+                hdu1 = fits.open(io.BytesIO(data))
+                ccdnum = int(os.path.basename(name)[:-5].split('_')[-1])
+                newhdu = fits.BinTableHDU(hdu1[1].data,header=hdu1[1].header)
+                newhdu.header['extname'] = str(ccdnum)
+                newhdu.header['ccdnum'] = ccdnum
+                mhdu.append(newhdu)
+        nchips = len(mhdu)-1
+        logfile = bundle.find('.log')
+        logfiletest = logfile is not None
     # multi-extension meas.fits file
     elif os.path.exists(expdir+'/'+base+'_meas.fits'):
         measfile = expdir+'/'+base+'_meas.fits'
@@ -932,14 +944,25 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
 
     # v4+ use separate header file
     if version >= 'v4':
-        if measfile is not None:
+        if bundle is not None:
+            headfile = bundle.find('_header.fits')
+            if headfile is None:
+                headfile = bundle.find('.hdr')
+            if headfile is None:
+                headfile = os.path.join(dldir,'dnidever','nsc','instcal',version,
+                                        'header',instrument,night,base+'.hdr')
+            elif headfile.endswith('.fits'):
+                headfile = bundle.fitsopen(headfile)
+            else:
+                headfile = bundle.readlines(headfile)
+        elif measfile is not None:
             headfile = os.path.join(expdir,base+'_header.fits')            
         else:
             headfile = os.path.join(expdir,base+'.hdr')
             if os.path.exists(headfile)==False:
                 headfile = os.path.join(dldir,'dnidever','nsc','instcal',version,
                                     'header',instrument,night,base+'.hdr')
-        if os.path.exists(headfile)==False:
+        if isinstance(headfile,str) and os.path.exists(headfile)==False:
             raise ValueError(headfile+' not found')
         headdict = loadheader(headfile)
     else:
@@ -1148,7 +1171,11 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
     logger.info('FWHM = %.2f arcsec' % medfwhm)
          
     # Load the logfile and get absolute flux filename
-    loglines = dln.readlines(expdir+'/'+base+'.log')
+    if bundle is not None:
+        loglines = bundle.readlines(logfile)
+        bundle.close()
+    else:
+        loglines = dln.readlines(expdir+'/'+base+'.log')
     #ind = dln.grep(loglines,'Step #2: Copying InstCal images from mass store archive',index=True)
     ind = dln.grep(loglines,'Copying InstCal images',index=True)
     fline = loglines[ind[0]+1] 
@@ -1281,7 +1308,7 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
                               (inpref['dec'] >= np.min(meas[deccol])-0.01) & 
                               (inpref['dec'] <= np.max(meas[deccol])+0.01))
         ref = inpref[gdref] 
-        logger.info(str(ngdref)+' reference stars in our region')
+        logger.info(str(len(gdref))+' reference stars in our region')
 
     # Step 3. Astrometric calibration 
     #---------------------------------- 
@@ -1308,6 +1335,9 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
     allgaiadist[gdmeas[ind2]] = coords.sphdist(gaia['ra'][ind1],gaia['dec'][ind1],
                                               meas[racol][gdmeas[ind2]],meas[deccol][gdmeas[ind2]])*3600 
     # CCD loop 
+    #  gather the Gaia offsets for every chip, then solve all the
+    #  chip-level linear fits at once below
+    astfit = []
     for i in range(nchips): 
         if chinfo['nsources'][i]==0: 
             continue
@@ -1320,7 +1350,7 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
         gaiadist1 = allgaiadist[chind2] 
         gmatch, = np.where((gaiaind1 > -1) & (gaiadist1 <= 0.5))   # get sources with Gaia matches 
         if len(gmatch) == 0: 
-            gmatch, = np.where(gaiaind1 > -1 and gaiadist1 <= 1.0) 
+            gmatch, = np.where((gaiaind1 > -1) & (gaiadist1 <= 1.0))
         if len(gmatch) < 5: 
             logger.info('Not enough Gaia matches')
             # Add threshold to astrometric errors 
@@ -1373,26 +1403,62 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
         # Rotate to coordinates relative to the center of the field 
         gaialon,gaialat = coords.rotsphcen(gra_epoch,gdec_epoch,chinfo['cenra'][i],chinfo['cendec'][i],gnomic=True)
         lon1,lat1 = coords.rotsphcen(meas2[racol],meas2[deccol],chinfo['cenra'][i],chinfo['cendec'][i],gnomic=True)
-        # ---- Fit RA as function of RA/DEC ---- 
+        # ---- RA as function of RA/DEC ---- 
         londiff = gaialon-lon1 
-        err = None
+        raerr = None
         if 'ra_error' in gaia2.colnames:
-            err = np.sqrt(gaia2['ra_error']**2 + meas2['raerr']**2) 
+            raerr = np.sqrt(gaia2['ra_error']**2 + meas2['raerr']**2) 
         if 'ra_error' not in gaia2.colnames and 'e_ra_icrs' in gaia2.colnames:
-            err = np.sqrt(gaia2['e_ra_icrs']**2 + meas2['raerr']**2) 
-        if err is None:
-            err = meas2['raerr']
+            raerr = np.sqrt(gaia2['e_ra_icrs']**2 + meas2['raerr']**2) 
+        if raerr is None:
+            raerr = meas2['raerr']
         lonmed = np.median(londiff) 
         lonsig = np.maximum(dln.mad(londiff), 1e-5)  # 0.036" 
-        gdlon, = np.where(np.abs(londiff-lonmed) < 3.0*lonsig)# remove outliers 
-        if len(gdlon) > 5:   # use constant if not enough stars 
-            npars = 4 
-        else: 
-            npars = 1 
-        initpars = np.zeros(npars,float) 
-        initpars[0] = np.median([londiff]) 
-        racoef,racov = curve_fit(utils.func_poly2d_wrap,[lon1[gdlon],lat1[gdlon]],
-                                 londiff[gdlon],sigma=err[gdlon],p0=initpars)
+        gdlon = np.abs(londiff-lonmed) < 3.0*lonsig   # remove outliers 
+        # ---- DEC as function of RA/DEC ----- 
+        latdiff = gaialat-lat1 
+        decerr = None
+        if 'dec_error' in gaia2.colnames: 
+            decerr = np.sqrt(gaia2['dec_error']**2 + meas2['decerr']**2) 
+        if 'dec_error' not in gaia2.colnames and 'e_dec_icrs' in gaia2.colnames:
+            decerr = np.sqrt(gaia2['e_de_icrs']**2 + meas2['decerr']**2) 
+        if decerr is None: 
+            decerr = meas2['decerr']
+        latmed = np.median(latdiff) 
+        latsig = np.maximum(dln.mad(latdiff), 1e-5)   # 0.036" 
+        gdlat = np.abs(latdiff-latmed) < 3.0*latsig   # remove outliers 
+        astfit.append({'i':i,'chind2':chind2,'nchmatch':nchmatch,'ngmatch':len(gmatch),'nqcuts':len(qcuts1),
+                       'meas2':meas2,'lon1':lon1,'lat1':lat1,'londiff':londiff,'latdiff':latdiff,
+                       'raerr':np.asarray(raerr),'decerr':np.asarray(decerr),'gdlon':gdlon,'gdlat':gdlat})
+
+    # Linear least-squares fits for all chips at once 
+    #  use constant if not enough stars 
+    nfit = len(astfit)
+    if nfit > 0:
+        lon1list = [a['lon1'] for a in astfit]
+        lat1list = [a['lat1'] for a in astfit]
+        racoefs,racovs,ramasks = utils.fit_poly2d_batch(lon1list,lat1list,[a['londiff'] for a in astfit],
+                                                        [a['raerr'] for a in astfit],
+                                                        [4 if np.sum(a['gdlon'])>5 else 1 for a in astfit],
+                                                        masklist=[a['gdlon'] for a in astfit],niter=2)
+        deccoefs,deccovs,decmasks = utils.fit_poly2d_batch(lon1list,lat1list,[a['latdiff'] for a in astfit],
+                                                           [a['decerr'] for a in astfit],
+                                                           [4 if np.sum(a['gdlat'])>5 else 1 for a in astfit],
+                                                           masklist=[a['gdlat'] for a in astfit],niter=2)
+
+    # Apply the chip solutions 
+    for k in range(nfit):
+        i = astfit[k]['i']
+        chind2 = astfit[k]['chind2']
+        meas1 = meas[chind2]
+        meas2 = astfit[k]['meas2']
+        lon1,lat1 = astfit[k]['lon1'],astfit[k]['lat1']
+        londiff,latdiff = astfit[k]['londiff'],astfit[k]['latdiff']
+        racoef = racoefs[k]
+        deccoef = deccoefs[k]
+        gdlon, = np.where(ramasks[k])
+        gdlat, = np.where(decmasks[k])
+        # ---- RA residuals ---- 
         yfitall = utils.func_poly2d(lon1,lat1,*racoef)
         rarms1 = dln.mad((londiff[gdlon]-yfitall[gdlon])*3600.) 
         rastderr = rarms1/np.sqrt(len(gdlon))
@@ -1406,26 +1472,7 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
             rastderr = rarms/np.sqrt(len(gdstars))
         else:
             rarms = rarms1 
-        # ---- Fit DEC as function of RA/DEC ----- 
-        latdiff = gaialat-lat1 
-        err = None
-        if 'dec_error' in gaia2.colnames: 
-            err = np.sqrt(gaia2['dec_error']**2 + meas2['decerr']**2) 
-        if 'dec_error' not in gaia2.colnames and 'e_dec_icrs' in gaia2.colnames:
-            err = np.sqrt(gaia2['e_de_icrs']**2 + meas2['decerr']**2) 
-        if err is None: 
-            err = meas2['decerr']
-        latmed = np.median(latdiff) 
-        latsig = np.maximum(dln.mad(latdiff), 1e-5)   # 0.036" 
-        gdlat, = np.where(np.abs(latdiff-latmed) < 3.0*latsig)  # remove outliers 
-        if len(gdlat) > 5:     # use constant if not enough stars 
-            npars = 4 
-        else: 
-            npars = 1 
-        initpars = np.zeros(npars,float) 
-        initpars[0] = np.median(latdiff) 
-        deccoef,deccov = curve_fit(utils.func_poly2d_wrap,[lon1[gdlat],lat1[gdlat]],
-                                   latdiff[gdlat],sigma=err[gdlat],p0=initpars)
+        # ---- DEC residuals ----- 
         yfitall = utils.func_poly2d(lon1,lat1,*deccoef)
         decrms1 = dln.mad((latdiff[gdlat]-yfitall[gdlat])*3600.) 
         decstderr = decrms1/np.sqrt(len(gdlat))
@@ -1437,7 +1484,8 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
         else:
             decrms = decrms1 
         logger.info('  CCDNUM=%3d  NSOURCES=%5d  %5d/%5d GAIA matches  RMS(RA/DEC)=%7.4f/%7.4f STDERR(RA/DEC)=%7.4f/%7.4f arcsec' % 
-                    (chinfo['ccdnum'][i],nchmatch,len(gmatch),len(qcuts1),rarms,decrms,rastderr,decstderr))
+                    (chinfo['ccdnum'][i],astfit[k]['nchmatch'],astfit[k]['ngmatch'],astfit[k]['nqcuts'],
+                     rarms,decrms,rastderr,decstderr))
         # Apply to all sources 
         lon,lat = coords.rotsphcen(meas1['alpha_j2000'],meas1['delta_j2000'],
                                    chinfo['cenra'][i],chinfo['cendec'][i],gnomic=True)
@@ -1460,8 +1508,8 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
         meas1['decerr'] = np.sqrt(meas1['decerr']**2 + decrms**2) 
         # Stuff back into the main structure 
         meas[chind2] = meas1 
-        chinfo['ngaiamatch'][i] = len(gmatch)
-        chinfo['ngoodgaiamatch'][i] = len(qcuts1) 
+        chinfo['ngaiamatch'][i] = astfit[k]['ngmatch']
+        chinfo['ngoodgaiamatch'][i] = astfit[k]['nqcuts']
         chinfo['rarms'][i] = rarms 
         chinfo['rastderr'][i] = rastderr 
         chinfo['racoef'][i] = racoef 
@@ -1470,9 +1518,7 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
         chinfo['deccoef'][i] = deccoef 
     
     # Get reddening
-    coo = SkyCoord(ra=meas['ra'],dec=meas['dec'],unit='deg')
-    sfd = SFDQuery()
-    ebv = sfd(coo)                
+    ebv = extinction.getebv(meas['ra'],meas['dec'])
     meas['ebv'] = ebv 
                  
     # Put in exposure-level information 
@@ -1498,23 +1544,36 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
     logger.info(str(nmatch)+' matches to reference catalog')
     if nmatch == 0: 
         logger.info('No matches to reference catalog')
-        return
-    ref1 = ref[ind1]
-    meas1 = meas[gdmeas[ind2]]
-    # Use Gaia XP synthetic photometry
-    # Get the model magnitudes 
-    mmags = modelmag.modelmag(ref1,instfilt,cendec,eqnfile) 
-    if len(mmags) == 1 and mmags[0] < -1000: 
-        print('No good model mags')
-        return
-    
-    # Get the zero-points
-    mmexpinfo,mmchinfo = getzpterm(meas1,ref1,mmags,expinfo.copy(),chinfo.copy(),kind='modelmag')
-    gexpinfo,gchinfo = getzpterm(meas1,ref1,mmags,expinfo.copy(),chinfo.copy(),kind='gaiaxpsynth')    
-
-    print('Using Gaia for everything now')
-    expinfo = gexpinfo.copy()
-    chinfo = gchinfo.copy()
+        if selfcal==False:
+            return
+    else:
+        ref1 = ref[ind1]
+        meas1 = meas[gdmeas[ind2]]
+        # Use Gaia XP synthetic photometry
+        # Get the model magnitudes 
+        mmags = modelmag.modelmag(ref1,instfilt,cendec,eqnfile) 
+        if len(mmags) == 1 and mmags[0] < -1000: 
+            print('No good model mags')
+            if selfcal==False:
+                return
+        else:
+            # Get the zero-points
+            mmexpinfo,mmchinfo = getzpterm(meas1,ref1,mmags,expinfo.copy(),chinfo.copy(),kind='modelmag')
+            gexpinfo,gchinfo = getzpterm(meas1,ref1,mmags,expinfo.copy(),chinfo.copy(),kind='gaiaxpsynth')    
+
+            print('Using Gaia for everything now')
+            expinfo = gexpinfo.copy()
+            chinfo = gchinfo.copy()
+
+    # No reference zero-point, leave the magnitudes uncalibrated (ZPTERM=0)
+    #  and let the region-level self-calibration (selfcalregion) solve for it
+    if selfcal and expinfo['zptype'][0] == 0:
+        logger.info('No reference zero-point.  Leaving it for the region self-calibration.')
+        expinfo['zpterm'] = 0.0
+        expinfo['zptermerr'] = 0.0
+        expinfo['zptermsig'] = 0.0
+        chinfo['zpterm'] = 0.0
+        chinfo['zptermerr'] = 0.0
     
     # Apply the zero-point to the full catalogs 
     # USE CHIP-LEVEL ZERO-POINTS WHEN POSSIBLE!!! 
@@ -1536,8 +1595,8 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
             #  chinfo[i].zptype = 2 
             #endelse 
             # Always use exposure-level zero-points,  they are good enough 
-            chinfo['zpterm'][i] = expinfo['zpterm']
-            chinfo['zptermerr'][i] = expinfo['zptermerr']
+            chinfo['zpterm'][i] = expinfo['zpterm'][0]
+            chinfo['zptermerr'][i] = expinfo['zptermerr'][0]
             #chinfo['zptype'][i] = 2 
                      
             #gdmeasmag, = np.where(meas1['magpsf'] < 50) 
@@ -1549,10 +1608,10 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
             #meas[lo[i]:hi[i]] = meas1  # stuff back in 
              
     # Print out the results 
-    logger.info('NPHOTREFMATCH=%d' % expinfo['nrefmatch'])
-    logger.info('EXPOSURE ZPTERM=%.4f +/- %.4f  SIG=%.4f mag' % (expinfo['zpterm'],expinfo['zptermerr'],expinfo['zptermsig']))
+    logger.info('NPHOTREFMATCH=%d' % expinfo['nrefmatch'][0])
+    logger.info('EXPOSURE ZPTERM=%.4f +/- %.4f  SIG=%.4f mag' % (expinfo['zpterm'][0],expinfo['zptermerr'][0],expinfo['zptermsig'][0]))
     logger.info('ZPSPATIALVAR:  RMS=%.4f RANGE=%.4f NCCD=%d' % 
-                (expinfo['zpspatialvar_rms'],expinfo['zpspatialvar_range'],expinfo['zpspatialvar_nccd']))
+                (expinfo['zpspatialvar_rms'][0],expinfo['zpspatialvar_range'][0],expinfo['zpspatialvar_nccd'][0]))
 
              
     # Measure the depth 
@@ -1756,20 +1815,20 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
 
             # Append to the output HDUList
             hdu1 = fits.table_to_hdu(final)
-            hdu1.header['EXTNAME'] = ccdnum
+            hdu1.header['EXTNAME'] = str(chinfo['ccdnum'][i])
             hdu.append(hdu1)
             mhdu1 = fits.table_to_hdu(chinfo[i:i+1])
-            mhdu1.header['EXTNAME'] = ccdnum
+            mhdu1.header['EXTNAME'] = str(chinfo['ccdnum'][i])
             mhdu.append(mhdu1)                    # add metadata for this chip
 
     # Write to file 
-    outfile = expdir+'/'+base+'_meas2.fits'
+    outfile = outdir+'/'+base+'_meas2.fits'
     logger.info('Writing table to '+outfile)    
     hdu.writeto(outfile,overwrite=True)
     hdu.close()
                      
     # Meta-data file 
-    metafile = expdir+'/'+base+'_meta2.fits' 
+    metafile = outdir+'/'+base+'_meta2.fits' 
     logger.info('Writing metadata to '+metafile)
     mhdu.writeto(metafile,overwrite=True)
     mhdu.close()
@@ -1777,7 +1836,100 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
     dt = time.time()-t00 
     logger.info('dt = %.2f sec.' % dt)
 
-def calibrate_healpix(pix,version,nside=64,redo=False):
+# Reference catalog shared by the calibrate_healpix() worker processes
+_sharedref = None
+
+def _calibrate_worker_init(reffile,maskfile=None):
+    """ Memory-map the shared reference catalog (and its mask) in each worker process."""
+    global _sharedref
+    data = np.load(reffile,mmap_mode='r')
+    if maskfile is not None:
+        data = np.ma.MaskedArray(data,mask=np.load(maskfile,mmap_mode='r'))
+    _sharedref = Table(data,copy=False)
+
+def _calibrate_one(expdir,ref,redo=False,selfcal=False):
+    """ Calibrate one exposure and return (expdir,success,error,dt)."""
+    t0 = time.time()
+    try:
+        calibrate(expdir,ref,redo=redo,selfcal=selfcal)
+        return expdir,True,'',time.time()-t0
+    except:
+        return expdir,False,traceback.format_exc(),time.time()-t0
+
+def _calibrate_worker(pars):
+    """ Calibrate one exposure with the shared reference catalog."""
+    expdir,redo,selfcal = pars
+    return _calibrate_one(expdir,_sharedref,redo=redo,selfcal=selfcal)
+
+def _selfcal_healpix(expdirs,logger=None):
+    """
+    Self-calibrate the exposures of a region that have no reference
+    zero-point with selfcalregion() and update their _meas2/_meta2 files.
+    """
+    if logger is None:
+        logger = dln.basiclogger()
+    # Load the calibrated catalogs and meta-data
+    files,cats,expinfo,chinfos = [],[],[],[]
+    for expdir in expdirs:
+        expdir = expdir.rstrip('/')
+        if tarbundle.istarfile(expdir):
+            base = tarbundle.tarbase(expdir)
+            outdir = os.path.dirname(os.path.abspath(expdir))
+        else:
+            base = os.path.basename(expdir)
+            outdir = expdir
+        measfile = outdir+'/'+base+'_meas2.fits'
+        metafile = outdir+'/'+base+'_meta2.fits'
+        if os.path.exists(measfile)==False or os.path.exists(metafile)==False:
+            continue
+        with fits.open(metafile) as mhdu:
+            expinfo.append(Table(mhdu[1].data))
+            chinfo = vstack([Table(mhdu[i].data) for i in range(2,len(mhdu))])
+        # the chip catalogs are in the same order as the chip meta-data
+        cat = []
+        with fits.open(measfile) as hdu:
+            for i in range(1,len(hdu)):
+                cat1 = Table(hdu[i].data)
+                cat1['ccdnum'] = np.zeros(len(cat1),int)+chinfo['ccdnum'][i-1]
+                cat.append(cat1)
+        chinfos.append(chinfo)
+        cats.append(vstack(cat))
+        files.append((measfile,metafile))
+    if len(files)==0:
+        logger.info('No calibrated exposures to self-calibrate')
+        return
+    expinfo = vstack(expinfo)
+    zptype0 = np.array(expinfo['zptype']).copy()
+    expzp0 = np.where(expinfo['zpterm']<1000,expinfo['zpterm'],0.0)
+    chzp0 = [np.array(c['zpterm']).copy() for c in chinfos]
+    expinfo,chinfos = selfcalregion(cats,expinfo,chinfos,logger=logger)
+
+    # Apply the new zero-points to the self-calibrated exposures
+    for i in range(len(files)):
+        if zptype0[i] in [1,2] or expinfo['zptype'][i] != 3:
+            continue
+        measfile,metafile = files[i]
+        logger.info('Updating '+measfile)
+        dzp = np.array(chinfos[i]['zpterm'])-np.where(chzp0[i]<1000,chzp0[i],0.0)
+        dexpzp = expinfo['zpterm'][i]-expzp0[i]
+        with fits.open(measfile) as hdu:
+            for j in range(1,len(hdu)):
+                for c in ['mag_auto','mag_aper1','mag_aper2','mag_aper4','mag_aper6','mag_aper8','magpsf']:
+                    hdu[j].data[c] += dzp[j-1]
+            hdu.writeto(measfile,overwrite=True)
+        chinfos[i]['depth95'] += dexpzp
+        chinfos[i]['depth10sig'] += dexpzp
+        expinfo1 = expinfo[i:i+1]
+        expinfo1['depth95'] += dexpzp
+        expinfo1['depth10sig'] += dexpzp
+        mhdu = fits.HDUList()
+        mhdu.append(fits.table_to_hdu(expinfo1))
+        for j in range(len(chinfos[i])):
+            mhdu.append(fits.table_to_hdu(chinfos[i][j:j+1]))
+        mhdu.writeto(metafile,overwrite=True)
+        mhdu.close()
+
+def calibrate_healpix(pix,version,nside=64,redo=False,ncpu=1,selfcal=False):
     """
     This program is a wrapper around NSC_INSTCAL_CALIBRATE
     for all exposures in the same region of the sky.
@@ -1789,21 +1941,28 @@ def calibrate_healpix(pix,version,nside=64,redo=False):
     version   The version name, e.g. 'v3'. 
     =nside    The HEALPix nside to use.  Default is 64.
     /redo     Rerun on exposures that were previously processed.
+    =ncpu     Number of exposures to calibrate concurrently.  The
+                reference catalog is shared with the worker processes
+                through a memory-mapped file.  Default is 1.
+    /selfcal  Self-calibrate the exposures without a reference
+                zero-point all at once with selfcalregion().
 
     Returns
     -------
+    report    Table with the status, error message and run time
+                for each exposure.
 
     Example
     -------
 
-    calibrate_healpix(1045,'v3')
+    report = calibrate_healpix(1045,'v3',ncpu=8)
 
     By D. Nidever 2017
     Translated to Python by D. Nidever, May 2022
     """
 
     # Main NOAO DECam source catalog
-    lsdir,mssdir,localdir = utils.rootdirs()
+    dldir,mssdir,localdir = utils.rootdirs()
     fdir = dldir+'users/dnidever/nsc/instcal/'+version+'/'
     tmpdir = localdir+'dnidever/nsc/instcal/'+version+'/tmp/'
     if os.path.exists(fdir)==False:
@@ -1828,7 +1987,7 @@ def calibrate_healpix(pix,version,nside=64,redo=False):
         print('No exposures')
         return
     print('NEXPOSURES = '+str(nind))
-    hplist1 = hplist[ind]
+    hplist1 = hplist[ind1]
     hplist1['expdir'] = np.char.array(hplist1['expdir']).strip()
     hplist1['instrument ']= np.char.array(hplist1['instrument']).strip()
     hplist1['filter'] = np.char.array(hplist1['filter']).strip()
@@ -1866,21 +2025,72 @@ def calibrate_healpix(pix,version,nside=64,redo=False):
 
     # Get all of the reference data that we need
     print('')
-    ref = getrefdata(filters,cenra,cendec,radius)
+    ref = query.getrefdata(filters,cenra,cendec,radius)
 
-    # Loop over the exposures
+    expdirs = []
     for i in range(nind):
-        print('')
-        print('---- EXPOSURE '+str(i+1)+' OF '+str(nind)+' ----')
-        print('')
         expdir = hplist1['expdir'][i]
         lo = expdir.find('/d1')
-        expdir = dldir + expdir[lo+5:]
-        calibrate(expdir,ref,redo=redo)
+        expdirs.append(dldir + expdir[lo+5:])
+
+    # Per-exposure report
+    report = Table(np.zeros(nind,dtype=np.dtype([('expdir',(str,300)),('success',bool),
+                                                ('dt',float),('error',(str,2000))])))
+    
+    # Loop over the exposures
+    if ncpu <= 1:
+        for i in range(nind):
+            print('')
+            print('---- EXPOSURE '+str(i+1)+' OF '+str(nind)+' ----')
+            print('')
+            out = _calibrate_one(expdirs[i],ref,redo=redo,selfcal=selfcal)
+            report[i] = out[0],out[1],out[3],out[2][-2000:]
+            if out[1]==False:
+                print(out[2])
+    # Calibrate the exposures concurrently
+    #  the workers memory-map the reference catalog instead of
+    #  getting a pickled copy of the table
+    else:
+        reffile = tmpdir+'calibrate_healpix'+str(nside)+'_'+str(pix)+'_ref.npy'
+        refarr = ref.as_array()
+        # save the mask as well so the workers get the same masked table
+        maskfile = None
+        if isinstance(refarr,np.ma.MaskedArray):
+            maskfile = reffile[:-4]+'_mask.npy'
+            np.save(maskfile,np.ma.getmaskarray(refarr))
+            refarr = refarr.data
+        np.save(reffile,refarr)
+        del refarr
+        print('Calibrating '+str(nind)+' exposures with '+str(ncpu)+' processes')
+        ctx = multiprocessing.get_context('spawn')
+        try:
+            with ctx.Pool(int(np.minimum(ncpu,nind)),initializer=_calibrate_worker_init,initargs=(reffile,maskfile)) as pool:
+                for i,out in enumerate(pool.imap(_calibrate_worker,[(e,redo,selfcal) for e in expdirs])):
+                    report[i] = out[0],out[1],out[3],out[2][-2000:]
+                    print('%d/%d %s  success=%s  dt=%.1f sec' % (i+1,nind,out[0],out[1],out[3]))
+        finally:
+            for f in [reffile,maskfile]:
+                if f is not None and os.path.exists(f): os.remove(f)
+
+    # Self-calibrate the exposures without a reference zero-point
+    #  all at once, anchored to the calibrated ones
+    if selfcal:
+        print('')
+        _selfcal_healpix(list(report['expdir'][report['success']]))
+
+    # Failure report
+    bd, = np.where(report['success']==False)
+    print('')
+    print(str(nind-len(bd))+' of '+str(nind)+' exposures calibrated successfully')
+    for i in bd:
+        print('FAILED: '+report['expdir'][i])
+        print(report['error'][i])
 
     print('')
     print('Total time = %.2f sec' % (time.time()-t00))
 
+    return report
+
 
  
                 
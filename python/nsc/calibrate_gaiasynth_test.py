@@ -11,54 +11,14 @@ from astropy.wcs import WCS
 from astropy.coordinates import SkyCoord
 from astropy.time import Time
 from dlnpyutils import utils as dln,coords
-from dustmaps.sfd import SFDQuery
 from scipy.optimize import curve_fit
 from scipy import stats
 import subprocess
-from . import utils,query,modelmag
+from . import utils,query,modelmag,extinction,zeropoint
 
-def fitzpterm(mstr,expinfo,chinfo):
-    # Fit the global and ccd zero-points 
-     
-    n = len(mstr['col']) 
-    diff = mstr['model'] - mstr['mag']
-    err = mstr['err']
-    # Make a sigma cut 
-    med = np.median(diff) 
-    sig = dln.mad(diff) 
-    gd, = np.where(np.abs(diff-med) < 3*sig) 
-    x = np.zeros(n,float)
-    zpterm,zptermerr1 = dln.wtmean(diff[gd],err[gd],error=True)
-    zptermerr = dln.bootstrap(diff[gd],dln.wtmean,args=err[gd],indexargs=True)
-    # Save in exposure table
-    expinfo['zpterm'] = zpterm 
-    expinfo['zptermerr'] = zptermerr 
-    expinfo['zptermsig'] = sig 
-    expinfo['nrefmatch'] = n 
-    expinfo['ngoodrefmatch'] = len(gd)
-     
-    # Measure chip-level zpterm and variations 
-    nchips = len(chinfo) 
-    for i in range(nchips): 
-        ind1,ind2 = dln.match(chinfo['ccdnum'][i],mstr['ccdnum'])
-        nmatch = len(ind1)
-        if nmatch >= 5: 
-            gd1, = np.where(np.abs(diff[ind2]-med) < 3*sig) 
-            if len(gd1) >= 5: 
-                zpterm1, _ = dln.wtmean(diff[ind2[gd1]],err[ind2[gd1]],error=True)
-                zptermerr1 = dln.bootstrap(diff[ind2[gd1]],dln.wtmean,args=err[ind2[gd1]],indexargs=True)
-                chinfo['zpterm'][i] = zpterm1 
-                chinfo['zptermerr'][i] = zptermerr1 
-                chinfo['nrefmatch'][i] = nmatch 
-     
-    # Measure spatial variations 
-    gdchip, = np.where(chinfo['zpterm'] < 1000) 
-    if len(gdchip) > 1: 
-        expinfo['zpspatialvar_rms'] = np.std(chinfo['zpterm'][gdchip]) 
-        expinfo['zpspatialvar_range'] = np.max(chinfo['zpterm'][gdchip])-np.min(chinfo['zpterm'][gdchip]) 
-        expinfo['zpspatialvar_nccd'] = len(gdchip)
-
-    return expinfo,chinfo
+def fitzpterm(mstr,expinfo,chinfo,errmethod='bootstrap'):
+    """ Fit the global and ccd zero-points, see zeropoint.fitzpterm()."""
+    return zeropoint.fitzpterm(mstr,expinfo,chinfo,errmethod=errmethod)
 
 def loadheader(headfile):
     """
@@ -761,9 +721,7 @@ def calibrate(expdir,inpref=None,eqnfile=None,redo=False,selfcal=False,
     # don't have daophot coordinates for all the sources, why?
         
     # Get reddening
-    coo = SkyCoord(ra=cat['ra'],dec=cat['dec'],unit='deg')
-    sfd = SFDQuery()
-    ebv = sfd(coo)                
+    ebv = extinction.getebv(cat['ra'],cat['dec'])
     #glactc,cat['ra'],cat['dec'],2000.0,glon,glat,1,/deg 
     #ebv = dust_getval(glon,glat,/noloop,/interp)
     cat['ebv'] = ebv 
@@ -7,7 +7,6 @@ from astropy.wcs import WCS
 from astropy.coordinates import SkyCoord
 from astropy.time import Time
 from dlnpyutils import utils as dln,coords
-from dustmaps.sfd import SFDQuery
 from glob import glob
 import healpy as hp
 import numpy as np
@@ -20,7 +19,7 @@ import subprocess
 import sys
 import time
 
-from nsc import utils,query,modelmag
+from nsc import utils,query,modelmag,extinction,zeropoint
 #from utils_tempest import *
 import warnings
 warnings.resetwarnings()
@@ -29,48 +28,9 @@ warnings.filterwarnings('ignore',category=UserWarning,append=True)
 from slurm_funcs import *
 
 
-def fitzpterm(mstr,expinfo,chinfo):
-    # Fit the global and ccd zero-points 
-     
-    n = len(mstr['col']) 
-    diff = mstr['model'] - mstr['mag']
-    err = mstr['err']
-    # Make a sigma cut 
-    med = np.median(diff) 
-    sig = dln.mad(diff) 
-    gd, = np.where(np.abs(diff-med) < 3*sig) 
-    x = np.zeros(n,float)
-    zpterm,zptermerr1 = dln.wtmean(diff[gd],err[gd],error=True)
-    zptermerr = dln.bootstrap(diff[gd],dln.wtmean,args=err[gd],indexargs=True)
-    # Save in exposure table
-    expinfo['zpterm'] = zpterm 
-    expinfo['zptermerr'] = zptermerr 
-    expinfo['zptermsig'] = sig 
-    expinfo['nrefmatch'] = n 
-    expinfo['ngoodrefmatch'] = len(gd)
-     
-    # Measure chip-level zpterm and variations 
-    nchips = len(chinfo) 
-    for i in range(nchips): 
-        ind1,ind2 = dln.match(chinfo['ccdnum'][i],mstr['ccdnum'])
-        nmatch = len(ind1)
-        if nmatch >= 5: 
-            gd1, = np.where(np.abs(diff[ind2]-med) < 3*sig) 
-            if len(gd1) >= 5: 
-                zpterm1, _ = dln.wtmean(diff[ind2[gd1]],err[ind2[gd1]],error=True)
-                zptermerr1 = dln.bootstrap(diff[ind2[gd1]],dln.wtmean,args=err[ind2[gd1]],indexargs=True)
-                chinfo['zpterm'][i] = zpterm1 
-                chinfo['zptermerr'][i] = zptermerr1 
-                chinfo['nrefmatch'][i] = nmatch 
-     
-    # Measure spatial variations 
-    gdchip, = np.where(chinfo['zpterm'] < 1000) 
-    if len(gdchip) > 1: 
-        expinfo['zpspatialvar_rms'] = np.std(chinfo['zpterm'][gdchip]) 
-        expinfo['zpspatialvar_range'] = np.max(chinfo['zpterm'][gdchip])-np.min(chinfo['zpterm'][gdchip]) 
-        expinfo['zpspatialvar_nccd'] = len(gdchip)
-
-    return expinfo,chinfo
+def fitzpterm(mstr,expinfo,chinfo,errmethod='bootstrap'):
+    """ Fit the global and ccd zero-points, see zeropoint.fitzpterm()."""
+    return zeropoint.fitzpterm(mstr,expinfo,chinfo,errmethod=errmethod)
 
 
 def selfcalzpterm(expdir,cat,expinfo,chinfo,logger=None,silent=False):
@@ -305,47 +265,7 @@ def selfcalzpterm(expdir,cat,expinfo,chinfo,logger=None,silent=False):
      
     # MEASURE THE ZERO-POINT 
     #----------------------- 
-    # Same as from fitzpterm()
-     
-    # Fit the global and ccd zero-points 
-    n = len(mstr['col']) 
-    diff = mstr['model'] - mstr['mag']
-    err = mstr['err']
-    # Make a sigma cut 
-    med = np.median(diff) 
-    sig = dln.mad(diff) 
-    gd, = np.where(np.abs(diff-med) < 3*sig) 
-    ngd = len(gd)
-    x = np.zeros(n,float)
-    zpterm, _ = dln.wtmean(diff[gd],err[gd],error=True)
-    zptermerr = dln.bootstrap(diff[gd],dln.wtmean,args=err[gd],indexargs=True)
-    # Save in exposure structure 
-    expinfo['zpterm'] = zpterm 
-    expinfo['zptermerr'] = zptermerr 
-    expinfo['zptermsig'] = sig 
-    expinfo['nrefmatch'] = n 
-    expinfo['ngoodrefmatch'] = ngd 
-     
-    # Measure chip-level zpterm and variations 
-    nchips = len(chinfo) 
-    for i in range(nchips): 
-        ind1,ind2 = dln.match(chinfo['ccdnum'][i],mstr['ccdnum'])
-        nmatch = len(ind1)
-        if nmatch >= 5: 
-            gd1, = np.where(np.abs(diff[ind2]-med) < 3*sig) 
-            if len(gd1) >= 5: 
-                zpterm1, _ = dln.wtmean(diff[ind2[gd1]],err[ind2[gd1]],error=True)
-                zptermerr1 = dln.bootstrap(diff[ind2[gd1]],dln.wtmean,args=err[ind2[gd1]],indexargs=True)
-                chinfo['zpterm'][i] = zpterm1 
-                chinfo['zptermerr'][i] = zptermerr1 
-                chinfo['nmatch'][i] = nmatch 
-     
-    # Measure spatial variations 
-    gdchip, = np.where(chinfo['zpterm'] < 1000) 
-    if len(gdchip) > 1: 
-        expinfo['zpspatialvar_rms'] = np.std(chinfo['zpterm'][gdchip]) 
-        expinfo['zpspatialvar_range'] = np.max(chinfo['zpterm'][gdchip]-np.min(chinfo['zpterm'][gdchip]))
-        expinfo['zpspatialvar_nccd'] = len(gdchip)
+    expinfo,chinfo = fitzpterm(mstr,expinfo,chinfo)
      
     # Print out the results 
     #if not keyword_set(silent) then begin 
@@ -1106,9 +1026,7 @@ def calibrate(expdir,inpref=None,refcatfile=None,logfilename=None,eqnfile=None,r
 
                  
     # Get reddening
-    coo = SkyCoord(ra=cat['ra'],dec=cat['dec'],unit='deg')
-    sfd = SFDQuery()
-    ebv = sfd(coo)                
+    ebv = extinction.getebv(cat['ra'],cat['dec'])
     #glactc,cat['ra'],cat['dec'],2000.0,glon,glat,1,/deg 
     #ebv = dust_getval(glon,glat,/noloop,/interp)
     cat['ebv'] = ebv 
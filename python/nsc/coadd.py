@@ -15,6 +15,7 @@ __version__ = '20170911'  # yyyymmdd
 
 import os
 import sys
+import json
 import numpy as np
 import shutil
 #import scipy
@@ -35,6 +36,7 @@ import healpy as hp
 from reproject import reproject_interp
 import tempfile
 import subprocess
+import multiprocessing
 import glob
 from dlnpyutils import utils as dln, coords
 
@@ -716,6 +718,109 @@ def image_interp(imagefile,outhead,weightfile=None,masknan=False,verbose=False):
         return oim,ohead,obg
 
     
+def accumulate(tot,totwt,totvar,im,wt,weight):
+    """
+    Add one image to the running sums of a weighted mean, in place.  Pixels
+    with wt<=0 are skipped.  The sums can be float32 or float64 arrays and
+    any number of images can be added with constant memory.
+    """
+    mask = (wt > 0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        tot += np.where(mask,im*weight,0.0).astype(tot.dtype,copy=False)
+        totwt += mask*np.array(weight,dtype=totwt.dtype)
+        # Variance in each pixel for noise images and the scalar weights
+        totvar += np.where(mask,weight/wt,0.0).astype(totvar.dtype,copy=False)
+
+
+def finishmean(tot,totwt,totvar,nimages,statistic='mean'):
+    """ Turn the running sums from accumulate() into the final image and error image."""
+    # Create the weighted average image
+    totwt = totwt.copy()
+    totwt[totwt<=0] = 1
+    final = tot/totwt
+    # Create final error image
+    error = np.sqrt(totvar)
+    # Sum
+    if statistic == 'sum':
+        final *= nimages
+        error *= nimages
+    return final,error
+
+
+def robustcube(imcube,wtcube,weights=None,statistic='median',nsigma=3.0,maxiter=3):
+    """
+    Outlier-resistant combination of an image cube.  The images must already
+    be background-subtracted and scaled, and pixels to be masked should have
+    wtcube = 0.
+
+    Parameters
+    ----------
+    imcube : numpy array
+       Image cube with shape (ny,nx,nimages).
+    wtcube : numpy array
+       Weight (1/variance) cube with the same shape.
+    weights : numpy array, optional
+       Scalar weight of each image.  By default all images have the same weight.
+    statistic : str, optional
+       'median' or 'clipmean'.  'clipmean' is the weighted mean after iteratively
+         rejecting pixels more than `nsigma` from the median.  The sigma of a pixel
+         is the larger of its own error and the robust scatter across the images.
+         Default is 'median'.
+    nsigma : float, optional
+       The rejection threshold for 'clipmean'.  Default is 3.
+    maxiter : int, optional
+       Maximum number of rejection iterations for 'clipmean'.  Default is 3.
+
+    Returns
+    -------
+    final : numpy array
+       The combined image.
+    error : numpy array
+       The error image.
+
+    Example
+    -------
+
+    final,error = robustcube(imcube,wtcube,weights,statistic='clipmean')
+
+    """
+
+    ny,nx,nimages = imcube.shape
+    if weights is None:
+        weights = np.ones(nimages,float)/nimages
+    weights = np.asarray(weights,float).reshape(1,1,-1)
+
+    good = (wtcube > 0) & np.isfinite(imcube)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        var = np.where(good,1/wtcube,np.inf)
+    data = np.where(good,imcube,np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore",category=RuntimeWarning)
+        if statistic == 'median':
+            final = np.nanmedian(data,axis=2)
+            # the median is sqrt(pi/2) noisier than the mean
+            error = np.sqrt(np.pi/2)*np.sqrt(np.sum(np.where(good,weights*var,0),axis=2))
+        elif statistic == 'clipmean':
+            keep = good.copy()
+            for it in range(maxiter):
+                med = np.nanmedian(np.where(keep,data,np.nan),axis=2)
+                mad = np.nanmedian(np.abs(np.where(keep,data,np.nan)-med[:,:,np.newaxis]),axis=2)
+                sig = np.maximum(1.4826*mad[:,:,np.newaxis],np.sqrt(var))
+                newkeep = keep & (np.abs(data-med[:,:,np.newaxis]) <= nsigma*sig)
+                # Always keep at least one image
+                newkeep |= keep & (np.sum(newkeep,axis=2,keepdims=True)==0)
+                if np.array_equal(newkeep,keep): break
+                keep = newkeep
+            totwt = np.sum(keep*weights,axis=2)
+            final = np.sum(np.where(keep,data*weights,0),axis=2)/np.where(totwt>0,totwt,1)
+            error = np.sqrt(np.sum(np.where(keep,weights*var,0),axis=2))
+        else:
+            raise ValueError('statistic '+str(statistic)+' not supported')
+    final[~np.isfinite(final)] = 0.0
+
+    return final,error
+
+
 def meancube(imcube,wtcube,weights=None,crreject=False,statistic='mean'):
     """ This does the actual stack of an image cube.  The images must already be background-subtracted and scaled."""
     # Weights should be normalized, e.g., sum(weights)=1
@@ -727,32 +832,21 @@ def meancube(imcube,wtcube,weights=None,crreject=False,statistic='mean'):
     if weights is None:
         weights = np.ones(nimages,float)/nimages
     
+    # CR rejection, sigma-clipped mean
+    if crreject is True:
+        final,error = robustcube(imcube,wtcube,weights=weights,statistic='clipmean')
+        if statistic == 'sum':
+            final *= nimages
+            error *= nimages
+        return final,error
+
     # Do the weighted average
     finaltot = np.zeros((ny,nx),float)
     finaltotwt = np.zeros((ny,nx),float)        
     totvarim = np.zeros((ny,nx),float)
     for i in range(nimages):
-        mask = (wtcube[:,:,i] > 0)
-        var = np.zeros((ny,nx),float)  # sig^2
-        var[mask] = 1/wtcube[:,:,i][mask]
-        finaltot[mask] += imcube[:,:,i][mask]*weights[i]
-        finaltotwt[mask] += weights[i]
-        # Variance in each pixel for noise images and the scalar weights
-        totvarim[mask] += weights[i]*var[mask]
-    # Create the weighted average image
-    finaltotwt[finaltotwt<=0] = 1
-    final = finaltot/finaltotwt
-    # Create final error image
-    error = np.sqrt(totvarim)
-
-    # Sum
-    if statistic == 'sum':
-        final *= nimages
-        error *= nimages
-    
-    # CR rejection
-    if crreject is True:
-        pass
+        accumulate(finaltot,finaltotwt,totvarim,imcube[:,:,i],wtcube[:,:,i],weights[i])
+    final,error = finishmean(finaltot,finaltotwt,totvarim,nimages,statistic=statistic)
     
     return final,error
 
@@ -794,7 +888,107 @@ def reassemble(filename):
     return image,head
 
 
-def stack(meta,statistic='mean'):
+def tilegeom(nx,ny,nbin=2):
+    """
+    Geometry of the nbin x nbin tiles (subimages) of an image.  OFFSET is
+    the position of the first pixel of the tile in a tile file.
+    """
+    dtype = np.dtype([('X0',int),('X1',int),('Y0',int),('Y1',int),('NX',int),('NY',int),('OFFSET',int)])
+    tiles = np.zeros(nbin*nbin,dtype=dtype)
+    xbin = ybin = nbin
+    dx = nx // xbin
+    dy = ny // ybin
+    b = 0
+    offset = 0
+    for i in range(xbin):
+        x0 = i*dx
+        x1 = x0 + dx
+        if i==(xbin-1): x1=nx
+        for j in range(ybin):
+            y0 = j*dy
+            y1 = y0 + dy
+            if j==(ybin-1): y1=ny
+            tiles[b] = (x0,x1-1,y0,y1-1,x1-x0,y1-y0,offset)
+            offset += (x1-x0)*(y1-y0)
+            b += 1
+    return tiles
+
+
+def readtileindex(tmpdir):
+    """ Read the tile index of a scratch directory, returns the image size and tile geometry."""
+    with open(os.path.join(tmpdir,'tiles.json'),'r') as f:
+        index = json.load(f)
+    tiles = np.zeros(len(index['tiles']),dtype=tilegeom(1,1,1).dtype)
+    for n in tiles.dtype.names:
+        tiles[n] = [t[n] for t in index['tiles']]
+    return index['nx'],index['ny'],tiles
+
+
+def readtile(filename,tile,y0=0,y1=None):
+    """ Return rows y0:y1 of one tile of a tile file, as a memory-mapped array."""
+    arr = np.load(filename,mmap_mode='r')
+    sub = arr[tile['OFFSET']:tile['OFFSET']+tile['NX']*tile['NY']].reshape(tile['NY'],tile['NX'])
+    return sub[y0:y1]
+
+
+def stackbin(imagefiles,weightfiles,scales,weights,tile,statistic='mean',nrows=None,nsigma=3.0):
+    """
+    Stack one bin (tile) of the temporary tile files.  'mean' and 'sum' add the
+    images one at a time to running sums.  'median' and 'clipmean' read `nrows`
+    rows of all the images at a time (memory-mapped) and combine them with
+    robustcube(), so the memory stays bounded.
+
+    Returns the combined image and error image of the bin.
+    """
+
+    nimages = len(imagefiles)
+    ny,nx = tile['NY'],tile['NX']
+
+    def getrows(f,y0,y1):
+        im = np.array(readtile(imagefiles[f],tile,y0,y1),float)
+        wt = np.array(readtile(weightfiles[f],tile,y0,y1),float)
+        # Deal with NaNs
+        wt[~np.isfinite(im)] = 0
+        # Scale the image
+        #  divide image by "scale"
+        im /= scales[f]
+        #  wt = 1/err^2, need to perform same operation on err as on image
+        wt *= scales[f]**2
+        return im,wt
+
+    # Running sums, the images are added one at a time
+    if statistic in ['mean','sum']:
+        tot = np.zeros((ny,nx),float)
+        totwt = np.zeros((ny,nx),float)
+        totvar = np.zeros((ny,nx),float)
+        for f in range(nimages):
+            im,wt = getrows(f,0,ny)
+            accumulate(tot,totwt,totvar,im,wt,weights[f])
+        return finishmean(tot,totwt,totvar,nimages,statistic=statistic)
+
+    # Robust statistics need all images of a pixel at once, do a few rows at a time
+    #  about 64MB for the image and weight cubes
+    if nrows is None:
+        nrows = int(np.clip(64e6/(16*nx*nimages),1,ny))
+    final = np.zeros((ny,nx),float)
+    error = np.zeros((ny,nx),float)
+    for y0 in range(0,ny,nrows):
+        y1 = np.minimum(y0+nrows,ny)
+        imcube = np.zeros((y1-y0,nx,nimages),float)
+        wtcube = np.zeros((y1-y0,nx,nimages),float)
+        for f in range(nimages):
+            imcube[:,:,f],wtcube[:,:,f] = getrows(f,y0,y1)
+        final[y0:y1],error[y0:y1] = robustcube(imcube,wtcube,weights=weights,
+                                              statistic=statistic,nsigma=nsigma)
+    return final,error
+
+
+def _stackbin_worker(args):
+    """ Run stackbin() in a separate process."""
+    return stackbin(*args[0:5],**args[5])
+
+
+def stack(meta,statistic='mean',nrows=None,ncpu=1,nsigma=3.0):
     """
     Actually do the stacking/averaging of multiple images already reprojected.
 
@@ -804,8 +998,15 @@ def stack(meta,statistic='mean'):
        Table that contains all of the information to perform the stacking.
          Required columns are : "flxfile", "wtfile", "bgfile", "weight"
     statistic : str, optional
-       The statistic to use when combining the images: 'mean' or 'sum'.  Default
-         is 'mean'.
+       The statistic to use when combining the images: 'mean', 'sum', 'median'
+         or 'clipmean' (sigma-clipped mean).  Default is 'mean'.
+    nrows : int, optional
+       Number of rows to combine at a time for 'median' and 'clipmean'.  By default
+         this is set to use about 64MB.
+    ncpu : int, optional
+       Number of bins to stack in parallel.  Default is 1.
+    nsigma : float, optional
+       The rejection threshold for 'clipmean'.  Default is 3.
 
     Returns
     -------
@@ -822,11 +1023,11 @@ def stack(meta,statistic='mean'):
     """
 
     nimages = len(meta)
-    imagefiles = meta['flxfile']
-    weightfiles = meta['wtfile']
+    imagefiles = list(meta['flxfile'])
+    weightfiles = list(meta['wtfile'])
     bgfiles = meta['bgfile']
-    weights = meta['weight']
-    scales = meta['scale']
+    weights = np.array(meta['weight'])
+    scales = np.array(meta['scale'])
 
     # DO NOT use the error maps for the weighted average.  Use scalar weights for each exposure.
     #  otherwise you'll get screwy images
@@ -835,129 +1036,78 @@ def stack(meta,statistic='mean'):
     # imagefiles/weightfiles, list of filenames
 
     # The images should already be background subtracted and scaled
-    
-    # How many subimages
-    file1 = imagefiles[0]
-    hdu = fits.open(file1)
-    nbin = len(hdu)
-    hdu.close()
 
-    # Original image size
-    head = fits.getheader(imagefiles[0],0)
-    fnx = head['ONAXIS1']
-    fny = head['ONAXIS2']
+    if statistic not in ['mean','sum','median','clipmean']:
+        raise ValueError('statistic '+str(statistic)+' not supported')
     
-    # Get the sizes and positions of the subimages
-    dtype = np.dtype([('X0',int),('X1',int),('Y0',int),('Y1',int),('NX',int),('NY',int)])
-    bintab = np.zeros(nbin,dtype=dtype)
-    for b in range(nbin):
-        head = fits.getheader(imagefiles[0],b)
-        bintab['X0'][b] = head['SUBX0']
-        bintab['X1'][b] = head['SUBX1']
-        bintab['Y0'][b] = head['SUBY0']
-        bintab['Y1'][b] = head['SUBY1']        
-        bintab['NX'][b] = head['SUBNX']
-        bintab['NY'][b] = head['SUBNY']
+    # Original image size and the sizes and positions of the subimages
+    fnx,fny,bintab = readtileindex(os.path.dirname(os.path.abspath(imagefiles[0])))
+    nbin = len(bintab)
 
     # Final image
     final = np.zeros((fny,fnx),float)
     error = np.zeros((fny,fnx),float)    
-        
-    # Loop over bins
+
+    # Stack the bins, in parallel if requested
+    kwargs = {'statistic':statistic,'nrows':nrows,'nsigma':nsigma}
+    args = [(imagefiles,weightfiles,scales,weights,bintab[b],kwargs) for b in range(nbin)]
+    if ncpu > 1 and nbin > 1:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(int(np.minimum(ncpu,nbin))) as pool:
+            out = pool.map(_stackbin_worker,args)
+    else:
+        out = [_stackbin_worker(a) for a in args]
+
+    # Stuff into final image
     for b in range(nbin):
-        imcube = np.zeros((bintab['NY'][b],bintab['NX'][b],nimages),float)
-        wtcube = np.zeros((bintab['NY'][b],bintab['NX'][b],nimages),float)        
-        # Loop over images
-        for f in range(nimages):
-            im,head = fits.getdata(imagefiles[f],b,header=True)
-            wt,whead = fits.getdata(weightfiles[f],b,header=True)
-            # Deal with NaNs
-            wt[~np.isfinite(im)] = 0
-
-            # Scale the image
-            #  divide image by "scale"
-            im /= scales[f]
-            #  wt = 1/err^2, need to perform same operation on err as on image
-            wt *= scales[f]**2
-
-            # Stuff into the cube
-            imcube[:,:,f] = im
-            wtcube[:,:,f] = wt
-        # Do the weighted combination
-        avgim,errim = meancube(imcube,wtcube,weights=weights,statistic=statistic)
-        # Stuff into final image
+        avgim,errim = out[b]
         final[bintab['Y0'][b]:bintab['Y1'][b]+1,bintab['X0'][b]:bintab['X1'][b]+1] = avgim
         error[bintab['Y0'][b]:bintab['Y1'][b]+1,bintab['X0'][b]:bintab['X1'][b]+1] = errim
 
     return final,error
 
 
-def mktempfile(im,head,bg,wt,outhead,nbin=2):
-    """ Break up into bins and save to temporary file """
+def mktempfile(im,head,bg,wt,outhead,nbin=2,tmpdir='.'):
+    """
+    Break up into tiles and save to the scratch directory `tmpdir`.  The flux,
+    background and weight images are each written as one float32 .npy file
+    with the tiles stored one after the other, so every tile is a contiguous
+    slice of a memory-mapped array.  The tile geometry is in the "tiles.json"
+    index file of the directory.
+    """
 
     ny,nx = im.shape
-
-    # Set up temporary file n ames
-    tid,tfile = tempfile.mkstemp(prefix="timage",dir="/tmp")
+    tiles = tilegeom(nx,ny,nbin)
+
+    # Tile index, the same for all images
+    indexfile = os.path.join(tmpdir,'tiles.json')
+    if os.path.exists(indexfile)==False:
+        index = {'nx':nx,'ny':ny,'nbin':nbin,
+                 'tiles':[{n:int(t[n]) for n in tiles.dtype.names} for t in tiles]}
+        with open(indexfile,'w') as f:
+            json.dump(index,f)
+
+    # Set up temporary file names
+    tid,tfile = tempfile.mkstemp(prefix="timage",dir=tmpdir)
     os.close(tid)  # close open file
-    tbase = os.path.basename(tfile)
-    timfile = "/tmp/"+tbase+"_flx.fits"
-    twtfile = "/tmp/"+tbase+"_wt.fits"
-    tbgfile = "/tmp/"+tbase+"_bg.fits"
-
-    timhdu = fits.HDUList()
-    twthdu = fits.HDUList()
-    tbghdu = fits.HDUList()
-
-    xbin = ybin = nbin
-    dx = nx // xbin
-    dy = ny // ybin
-
-    # Put information in header
-    # ONAXIS1, ONAXIS2, SUBX0, SUBX1, SUBY0, SUBY1, SUBNX, SUBNY
-    for i in range(xbin):
-        x0 = i*dx
-        x1 = x0 + dx
-        if i==(xbin-1): x1=nx
-        for j in range(ybin):
-            y0 = j*dy
-            y1 = y0 + dy
-            if j==(ybin-1): y1=ny
-            newhead = head.copy()
-            newhead['ONAXIS1'] = newhead['NAXIS1']
-            newhead['ONAXIS2'] = newhead['NAXIS2']
-            newhead['SUBX0'] = x0
-            newhead['SUBX1'] = x1-1
-            newhead['SUBNX'] = x1-x0               
-            newhead['SUBY0'] = y0
-            newhead['SUBY1'] = y1-1
-            newhead['SUBNY'] = y1-y0
-            # Flux
-            subim = im[y0:y1,x0:x1].copy()
-            hdu1 = fits.PrimaryHDU(subim,newhead.copy())
-            timhdu.append(hdu1)
-            # Background
-            subbg = bg[y0:y1,x0:x1].copy()
-            hdu2 = fits.PrimaryHDU(subbg,newhead.copy())
-            tbghdu.append(hdu2)                
-            # Weight
-            subwt = wt[y0:y1,x0:x1].copy()
-            hdu3 = fits.PrimaryHDU(subwt,newhead.copy())
-            twthdu.append(hdu3)
-
-    timhdu.writeto(timfile,overwrite=True)
-    timhdu.close()
-    tbghdu.writeto(tbgfile,overwrite=True)
-    tbghdu.close()        
-    twthdu.writeto(twtfile,overwrite=True)
-    twthdu.close()
+    timfile = tfile+"_flx.npy"
+    twtfile = tfile+"_wt.npy"
+    tbgfile = tfile+"_bg.npy"
+
+    for data,filename in zip([im,bg,wt],[timfile,tbgfile,twtfile]):
+        arr = np.lib.format.open_memmap(filename,mode='w+',dtype=np.float32,shape=(nx*ny,))
+        for t in tiles:
+            sub = data[t['Y0']:t['Y1']+1,t['X0']:t['X1']+1]
+            arr[t['OFFSET']:t['OFFSET']+t['NX']*t['NY']] = sub.ravel()
+        arr.flush()
+        del arr
     if os.path.exists(tfile): os.remove(tfile)
 
     return timfile,tbgfile,twtfile
 
     
 def coadd(imagefiles,weightfiles,meta,outhead,statistic='mean',
-          nbin=2,outfile=None,verbose=False):
+          nbin=2,ncpu=1,scratchdir=None,outfile=None,verbose=False):
     """
     Create a coadd given a list of images.
 
@@ -973,10 +1123,18 @@ def coadd(imagefiles,weightfiles,meta,outhead,statistic='mean',
     outhead : header or WCS
        Header with projection for the output image.
     statistic : str, optional
-       Statistic to use for coaddition: 'mean' or 'sum'.  Default is 'mean'.
+       Statistic to use for coaddition: 'mean', 'sum', 'median' or 'clipmean'
+         (sigma-clipped mean, rejects cosmic rays and satellite trails).
+         Default is 'mean'.
     nbin : int, optional
        Number of bins to use (in X and Y) when splitting up the
          image for the temporary files.  Default is 2.
+    ncpu : int, optional
+       Number of bins to stack in parallel.  Default is 1.
+    scratchdir : str, optional
+       Directory in which to create the temporary tile directory.  Use
+         "/dev/shm" to keep the tiles in shared memory.  By default the
+         current directory is used.
     outfile : str, optional
        Name of output FITS filename.
     verbose : boolean, optional
@@ -1014,35 +1172,36 @@ def coadd(imagefiles,weightfiles,meta,outhead,statistic='mean',
     weights /= np.sum(weights)    # normalize
     meta['weight'] = weights
 
+    # Scratch directory for the temporary tile files
+    if scratchdir is None: scratchdir='.'
+    tmpdir = tempfile.mkdtemp(prefix="coadd",dir=scratchdir)
+
     # Loop over the images
-    meta['flxfile'] = 100*' '  # add columns for temporary file names
-    meta['wtfile'] = 100*' '
-    meta['bgfile'] = 100*' '
-    for f in range(nimages):
-        if verbose:
-            print(str(f+1)+' '+imagefiles[f]+' '+weightfiles[f])
+    meta['flxfile'] = 300*' '  # add columns for temporary file names
+    meta['wtfile'] = 300*' '
+    meta['bgfile'] = 300*' '
+    try:
+        for f in range(nimages):
+            if verbose:
+                print(str(f+1)+' '+imagefiles[f]+' '+weightfiles[f])
 
-        # Interpolate image
-        fim, fhead, fbg, fwt = image_interp(imagefiles[f],outhead,weightfile=weightfiles[f],verbose=verbose)
-        ny,nx = fim.shape
+            # Interpolate image
+            fim, fhead, fbg, fwt = image_interp(imagefiles[f],outhead,weightfile=weightfiles[f],verbose=verbose)
+            ny,nx = fim.shape
 
-        # Break up image and save to temporary files
-        tflxfile,tbgfile,twtfile = mktempfile(fim,fhead,fbg,fwt,outhead,nbin=nbin)
-        meta['flxfile'][f] = tflxfile
-        meta['bgfile'][f] = tbgfile
-        meta['wtfile'][f] = twtfile
-        
-    # Stack the images
-    #   this does the scaling and weighting
-    final,error = stack(meta,statistic=statistic)
+            # Break up image and save to temporary files
+            tflxfile,tbgfile,twtfile = mktempfile(fim,fhead,fbg,fwt,outhead,nbin=nbin,tmpdir=tmpdir)
+            meta['flxfile'][f] = tflxfile
+            meta['bgfile'][f] = tbgfile
+            meta['wtfile'][f] = twtfile
 
+        # Stack the images
+        #   this does the scaling and weighting
+        final,error = stack(meta,statistic=statistic,ncpu=ncpu)
 
-    
     # Delete temporary files
-    for i in range(len(meta)):
-        if os.path.exists(meta['flxfile'][i]): os.remove(meta['flxfile'][i])
-        if os.path.exists(meta['bgfile'][i]): os.remove(meta['bgfile'][i])
-        if os.path.exists(meta['wtfile'][i]): os.remove(meta['wtfile'][i])
+    finally:
+        shutil.rmtree(tmpdir,ignore_errors=True)
 
     # Final header
     #  scales, weights, image names, mean backgrounds
@@ -8,6 +8,7 @@ from astropy.io import fits
 import photutils
 from skimage import measure, morphology
 from scipy.cluster import vq
+from scipy.spatial import cKDTree
 #import gaps
 import matplotlib.pyplot as plt
 import pylab
@@ -345,6 +346,79 @@ def get_fluxcenter(subim,mask=None,noise=None):
         
     return (xcen,ycen,xcenerr,ycenerr)
 
+def select_peaks(im,cand,radius):
+    """ Non-maximum suppression of candidate peaks.
+        im      The image used to rank the peaks
+        cand    Boolean image of the candidate peaks
+        radius  A peak is rejected if a brighter peak was accepted
+                  within +/-radius pixels
+        Returns a boolean image of the accepted peaks.
+        This gives the same result as going through the peaks from
+        the brightest to the faintest, but all peaks that have no brighter
+        undecided neighbor are accepted at once.
+    """
+    ycand, xcand = np.where(cand)
+    ncand = len(xcand)
+    keep = np.zeros(im.shape,bool)
+    if ncand == 0:
+        return keep
+    # Rank the candidates, 0 is the brightest, ties are broken by position
+    rank = np.zeros(ncand,int)
+    rank[np.argsort(-im[ycand,xcand],kind='stable')] = np.arange(ncand)
+    # Pairs of neighboring candidates, both ways
+    pairs = cKDTree(np.column_stack((xcand,ycand))).query_pairs(radius,p=np.inf,output_type='ndarray')
+    p1 = np.concatenate((pairs[:,0],pairs[:,1]))
+    p2 = np.concatenate((pairs[:,1],pairs[:,0]))
+    # 0-undecided, 1-accepted, -1-rejected
+    state = np.zeros(ncand,int)
+    while np.sum(state==0) > 0:
+        blocked = np.zeros(ncand,bool)
+        bpair = (state[p1]==0) & (state[p2]==0) & (rank[p2] < rank[p1])
+        blocked[p1[bpair]] = True
+        state[(state==0) & (blocked==False)] = 1
+        # reject everything near the accepted peaks
+        rpair = (state[p1]==1) & (state[p2]==0)
+        state[p2[rpair]] = -1
+    keep[ycand[state==1],xcand[state==1]] = True
+    return keep
+
+def get_stamps(im,xind,yind,hwidth,mask=None,noise=None,sky=0.0):
+    """ This function returns the subimages around many positions
+        as 3-D arrays [nstamps,2*hwidth+1,2*hwidth+1]
+        xind, yind   the indices for the im array
+        hwidth is the half-width.  Total width = 2*hwidth+1
+        sky  the sky level to use, default=0.0
+        Out of bounds pixels are set like in get_subim(), flux=sky,
+        mask=False and noise=1.0.
+        Returns (flux,mask,noise) tuple.
+    """
+    ny, nx = im.shape
+    xind = np.atleast_1d(xind).astype(int)
+    yind = np.atleast_1d(yind).astype(int)
+    # Pixel indices of all the stamps in the padded image
+    dind = np.arange(2*hwidth+1)
+    yy = np.clip(yind,-hwidth,ny-1+hwidth)[:,None,None] + dind[None,:,None]
+    xx = np.clip(xind,-hwidth,nx-1+hwidth)[:,None,None] + dind[None,None,:]
+    pim = np.pad(np.asarray(im),hwidth,mode='constant',constant_values=sky)
+    subim = pim[yy,xx]
+    if mask is not None:
+        pmask = np.pad(np.asarray(mask,bool),hwidth,mode='constant',constant_values=False)
+        submask = pmask[yy,xx]
+    else:
+        submask = np.zeros(subim.shape,bool)
+    if noise is not None:
+        pnoise = np.pad(np.asarray(noise),hwidth,mode='constant',constant_values=1.0)
+        subnoise = pnoise[yy,xx]
+    else:
+        subnoise = np.ones(subim.shape,'f')
+    # Stamps completely off the image
+    off = (xind < -hwidth) | (xind > nx-1+hwidth) | (yind < -hwidth) | (yind > ny-1+hwidth)
+    if np.sum(off) > 0:
+        subim[off] = sky
+        submask[off] = False
+        subnoise[off] = 1.0
+    return (subim,submask,subnoise)
+
 def detect_segment(exp,nsig=5.0):
     """ Detect with image segmentation
     """
@@ -386,7 +460,7 @@ def detect_segment(exp,nsig=5.0):
                    ('bbox_y0',int),('bbox_y1',int),('major_axis',float),('minor_axis',float),
                    ('theta',float),('eccentricity',float)])
     cat = np.zeros(nreg,dtype=dt)
-    for i in xrange(nreg):
+    for i in range(nreg):
         cat['id'][i] = all_props[i].label
         centroid = all_props[i].weighted_centroid
         cat['x'][i] = centroid[1]
@@ -447,14 +521,6 @@ def detect_delta(exp,nsig=5.0,fluxfrac=0.5):
     diffy2 = smim - np.roll(smim,-1,axis=0)
     diffy2[ny-1,:] = 0.5*fluxfrac*smim[ny-1,:] * (smim[ny-1,:] > 0.0)
 
-    # Try the maximum_filter
-    #neighborhood_size = 5
-    #smim_max = filters.maximum_filter(smim, neighborhood_size)
-    #smim_maxima = (smim == smim_max)
-    # This works but finds MANY peaks, needs to apply sigma threshold
-    # problems is that it's harder to easily check the flux
-    # ratio/fraction of the neighbors
-    
     # Set the threshold for the flux difference for neighbors
     diffth = smim*fluxfrac * (smim > 0.0)
     
@@ -468,55 +534,27 @@ def detect_delta(exp,nsig=5.0,fluxfrac=0.5):
              & (diffx1 < diffth) & (diffx2 < diffth) & (diffy1 < diffth) & (diffy2 < diffth) \
              & (im >= nsig*sigma) \
              & (exp.mask == False)
-    src = np.where(detect == True)
-    ndetect = len(src[0])
-    xdetect = np.zeros(ndetect,'i')
-    xdetect[:] = src[1]
-    ydetect = np.zeros(ndetect,'i')
-    ydetect[:] = src[0]
-
-    # Create peak structure
-    dt = np.dtype([('xcen',int),('ycen',int),('nsig',float)])
-    peaks = np.zeros(ndetect,dtype=dt)
-    peaks['nsig'] = 0.0
-    
-    # Stuff in some information
-    #peaks['xcen'] = xdetect
-    #peaks['ycen'] = ydetect
-    #peaks['nsig'] = im[ydetect,xdetect] / sigma[ydetect,xdetect]
-
-    #pylab.ion()
-    #plt.imshow(smim,interpolation='nearest',origin='lower')
-    #plt.plot(xdetect,ydetect,'r+')
-    #import pdb; pdb.set_trace()
 
     # I'M GETTING "HOT PIXELS" COMING THROUGH
     
-    # Loop through the peaks and make sure
-    #   that we have the brightest peak within +/-2 pixels
+    # Make sure that we have the brightest peak within +/-2 pixels
     #   this is to make sure that we don't get any duplicates.
     #   Can't make this too large or we won't detect fainter
     #   neighbor peaks that are close by
-    detmask = np.zeros(im.shape,'b')
     detbuff = 2
-    for i in xrange(ndetect):
-        # Buffer x/y ranges
-        xlo = (xdetect[i]-detbuff) if (xdetect[i]-detbuff) > 0 else 0
-        xhi = (xdetect[i]+detbuff) if (xdetect[i]+detbuff) < (nx-1) else (nx-1)
-        ylo = (ydetect[i]-detbuff) if (ydetect[i]-detbuff) > 0 else 0
-        yhi = (ydetect[i]+detbuff) if (ydetect[i]+detbuff) < (ny-1) else (ny-1)
-        maxsubsmim = np.max(smim[ylo:yhi+1,xlo:xhi+1])
-        ndetmask = np.sum(detmask[ylo:yhi+1,xlo:xhi+1])
-        # Brightest value within +/-2 pixels (use smoothed image)
-        #  and no peak previously detected nearby
-        if (smim[ydetect[i],xdetect[i]] >= maxsubsmim) & (ndetmask == 0):
-            # Since we find peaks in the smoothed image they might
-            #  not correspond to peaks in the original image
-            #  there might be a +/-1 pixel offset
-            peaks['xcen'][i] = xdetect[i]
-            peaks['ycen'][i] = ydetect[i]
-            peaks['nsig'][i] = im[ydetect[i],xdetect[i]] / sigma[ydetect[i],xdetect[i]]
-            detmask[ylo:yhi+1,xlo:xhi+1] = 1
+    ycand, xcand = np.where(detect)
+    smmax = np.max(get_stamps(smim,xcand,ycand,detbuff,sky=-np.inf)[0],axis=(1,2))
+    cand = np.zeros(im.shape,bool)
+    cand[ycand,xcand] = (smim[ycand,xcand] >= smmax)
+    #  and no brighter peak detected nearby
+    keep = select_peaks(smim,cand,2*detbuff)
+    ydetect, xdetect = np.where(keep)
+    # Create peak structure
+    dt = np.dtype([('xcen',int),('ycen',int),('nsig',float)])
+    peaks = np.zeros(len(xdetect),dtype=dt)
+    peaks['xcen'] = xdetect
+    peaks['ycen'] = ydetect
+    peaks['nsig'] = im[ydetect,xdetect] / sigma[ydetect,xdetect]
             
     # Only keep good peaks
     gdpeaks, = np.where(peaks['nsig'] >= nsig)
@@ -588,7 +626,7 @@ def detect_peaksegment(exp,nsig=5.0):
     
     # Now loop through the regions and resegment
     # with halfmax
-    for i in xrange(nreg):
+    for i in range(nreg):
         # Get bbox footprint for this region
         bbox = props[i].bbox
         subim = im[bbox[0]:bbox[2]+1,bbox[1]:bbox[3]+1]
@@ -601,7 +639,7 @@ def detect_peaksegment(exp,nsig=5.0):
             peakind = allpeaksind[labelbool]
             npeakind = len(peakind)
             # Loop over the peaks in this region
-            for j in xrange(npeakind):
+            for j in range(npeakind):
                 peakind1 = peakind[j]
                 # Make the halfmax mask image
                 #  make the threshold level slightly smaller
@@ -772,7 +810,7 @@ def get_contour(im,level,coord):
     # check my vertex overlap functions in printVisitSkyMap.py to see
     #  which contour encloses the center or flux center
     isinpoly = np.zeros(len(allcontours))
-    for f in xrange(len(allcontours)):
+    for f in range(len(allcontours)):
         isinpoly[f] = isPointInPolygon(allcontours[f][:,0],allcontours[f][:,1],ycen,xcen)
     gdcont = np.where(isinpoly == 1)[0]
     ngdcont = len(gdcont)
@@ -836,10 +874,10 @@ def get_morph_single(im,exp,morph,hwidth=10,hwidthS=3,noerrors=False):
     
     # Construct X- and Y-arrays
     #xx = np.zeros([2*hwidth+1,2*hwidth+1],'f')
-    #for j in xrange(2*hwidth+1):
+    #for j in range(2*hwidth+1):
     #    xx[:,j] = j
     #yy = np.zeros([2*hwidth+1,2*hwidth+1],'f')
-    #for j in xrange(2*hwidth+1):
+    #for j in range(2*hwidth+1):
     #    yy[j,:] = j   
     yy, xx = np.indices([2*hwidth1+1,2*hwidth1+1],'f')
     #print "need to test this np.indices code"
@@ -991,7 +1029,10 @@ def get_morph_single(im,exp,morph,hwidth=10,hwidthS=3,noerrors=False):
     return morph
 
 def get_morph(exp,peaks,noerrors=False):
-    """ Measure morphological parameters of a source in a small image
+    """ Measure morphological parameters of all the sources at once
+        using 3-D arrays of postage stamps.  The measurements are the
+        same as get_morph_single() except that the contour values come
+        from the pixels above half maximum instead of a traced contour.
     """
     subim = exp.flux - exp.background
     npeaks = len(peaks)
@@ -1029,23 +1070,103 @@ def get_morph(exp,peaks,noerrors=False):
         morph['y0'] = peaks['ycen']
         morph['nsig'] = peaks['nsig']
     
-    # Loop through the peaks
-    for i in range(npeaks):
-        morph1in = morph[i]
-
-        #pylab.ion()
-        #plt.imshow(smim,interpolation='nearest',origin='lower')
-        #plt.plot(xdetect,ydetect,'r+')
-        #import pdb; pdb.set_trace()
-    
-        #print morph1in.contour_fwhm
-        morph1out = get_morph_single(subim,exp,morph1in,hwidth=hwidth,noerrors=noerrors)
-        #print morph1out.contour_fwhm
-        # The box is too small, try twice the size
-        #if (np.isfinite(morph1out['contour_fwhm']) is False) | (morph1out['siga'] > (hwidth-1)) \
-        #   | (morph1out['sigb'] > (hwidth-1)):
-        #    morph1out = get_morph_single(subim,exp,morph1in,hwidth=2*hwidth,noerrors=noerrors)
-        morph[i] = morph1out
+    if npeaks == 0:
+        return morph
+
+    # Small stamps just to compute the flux center
+    #  just with the pixels near the peak
+    noise = exp.noise if noerrors is False else None
+    fluxS, maskS, noiseS = get_stamps(subim,morph['x0'],morph['y0'],hwidthS,mask=exp.mask,noise=noise)
+    nS = 2*hwidthS+1
+    gmaskS = (fluxS >= 0.0) & (maskS == False)
+    totfluxS = np.sum(fluxS*gmaskS,axis=(1,2))
+    xcenS = np.sum( np.sum(fluxS*gmaskS,axis=1)*np.arange(nS), axis=1 )/totfluxS
+    ycenS = np.sum( np.sum(fluxS*gmaskS,axis=2)*np.arange(nS), axis=1 )/totfluxS
+    morph['x'] = xcenS + morph['x0'] - hwidthS
+    morph['y'] = ycenS + morph['y0'] - hwidthS
+    if noerrors is False:
+        # Using eqns. 32+33 from SExtractor manual
+        morph['xerr'] = np.sqrt( np.sum( np.sum((noiseS**2)*gmaskS,axis=1)*np.arange(nS)**2, axis=1 )/totfluxS**2 )
+        morph['yerr'] = np.sqrt( np.sum( np.sum((noiseS**2)*gmaskS,axis=2)*np.arange(nS)**2, axis=1 )/totfluxS**2 )
+    else:
+        morph['xerr'] = np.nan
+        morph['yerr'] = np.nan
+    # Getting maximum from small stamps
+    maxim = np.max(fluxS*(1-maskS),axis=(1,2))
+    morph['max'] = maxim
+
+    # Larger stamps for the morphology
+    flux, mask, noise = get_stamps(subim,morph['x0'],morph['y0'],hwidth,mask=exp.mask,noise=noise)
+    yy, xx = np.indices([2*hwidth+1,2*hwidth+1],'f')
+    xcen = (xcenS + (hwidth-hwidthS))[:,None,None]
+    ycen = (ycenS + (hwidth-hwidthS))[:,None,None]
+    goodmask = (flux > 0.0) & (mask == False)
+    morph['flux'] = np.sum(flux*goodmask,axis=(1,2))
+
+    # Computing the "round" factor, see get_morph_single()
+    htx = np.max(np.sum(flux*(1-mask),axis=1),axis=1)
+    hty = np.max(np.sum(flux*(1-mask),axis=2),axis=1)
+    morph['round'] = (hty-htx)/(0.5*(htx+hty))
+
+    # "Window" mask, pixels above 1/2 maximum
+    #  the half-maximum contour of get_morph_single() is not traced here,
+    #  its FWHM comes from the area of the window instead
+    cgoodmask = goodmask & (flux >= 0.5*maxim[:,None,None])
+    npixhalf = np.sum(cgoodmask,axis=(1,2))
+    morph['contour_fwhm'] = np.where(npixhalf > 0, 2.0*np.sqrt(npixhalf/np.pi), np.nan)
+
+    # Second MOMENTS of the windowed image
+    #  The factor of 3.33 corrects for the fact that we are missing
+    #  a decent chunk of the 2D Gaussian.
+    wflux = flux*cgoodmask
+    posflux = np.sum(wflux,axis=(1,2))
+    ixx = np.sum( wflux * (xx-xcen)**2, axis=(1,2) ) / posflux * 3.33
+    iyy = np.sum( wflux * (yy-ycen)**2, axis=(1,2) ) / posflux * 3.33
+    ixy = np.sum( wflux * (xx-xcen) * (yy-ycen), axis=(1,2) ) / posflux * 3.33
+    morph['ixx'] = ixx
+    morph['iyy'] = iyy
+    morph['ixy'] = ixy
+    # Semi-major, semi-minor and theta from the moments, see get_morph_single()
+    det = np.sqrt( ((ixx-iyy)/2)**2 + ixy**2 )
+    siga = np.sqrt( (ixx+iyy)/2 + det )
+    sigb = np.sqrt( np.maximum((ixx+iyy)/2 - det, 0.0) )
+    sigb[det > (ixx+iyy)/2] = 0.1
+    theta = np.rad2deg( np.arctan2(2*ixy,ixx-iyy) / 2 )
+    theta = np.abs(theta)*np.sign(ixy)
+    theta[ixx == iyy] = 0.0
+    morph['siga'] = siga
+    morph['sigb'] = sigb
+    morph['theta'] = theta
+    morph['contour_elip'] = 1-sigb/siga
+    morph['contour_theta'] = theta
+
+    # Gaussian model for Gaussian weighted photometry
+    thetarad = np.deg2rad(theta)[:,None,None]
+    siga2 = (siga**2)[:,None,None]
+    sigb2 = (sigb**2)[:,None,None]
+    a = ((np.cos(-thetarad)**2) / (2*siga2)) + ((np.sin(-thetarad)**2) / (2*sigb2))
+    b = -((np.sin(-2*thetarad)) / (4*siga2)) + ((np.sin(-2*thetarad)) / (4*sigb2))
+    c = ((np.sin(-thetarad)**2) / (2*siga2)) + ((np.cos(-thetarad)**2) / (2*sigb2))
+    g = np.exp(-(a*(xx-xcen)**2 + 2*b*(xx-xcen)*(yy-ycen) + c*(yy-ycen)**2))
+    g /= np.sum(g,axis=(1,2))[:,None,None]
+
+    # Gaussian weighted flux, from Valdes (2007)
+    ivar = 1.0/noise**2
+    gausswtflux = np.sum( g*flux*cgoodmask*ivar, axis=(1,2) )
+    gausswtflux /= np.sum( g**2 * cgoodmask*ivar, axis=(1,2) )
+    morph['gausswtflux'] = gausswtflux
+
+    # Gaussian scaling factor, weighted mean of flux/gaussian
+    #  weight by (S/N)^2, only where the gaussian is large enough
+    gmask = (g > np.max(g,axis=(1,2))[:,None,None]*0.05) & cgoodmask
+    wt = (flux/noise)**2 * gmask
+    wt /= np.sum(wt,axis=(1,2))[:,None,None]
+    gdenom = np.where(gmask, g, 1.0)
+    morph['gaussflux'] = np.sum( flux*wt / gdenom, axis=(1,2) )
+
+    # compute chi-squared
+    resid = (flux-g*gausswtflux[:,None,None])*gmask / noise
+    morph['chisq'] = np.sum( resid**2, axis=(1,2) ) / np.sum(gmask,axis=(1,2))
 
     return morph
 
@@ -1054,8 +1175,8 @@ def get_morphclusters(morph,ngroups=3):
     """
 
     # Get sources with "good" values for everything
-    gd, = np.where(np.isfinite(morph['fwhm']) & np.isfinite(morph['round']) &
-                   np.isfinite(morph['elip']) & np.isfinite(morph['theta']) &
+    gd, = np.where(np.isfinite(morph['contour_fwhm']) & np.isfinite(morph['round']) &
+                   np.isfinite(morph['contour_elip']) & np.isfinite(morph['theta']) &
                    np.isfinite(morph['ixx']) & np.isfinite(morph['iyy']) &
                    np.isfinite(morph['ixy']))           
     ngd = len(gd)
@@ -1063,9 +1184,9 @@ def get_morphclusters(morph,ngroups=3):
     # Use K-means
     #  Try three groups: CRs, stars, and galaxies
     features = np.zeros([ngd,7],'f')
-    features[:,0] = morph['fwhm'][gd]
+    features[:,0] = morph['contour_fwhm'][gd]
     features[:,1] = morph['round'][gd]
-    features[:,2] = morph['elip'][gd]
+    features[:,2] = morph['contour_elip'][gd]
     features[:,3] = morph['theta'][gd]
     features[:,4] = morph['ixx'][gd]
     features[:,5] = morph['iyy'][gd]
@@ -1084,7 +1205,7 @@ def get_morphclusters(morph,ngroups=3):
                    ('sig_ixx',float),('med_iyy',float),('sig_iyy',float),
                    ('med_ixy',float),('sig_ixy',float)])
     clusters = np.zeros(nclusters,dtype=dt)
-    for i in xrange(nclusters):
+    for i in range(nclusters):
         grp, = np.where(idx == i)
         clusters['nsources'][i] = len(grp)
         if len(grp) > 1:
@@ -1108,31 +1229,45 @@ def get_morphclusters(morph,ngroups=3):
     
     return clusters
         
-def imfwhm(exp):
-    """ Measure the image PSF FWHM
-        bkg has the image (data), background (background) and noise in the
-        background (background_rms)
+def imfwhm(exp,nsig=10.0,maxsources=2000):
+    """ Measure the image PSF FWHM (in pixels) without Source Extractor
+        Bright, round, unsaturated peaks are measured and the FWHM of
+        the stellar locus is returned, along with the morph structure
+        of the stars used.
+        nsig        Minimum peak significance, default=10
+        maxsources  Maximum number of sources to measure, the brightest
+                      are used, default=2000
+        Returns (fwhm,morph) tuple.  FWHM is NAN if there are not enough stars.
     """
     # Step 1. Detect with delta function
-    peaks = detect_delta(exp)
-    # Step 2. Aperture photometry
-    #  not sure this is needed
-    # Step 3. Measure morphology/moments
-    morph = get_morph(exp,peaks)
-    # Step 4. Get cluster of stars and measure FWHM
-    clusters = get_morphclusters(morph)
-    # Step 5. Now decide which cluster to use for "stars" and measure FWHM
-    # three types of groups
-    # 1.) CRs, hot/bad pixels
-    #   -large variety of sizes, but lots will be very "peaky"
-    #     and have small widths
-    # 2.) stars
-    #   -wider than CRs but thinner than galaxies
-    #   -should be very uniform in all parameters
-    # 3.) galaxies
-    #   -should be the widest
-    #   -should a larger dispersion of shape, size, ellipticity and angle
-    # But how do we know if all of these three groups are presented?
+    peaks = detect_delta(exp,nsig=nsig)
+    if peaks is None:
+        return np.nan, None
+    if len(peaks) > maxsources:
+        si = np.argsort(-peaks['nsig'])
+        peaks = peaks[si[0:maxsources]]
+    # Step 2. Measure morphology/moments of all sources at once
+    morph = get_morph(exp,peaks,noerrors=True)
+    # FWHM from the second moments, sigma->FWHM
+    fwhm = 2.3548*np.sqrt(morph['siga']*morph['sigb'])
+    # Step 3. Select the stars
+    #  CRs and hot/bad pixels are very "peaky" with small widths
+    #  galaxies are wider and less round
+    gd = (np.isfinite(fwhm) & (fwhm > 1.0) & (morph['sigb'] > 0.1) &
+          (morph['sigb']/morph['siga'] > 0.7) & (np.abs(morph['round']) < 0.5))
+    if np.sum(gd) < 5:
+        return np.nan, morph[gd]
+    # Step 4. The stars are the narrow edge of the size distribution,
+    #  clip the wide sources (galaxies, blends) around the lower half
+    fwhm1 = fwhm[gd]
+    med = np.median(fwhm1[fwhm1 <= np.median(fwhm1)])
+    sig = np.maximum(mad(fwhm1[fwhm1 <= np.median(fwhm1)]), 0.05*med)
+    for i in range(3):
+        star = np.abs(fwhm1-med) < 3*sig
+        med = np.median(fwhm1[star])
+        sig = np.maximum(mad(fwhm1[star]), 0.05*med)
+    star = np.abs(fwhm1-med) < 3*sig
+    return med, morph[gd][star]
     
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+import os
+import time
+import tempfile
+import threading
+import subprocess
+
+# The DAOPHOT command prompt, every command returns to it when it is done
+PROMPT = b'Command:'
+
+class DaophotSession(object):
+    """
+    A persistent interactive DAOPHOT process.  Commands are written to its
+    stdin and the output is read back up to the next "Command:" prompt, so a
+    whole FIND/PHOTOMETRY/PICKPSF/PSF/GROUP/NSTAR/SUBSTAR sequence runs in one
+    process.  The image is only re-ATTACHed (and the options only re-read)
+    when the file changes.
+
+    Parameters
+    ----------
+    bindir : str, optional
+       The directory with the daophot executable.  By default it is found in the PATH.
+    timeout : float, optional
+       Maximum time in seconds to wait for a command to finish.  Default is 3600.
+    settle : float, optional
+       Time in seconds to wait for extra prompts after each command.  Default is 0.2.
+    logger : logging object, optional
+       The logger to use.
+
+    Example
+    -------
+
+    with DaophotSession() as session:
+        phot.daofind("image.fits",session=session)
+        phot.daoaperphot("image.fits","image.coo",session=session)
+
+    """
+
+    def __init__(self,bindir=None,timeout=3600.0,settle=0.2,logger=None):
+        if bindir is None: bindir=""
+        self.bindir = bindir
+        self.timeout = timeout
+        self.settle = settle
+        self.logger = logger
+        self.proc = None
+        # Short names for the image and option files, DAOPHOT can't handle long names
+        tid,tfile = tempfile.mkstemp(prefix="tses",dir=".")
+        os.close(tid)
+        self._tfile = tfile
+        tbase = os.path.basename(tfile)
+        self.imlink = tbase+".fits"
+        self.optlink = tbase+".opt"
+        self._start()
+
+    def _start(self):
+        """ Start the DAOPHOT process and wait for its first prompt."""
+        self._buf = bytearray()
+        self._pos = 0
+        self._eof = False
+        self._cond = threading.Condition()
+        self._attached = None
+        self._options = None
+        # gfortran buffers stdout when it is not a terminal, so the prompts would never show up
+        env = dict(os.environ)
+        env['GFORTRAN_UNBUFFERED_PRECONNECTED'] = 'y'
+        self.proc = subprocess.Popen([self.bindir+"daophot"],stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT,env=env,bufsize=0)
+        self._thread = threading.Thread(target=self._reader,args=(self.proc,self._cond),daemon=True)
+        self._thread.start()
+        self._wait()
+
+    def restart(self):
+        """ Kill the DAOPHOT process and start a new one."""
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+        self._start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def __repr__(self):
+        return "DaophotSession object"
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _reader(self,proc,cond):
+        """ Collect the DAOPHOT output in a background thread."""
+        fd = proc.stdout.fileno()
+        while True:
+            try:
+                data = os.read(fd,65536)
+            except OSError:
+                data = b''
+            with cond:
+                if cond is not self._cond:   # the session was restarted
+                    return
+                if len(data)==0:
+                    self._eof = True
+                    cond.notify_all()
+                    return
+                self._buf += data
+                cond.notify_all()
+
+    def _wait(self,logfile=None):
+        """ Wait for the next prompt and return the output since the last one."""
+        t0 = time.time()
+        with self._cond:
+            while True:
+                ind = self._buf.find(PROMPT,self._pos)
+                if ind >= 0:
+                    end = ind+len(PROMPT)
+                    out = bytes(self._buf[self._pos:end])
+                    self._pos = end
+                    break
+                if self._eof:
+                    out = bytes(self._buf[self._pos:])
+                    self._pos = len(self._buf)
+                    self._writelog(logfile,out)
+                    raise Exception("DAOPHOT session ended unexpectedly")
+                left = self.timeout-(time.time()-t0)
+                if left <= 0:
+                    self.close(kill=True)
+                    raise Exception("DAOPHOT session timed out")
+                self._cond.wait(left)
+        self._writelog(logfile,out)
+        return out.decode(errors='replace')
+
+    def _writelog(self,logfile,out):
+        if logfile is not None and len(out)>0:
+            with open(logfile,'ab') as f:
+                f.write(out)
+
+    def _drain(self,logfile=None):
+        """
+        Read any extra prompts that show up within `settle` seconds.  DAOPHOT
+        prompts again for answers it did not consume (e.g. the final blank line
+        after PSF or SUBSTAR), and those must not be taken as the output of the
+        next command.  Returns the number of extra prompts.
+        """
+        nextra = 0
+        with self._cond:
+            while True:
+                ind = self._buf.find(PROMPT,self._pos)
+                if ind >= 0:
+                    end = ind+len(PROMPT)
+                    out = bytes(self._buf[self._pos:end])
+                    self._pos = end
+                    self._writelog(logfile,out)
+                    nextra += 1
+                    continue
+                if self._eof:
+                    break
+                nbuf = len(self._buf)
+                self._cond.wait(self.settle)
+                if len(self._buf) == nbuf:
+                    break
+        return nextra
+
+    def command(self,lines,logfile=None,outfile=None):
+        """
+        Send one DAOPHOT command and its answers, and return its output.  If
+        `outfile` is given, raise an exception if it was not created.
+        """
+        if self.alive is False:
+            raise Exception("DAOPHOT session is not running")
+        if isinstance(lines,str): lines=[lines]
+        self.proc.stdin.write(("\n".join(lines)+"\n").encode())
+        self.proc.stdin.flush()
+        out = self._wait(logfile)
+        nextra = self._drain(logfile)
+        if nextra > 0 and self.logger is not None:
+            self.logger.debug("DAOPHOT "+lines[0]+" returned "+str(nextra)+" extra prompts")
+        if outfile is not None and os.path.exists(outfile) is False:
+            raise Exception("DAOPHOT "+lines[0]+" did not create "+outfile)
+        return out
+
+    def options(self,optfile,logfile=None):
+        """ Load an option file, unless it is unchanged since the last time."""
+        st = os.stat(optfile)
+        key = (os.path.abspath(optfile),st.st_ino,st.st_mtime_ns,st.st_size)
+        if key == self._options:
+            return
+        if os.path.lexists(self.optlink): os.remove(self.optlink)
+        os.symlink(os.path.abspath(optfile),self.optlink)
+        self.command(["OPTIONS",self.optlink,""],logfile)
+        self._options = key
+
+    def attach(self,imfile,logfile=None):
+        """ Attach an image, unless it is already attached and unchanged."""
+        st = os.stat(imfile)
+        key = (os.path.abspath(imfile),st.st_ino,st.st_mtime_ns,st.st_size)
+        if key == self._attached:
+            return
+        if os.path.lexists(self.imlink): os.remove(self.imlink)
+        os.symlink(os.path.abspath(imfile),self.imlink)
+        self.command("ATTACH "+self.imlink,logfile)
+        self._attached = key
+
+    def run(self,imfile,optfile,cmds,logfile=None,outfiles=None):
+        """
+        Run a sequence of commands on an image.  `cmds` is a list of
+        commands, each a list of the command name and its answers.
+        `outfiles` is an optional list with the output file that each
+        command must create (or None).
+        """
+        if outfiles is None: outfiles=[None]*len(cmds)
+        self.options(optfile,logfile)
+        self.attach(imfile,logfile)
+        out = ''
+        for c,o in zip(cmds,outfiles):
+            out += self.command(c,logfile,outfile=o)
+        return out
+
+    def close(self,kill=False):
+        """ Exit DAOPHOT and remove the temporary links."""
+        if self.proc is not None:
+            try:
+                if kill is False and self.alive:
+                    self.proc.stdin.write(b"EXIT\n")
+                    self.proc.stdin.flush()
+                    self.proc.wait(timeout=60)
+            except (OSError,subprocess.TimeoutExpired):
+                pass
+            if self.proc.poll() is None:
+                self.proc.kill()
+                self.proc.wait()
+            self.proc = None
+        for f in [self._tfile,self.imlink,self.optlink]:
+            if os.path.lexists(f): os.remove(f)
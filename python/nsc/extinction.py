@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+import healpy as hp
+from astropy.coordinates import SkyCoord
+from dustmaps.sfd import SFDQuery
+
+# Process-wide state.  The SFD maps are only loaded the first time they are
+# needed and then reused by every subsequent call in this python process.
+_sfd = None
+_ebvmap = None
+_ebvmapfile = None
+_exttype_cache = {}
+
+def getsfd():
+    """
+    Return the process-wide SFDQuery object, loading the dust maps on
+    the first call only.
+
+    Returns
+    -------
+    sfd : SFDQuery
+       The SFD dust map query object.
+
+    Example
+    -------
+
+    sfd = getsfd()
+
+    """
+    global _sfd
+    if _sfd is None:
+        _sfd = SFDQuery()
+    return _sfd
+
+
+def mkebvmap(nside=2048,outfile=None,nchunk=1000000):
+    """
+    Create a HEALPix (RING ordering) map of SFD E(B-V) evaluated at the
+    pixel centers.
+
+    Parameters
+    ----------
+    nside : int, optional
+       HEALPix nside of the map.  Must be between 1024 and 4096.
+         Default is 2048.
+    outfile : str, optional
+       Save the map to this numpy (.npy) file.  It can later be used with
+         loadebvmap(), which memory-maps it.
+    nchunk : int, optional
+       Number of pixels to evaluate at a time.  Default is 1000000.
+
+    Returns
+    -------
+    ebvmap : numpy array
+       The E(B-V) HEALPix map in float32.
+
+    Example
+    -------
+
+    ebvmap = mkebvmap(2048,'sfd_ebv_nside2048.npy')
+
+    """
+    if nside < 1024 or nside > 4096 or hp.isnsideok(nside)==False:
+        raise ValueError('nside must be a power of 2 between 1024 and 4096')
+    sfd = getsfd()
+    npix = hp.nside2npix(nside)
+    if outfile is not None:
+        ebvmap = np.lib.format.open_memmap(outfile,mode='w+',dtype=np.float32,shape=(npix,))
+    else:
+        ebvmap = np.zeros(npix,np.float32)
+    for lo in range(0,npix,nchunk):
+        hi = np.minimum(lo+nchunk,npix)
+        lon,lat = hp.pix2ang(nside,np.arange(lo,hi),lonlat=True)
+        coo = SkyCoord(l=lon,b=lat,frame='galactic',unit='deg')
+        ebvmap[lo:hi] = sfd(coo)
+    if outfile is not None:
+        ebvmap.flush()
+    return ebvmap
+
+
+def loadebvmap(filename=None):
+    """
+    Load a precomputed HEALPix E(B-V) map and use it for all subsequent
+    getebv() lookups in this process.
+
+    Parameters
+    ----------
+    filename : str, optional
+       The numpy (.npy) file created by mkebvmap().  The default is
+         the NSC_EBVMAP environment variable.
+
+    Returns
+    -------
+    ebvmap : numpy array
+       The memory-mapped E(B-V) map, or None if no map was found.
+
+    Example
+    -------
+
+    ebvmap = loadebvmap('sfd_ebv_nside2048.npy')
+
+    """
+    global _ebvmap,_ebvmapfile
+    if filename is None:
+        filename = os.environ.get('NSC_EBVMAP')
+    if filename is None:
+        return None
+    if os.path.exists(filename)==False:
+        raise ValueError(filename+' NOT FOUND')
+    # Memory-map so only the pages we index are read
+    ebvmap = np.load(filename,mmap_mode='r')
+    hp.npix2nside(len(ebvmap))   # check that it is a valid map
+    _ebvmap = ebvmap
+    _ebvmapfile = filename
+    return _ebvmap
+
+
+def getebv(ra,dec,usemap=True):
+    """
+    Get SFD E(B-V) values for an array of coordinates.  A precomputed
+    HEALPix map is used if one was loaded (or is given by NSC_EBVMAP),
+    otherwise the SFD maps are interpolated directly.
+
+    Parameters
+    ----------
+    ra : numpy array or float
+       Right Ascension in degrees.
+    dec : numpy array or float
+       Declination in degrees.
+    usemap : bool, optional
+       Use the precomputed HEALPix map if available.  Default is True.
+
+    Returns
+    -------
+    ebv : numpy array
+       SFD E(B-V) for each position.
+
+    Example
+    -------
+
+    ebv = getebv(cat['ra'],cat['dec'])
+
+    """
+    ra = np.atleast_1d(np.asarray(ra,float))
+    dec = np.atleast_1d(np.asarray(dec,float))
+    if usemap and _ebvmap is None and os.environ.get('NSC_EBVMAP') is not None:
+        loadebvmap()
+    if usemap and _ebvmap is not None:
+        nside = hp.npix2nside(len(_ebvmap))
+        ebv = np.zeros(len(ra),float)+np.nan
+        gd, = np.where(np.isfinite(ra) & np.isfinite(dec))
+        if len(gd) > 0:
+            pix = hp.ang2pix(nside,ra[gd],dec[gd],lonlat=True)
+            ebv[gd] = _ebvmap[pix]
+        return ebv
+    coo = SkyCoord(ra=ra,dec=dec,unit='deg')
+    return np.asarray(getsfd()(coo),float)
+
+
+def exttypekey(cenra,cendec,radius):
+    """ Key used for the extinction type cache, the exact center and radius."""
+    return (float(cenra),float(cendec),float(radius))
+
+
+def getexttypecache(cenra,cendec,radius):
+    """
+    Return the cached extinction type for this region or None.
+
+    Parameters
+    ----------
+    cenra : float
+       Right Ascension at the center of the image.
+    cendec : float
+       Declination at the center of the image.
+    radius : float
+       Radius of the image.
+
+    Returns
+    -------
+    ext_type : int
+       Cached extinction type, or None if this region has not
+         been seen before.
+
+    Example
+    -------
+
+    ext_type = getexttypecache(cenra,cendec,radius)
+
+    """
+    return _exttype_cache.get(exttypekey(cenra,cendec,radius))
+
+
+def setexttypecache(cenra,cendec,radius,ext_type):
+    """ Store the extinction type for this region in the cache."""
+    _exttype_cache[exttypekey(cenra,cendec,radius)] = ext_type
+
+
+def clearcache():
+    """ Clear the SFD object, E(B-V) map and extinction type cache."""
+    global _sfd,_ebvmap,_ebvmapfile
+    _sfd = None
+    _ebvmap = None
+    _ebvmapfile = None
+    _exttype_cache.clear()
@@ -2,304 +2,379 @@
 
 import os
 import re
+import ast
 import time
 import numpy as np
 from astropy.io import fits
 from astropy.table import Table
 from dlnpyutils import utils as dln
 
-def modelmag(tab,instfilt,dec,eqnfile):
+# Compiled model magnitude equations, keyed by equation file
+_eqncache = {}
+
+# AST nodes and operators allowed in the equations
+_binops = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+           ast.Div: np.divide, ast.Pow: np.power, ast.BitAnd: np.logical_and,
+           ast.BitOr: np.logical_or}
+_unaryops = {ast.USub: np.negative, ast.UAdd: np.positive, ast.Invert: np.logical_not}
+_cmpops = {ast.Lt: np.less, ast.LtE: np.less_equal, ast.Gt: np.greater,
+           ast.GtE: np.greater_equal, ast.Eq: np.equal, ast.NotEq: np.not_equal}
+
+def compile_expr(expr,kind='equation'):
     """
-    This calculates the model magnitudes for the NSC catalog
-    given a catalog with the appropriate information
+    Parse and validate a model magnitude equation or quality cut into an
+    AST.  Only column names, numbers, strings, arithmetic, comparisons
+    and &/| are allowed.
 
     Parameters
     ----------
-    tab : table
-       Catalog of sources with appropriate magnitude
-         columns.
-    instfilt : str
-       Short instrument and filter name, e.g. 'c4d-g'.
-    dec : float
-       The declination of the exposure.
-    eqnfile : str
-       File with the model magnitude equations.
+    expr : str
+       The expression, e.g. "0.5*PS_RMAG+0.5*GMAG" or "QFLG='AAA'".
+    kind : str, optional
+       "equation" or "cuts".  Default is "equation".
 
     Returns
     -------
-    model_mag : numpy array
-       An [Nsource,3] array with model magnitudes, errors and color.
+    node : ast node
+       The validated expression tree.
 
     Example
     -------
 
-    model_mag = modelmag(cat,'c4d-g',-50.0,'modelmag_equations.txt')
+    node = compile_expr('JMAG-KMAG-EJK')
 
-    By D. Nidever  Feb 2019
-    Translated to Python by D. Nidever, April 2022
     """
+    expr = expr.strip().upper()
+    if kind=='equation':
+        ## No parentheses allowed
+        if expr.find('(') != -1 or expr.find(')') != -1:
+            raise ValueError('No parentheses allowed in the model magnitude equations')
+        expr = expr.replace('^','**')
+    else:
+        ## single = means equality, and wrap each &/| term so the
+        ##  comparisons bind first
+        expr = re.sub('(?<![<>!=])=(?!=)','==',expr)
+        terms = re.split('([&|])',expr)
+        expr = ''.join([t if t in ['&','|'] else '('+t+')' for t in terms])
+    node = ast.parse(expr,mode='eval').body
+    for n in ast.walk(node):
+        if isinstance(n,(ast.BinOp,ast.UnaryOp,ast.Compare,ast.Name,ast.Load)):
+            pass
+        elif isinstance(n,ast.Constant) and isinstance(n.value,(int,float,str)):
+            pass
+        elif type(n) in _binops or type(n) in _unaryops or type(n) in _cmpops:
+            pass
+        else:
+            raise ValueError('Not allowed in model magnitude expression "'+expr+'": '+type(n).__name__)
+    return node
 
-    # This calculates the model magnitude for stars given the
-    # the magnitudes in reference catalogs
-    # NUV - Galex NUV magnitude
-    # GMAG - Gaia G magnitude
-    # JMAG - 2MASS J magnitude
-    # KMAG - 2MASS Ks magnitude
-    # APASS_GMAG - APASS g magnitue
-    # APASS_RMAG - APASS r magnitude
-    # EBV  - E(B-V) reddening
+def evalnode(node,env):
+    """ Evaluate a compiled expression with the columns in the ENV dictionary."""
+    if isinstance(node,ast.Constant):
+        return node.value
+    if isinstance(node,ast.Name):
+        return env[node.id]
+    if isinstance(node,ast.BinOp):
+        return _binops[type(node.op)](evalnode(node.left,env),evalnode(node.right,env))
+    if isinstance(node,ast.UnaryOp):
+        return _unaryops[type(node.op)](evalnode(node.operand,env))
+    if isinstance(node,ast.Compare):
+        left = evalnode(node.left,env)
+        out = None
+        for op,comp in zip(node.ops,node.comparators):
+            right = evalnode(comp,env)
+            res = _cmpops[type(op)](left,right)
+            out = res if out is None else (out & res)
+            left = right
+        return out
+    raise ValueError(type(node).__name__+' not supported')
 
-    ntab = len(tab)
-    colnames = tab.colnames
-    for n in tab.colnames:
-        tab[n].name = n.upper()
-    tabcols = np.char.array(tab.colnames)
+def exprnames(node):
+    """ Return the column names used in a compiled expression."""
+    return [n.id for n in ast.walk(node) if isinstance(n,ast.Name)]
 
-    ## Load the model magnitude equation information
-    ## band, dec range, color equation, color min/max range, quality cuts, model mag equation
+def _terms(node):
+    """ Split an expression into its top-level additive terms."""
+    if isinstance(node,ast.BinOp) and type(node.op) in [ast.Add,ast.Sub]:
+        return _terms(node.left)+_terms(node.right)
+    if isinstance(node,ast.UnaryOp) and type(node.op) in [ast.USub,ast.UAdd]:
+        return _terms(node.operand)
+    return [node]
+
+def _errterms(node,skip=['EBV']):
+    """
+    Error terms of an equation.  Each additive term with a column in it
+    has its columns X replaced by E_X (and COLOR by COLORERR).  These
+    are added in quadrature.
+    """
+    out = []
+    for t in _terms(node):
+        names = [n for n in exprnames(t) if n not in skip]
+        if len(names)==0:
+            continue
+        t = ast.parse(ast.unparse(t),mode='eval').body   # copy
+        for n in ast.walk(t):
+            if isinstance(n,ast.Name):
+                n.id = 'COLORERR' if n.id=='COLOR' else 'E_'+n.id
+        out.append(t)
+    return out
+
+def _parserange(rstr):
+    """ Parse a "[lo,hi]" range string."""
+    rr = rstr.replace('[','').replace(']','').split(',')
+    return np.array(rr).astype(float)
+
+def loadequations(eqnfile):
+    """
+    Read a model magnitude equation file and compile all of the
+    equations.  The results are cached and only recomputed if the
+    file changes.
+
+    Parameters
+    ----------
+    eqnfile : str
+       File with the model magnitude equations.
+
+    Returns
+    -------
+    eqns : list
+       List of dictionaries with the compiled equations.
+
+    Example
+    -------
+
+    eqns = loadequations('modelmag_equations.txt')
+
+    """
     if os.path.exists(eqnfile)==False:
         raise ValueError(eqnfile+' NOT FOUND')
+    key = os.path.abspath(eqnfile)
+    mtime = os.path.getmtime(eqnfile)
+    if key in _eqncache and _eqncache[key][0]==mtime:
+        return _eqncache[key][1]
     eqnstr = Table.read(eqnfile,format='ascii')
     for c in eqnstr.colnames:
         eqnstr[c].name = c.lower()
-    neqn = len(eqnstr)
-    ## Get COLOR and DEC ranges
-    eqnstr['colorlim'] = np.zeros((len(eqnstr),2),float)
-    eqnstr['declim'] = np.zeros((len(eqnstr),2),float)
+    eqns = []
     for i in range(len(eqnstr)):
-        # Color range
-        cr = np.char.array(eqnstr['colorange'][i].split(','))
-        cr = cr.replace('[','').replace(']','')
-        eqnstr['colorlim'][i] = np.array(cr).astype(float)
-        # DEC range
-        dr = np.char.array(eqnstr['decrange'][i].split(','))
-        dr = dr.replace('[','').replace(']','')
-        eqnstr['declim'][i] = np.array(dr).astype(float)
-
-    ## Get the band for this INSTRUMENT-FILTER and DEC.
-    gd, = np.where((np.char.array(eqnstr['instrument'])+'-'+np.char.array(eqnstr['band']) == instfilt) & 
-                   (dec >= eqnstr['declim'][:,0]) & (dec <= eqnstr['declim'][:,1]))
+        eqn = {'instfilt':str(eqnstr['instrument'][i])+'-'+str(eqnstr['band'][i]),
+               'colorlim':_parserange(str(eqnstr['colorange'][i])),
+               'declim':_parserange(str(eqnstr['decrange'][i])),
+               'coloreqn':str(eqnstr['coloreqn'][i]),
+               'modelmageqn':str(eqnstr['modelmageqn'][i]),
+               'qualitycuts':str(eqnstr['qualitycuts'][i])}
+        eqn['color'] = compile_expr(eqn['coloreqn'])
+        eqn['model'] = compile_expr(eqn['modelmageqn'])
+        eqn['cuts'] = compile_expr(eqn['qualitycuts'],kind='cuts')
+        ## Are we using color?
+        eqn['usecolor'] = not (eqn['colorlim'][0] < -10 and eqn['colorlim'][1] > 10 and
+                               'COLOR' not in exprnames(eqn['model']))
+        ## Get all columns that we need
+        cols = exprnames(eqn['model'])
+        if eqn['usecolor']:
+            cols += exprnames(eqn['color'])
+        cols = list(np.unique([c for c in cols if c!='COLOR']))
+        if len(cols)==0:
+            raise ValueError('No columns to use.')
+        eqn['cols'] = cols
+        ## Magnitude columns that need to be good (<50) and finite
+        eqn['magcols'] = [c for c in cols if (c.endswith('MAG') and not c.startswith('E_')) or c=='NUV']
+        eqn['colorerr'] = _errterms(eqn['color'])
+        eqn['modelerr'] = _errterms(eqn['model'])
+        eqns.append(eqn)
+    _eqncache[key] = (mtime,eqns)
+    return eqns
+
+def getequation(eqnfile,instfilt,dec):
+    """ Return the compiled equation for this INSTRUMENT-FILTER and DEC."""
+    eqns = loadequations(eqnfile)
+    gd = [e for e in eqns if e['instfilt']==instfilt and dec >= e['declim'][0] and dec <= e['declim'][1]]
     if len(gd)==0:
         raise ValueError('No model magnitude equation for INSTRUMENT-FILTER='+instfilt+' and DEC=%.2f' % dec)
     if len(gd) > 1:
         print('Found multiple magnitude equation for INSTRUMENT-FILTER='+instfilt+' and DEC=%.2f. Using the first one' % dec)
-        gd = gd[0]
-    eqnstr1 = eqnstr[gd]
-    eqnstr1 = dict(zip(eqnstr1.colnames, eqnstr1[0]))  # convert to dictionary
-    print("eqnstr1 = ",eqnstr1)
-    ## No parentheses allowed
-    if eqnstr1['coloreqn'].find('(') != -1 or eqnstr1['coloreqn'].find(')') != -1 or \
-       eqnstr1['modelmageqn'].find('(') != -1 or eqnstr1['modelmageqn'].find(')') != -1:
-        raise ValueError('No parentheses allowed in the model magnitude equations')
-    
-    ## Are we using color?
-    if eqnstr1['colorlim'][0] < -10 and eqnstr1['colorlim'][1] > 10 and eqnstr1['modelmageqn'].upper().find('COLOR') == -1:
-        usecolor = False
+    return gd[0]
+
+def _errvalue(tab,tabcols,col):
+    """ Error column, 0.001 if missing and 9.99 if bad."""
+    if col in tabcols:
+        err = np.array(tab[tabcols[col]],float)
     else:
-        usecolor = True
+        ## e.g. PS and Gaia GMAG, leave the errors at 0.001
+        err = np.zeros(len(tab),float)+0.001
+    ## convert NAN or 99.99 to 9.99 to be consistent
+    err[(err > 10.0) | (np.isfinite(err)==False)] = 9.99
+    return err
 
-    ## Get all columns that we need
-    coloreqn = eqnstr1['coloreqn']
-    qualitycuts = eqnstr1['qualitycuts']
-    modelmageqn = eqnstr1['modelmageqn']
-    coloreqn_cols = re.split('[-+*^]',coloreqn)
-    modelmageqn_cols = re.split('[-+*^]',modelmageqn)
+def evalmodelmag(tab,eqn,tabcols=None):
+    """
+    Evaluate a compiled model magnitude equation on a table.
+
+    Parameters
+    ----------
+    tab : table
+       Catalog of sources with appropriate magnitude columns.
+    eqn : dict
+       Compiled equation from getequation().
+    tabcols : dict, optional
+       Mapping of upper-case to actual column names of TAB.
+
+    Returns
+    -------
+    model_mag : numpy array
+       An [Nsource,3] array with model magnitudes, errors and color,
+         or an empty list if there are no good sources.
+
+    Example
+    -------
+
+    model_mag = evalmodelmag(cat,getequation(eqnfile,'c4d-g',-50.0))
+
+    """
+    ntab = len(tab)
+    if tabcols is None:
+        tabcols = {c.upper():c for c in tab.colnames}
+    missing = [c for c in eqn['cols'] if c not in tabcols]
+    if len(missing) > 0:
+        print('Needed columns missing. '+' '.join(missing))
+        return []
+    env = {c:np.asarray(tab[tabcols[c]]) for c in eqn['cols']}
+    for c in exprnames(eqn['cuts']):
+        if c in tabcols and c not in env:
+            env[c] = np.asarray(tab[tabcols[c]])
 
-    if usecolor:
-        cols = np.char.array(coloreqn_cols+modelmageqn_cols).upper()
-    else:
-        cols = np.char.array(modelmageqn_cols).upper()
-
-    ## Remove numbers and "COLOR"
-    isnumeric = np.array([dln.isnumber(c) for c in cols])
-    bd, = np.where(isnumeric | (cols.upper() == 'COLOR') | (cols == '??'))
-    if len(bd)>0:
-        if len(bd) < len(cols):
-            cols = np.delete(cols,bd)
-        else:
-            cols = None
-    ncols = len(cols)
-    ## No columns left
-    if ncols==0:
-        raise ValueError('No columns to use.')
-    ## Only unique columns
-    cols = np.unique(cols)
-    ncols = len(cols)
-    ind1,ind2 = dln.match(tabcols,cols)
-    ntagmatch = len(ind1)
-    if ntagmatch < ncols:
-        leftind = np.arange(ncols)
-        if ntagmatch>0:
-            leftind = np.delete(leftind,ind2)
-        print('Needed columns missing. '+' '.join(cols[leftind]))
-        
     ## Make the color
-    ##  replace the columns by TAB[GD].COLUMN
-    if usecolor:
-        coloreqn_cols = np.char.array(re.split('[-+*^]',coloreqn)).upper()
-        coloreqn_cols = np.unique(coloreqn_cols)  # unique ones
-        bd, = np.where(np.array([dln.isnumber(c) for c in coloreqn_cols]))  ## Remove numbers
-        if len(bd)>0:
-            coloreqn_cols = np.delete(coloreqn_cols,bd)
-        colcmd = coloreqn.upper()
-        for i in range(len(coloreqn_cols)):
-            colcmd = colcmd.replace(coloreqn_cols[i],"tab['"+coloreqn_cols[i]+"']")
-        color = eval(colcmd)
-        color = np.array(color)
+    if eqn['usecolor']:
+        color = np.array(evalnode(eqn['color'],env),float)*np.ones(ntab)
     else:
         color = np.zeros(ntab,float)
+    env['COLOR'] = color
 
     ## Make quality cuts
-    magcolsind, = np.where((dln.find(cols,'MAG$') > -1) & (cols.find('^E_') == -1) | (cols=='NUV'))
-    ## make sure all magnitudes are good (<50) and finite
+    ##  make sure all magnitudes are good (<50) and finite
     goodmask = np.ones(ntab,bool)
-    for i in range(len(magcolsind)):
-        magind, = np.where(tabcols.upper() == cols[magcolsind[i]].upper())
-        if len(magind) == 0:
-            print(cols[magcolsind[i]].upper()+' column NOT found')
-            return []
-        goodmask &= ((tab[tabcols[magind[0]]] < 50) & (tab[tabcols[magind[0]]] > 0) & np.isfinite(tab[tabcols[magind[0]]]))
-
+    for c in eqn['magcols']:
+        goodmask &= ((env[c] < 50) & (env[c] > 0) & np.isfinite(env[c]))
     ## input quality cuts
-    ##  replace <=, <, >, >=, =, &, |
-    qualitycuts = qualitycuts.replace('<=',' <= ')
-    qualitycuts = qualitycuts.replace('>=',' >= ')
-    qualitycuts = qualitycuts.replace('>',' > ')
-    qualitycuts = qualitycuts.replace('<',' < ')
-    qualitycuts = qualitycuts.replace('=',' == ')
-    qualitycuts = qualitycuts.replace('&',' & ')
-    qualitycuts = qualitycuts.replace('|',' | ')
-    ## fix column names
-    qualitycuts_cols = qualitycuts.split()
-    for i in range(len(qualitycuts_cols)):
-        col = qualitycuts_cols[i]
-        colind, = np.where(tabcols==col.upper())
-        if len(colind)>0:
-            qualitycuts = qualitycuts.replace(tabcols[colind[0]],"tab['"+tabcols[colind[0]]+"']")
-    goodmask &= eval(qualitycuts)
-
+    goodmask &= evalnode(eqn['cuts'],env)
     ## Apply the color range
-    if usecolor:
-        goodmask &= ((color >= eqnstr1['colorlim'][0]) & (color <= eqnstr1['colorlim'][1]))
+    if eqn['usecolor']:
+        goodmask &= ((color >= eqn['colorlim'][0]) & (color <= eqn['colorlim'][1]))
     ## Get the sources that pass all cuts
     gd, = np.where(goodmask==True)
     if len(gd)==0:
         print('No good sources left')
         return []
+    envgd = {c:(v[gd] if np.ndim(v)>0 else v) for c,v in env.items()}
 
     # Make the model magnitude
-    ##  replace the columns by TAB[GD].COLUMN
-    modelmageqn_cols = np.char.array(re.split('[-+*^]',modelmageqn)).upper()
-    bd, = np.where(np.array([dln.isnumber(c) for c in modelmageqn_cols]) |
-                   (modelmageqn_cols.upper() == 'COLOR'))  ## Remove numbers and "COLOR"
-    if len(bd)>0:
-        modelmageqn_cols = np.delete(modelmageqn_cols,bd)
-    modelmageqn_cols = np.unique(modelmageqn_cols)  # unique ones
-    magcmd = modelmageqn.upper()
-    for i in range(len(modelmageqn_cols)):
-        magcmd = magcmd.replace(modelmageqn_cols[i],"tab['"+modelmageqn_cols[i]+"'][gd]")
-    magcmd = magcmd.replace('COLOR','COLOR[gd]')
-    modelmag_gd = eval(magcmd)
     modelmag = np.zeros(ntab,float)+99.99
-    modelmag[gd] = modelmag_gd
-
-    ## Make the error structure
-    ##  Each magnitude has an E_MAG error except for PS and Gaia GMAG
-    ## If we are using PS or GMAG then add the errors for the
-    adderrcols = []
-    psmagind, = np.where(((dln.find(cols,'^PS_') > -1) & (dln.find(cols,'MAG$') > -1)) | (dln.find(cols,'GSYNTH_') > -1))
-    if len(psmagind) > 0:
-        adderrcols += list('E_'+cols[psmagind])
-    nadderrcols = len(adderrcols)
-    ## Making error structure
-    errcolind = np.where(dln.find(tabcols,'^E_') > -1)
-    errcols = tabcols[errcolind]
-    errdt = []
-    for i in range(len(errcols)):
-        errdt += [(errcols[i],float)]
-    if nadderrcols > 0:
-        for i in range(nadderrcols):
-            errdt += [(adderrcols[i],float)]
-    err = np.zeros(ntab,dtype=np.dtype(errdt))
-    err = Table(err)
-    for c in err.colnames:
-        err[c] = 0.001
-    for n in err.colnames:
-        if c in tab.colnames:
-            err[n] = tab[n]
-    ## leave the PS errors at 0.001
-    ## convert NAN or 99.99 to 9.99 to be consistent
-    for c in err.colnames:
-        bd = np.where((err[c] > 10.0) | (np.isfinite(err[c]) == False))
-        if len(bd) > 0:
-            err[c][bd] = 9.99
-
-    ## Calculate the color errors
-    ## get the columns
-    if usecolor:
-        colorerr_cols = np.char.array(re.split('[-+*^]',coloreqn)).upper()
-        colorerr_cols = np.unique(colorerr_cols)  # unique ones
-        bd, = np.where(np.array([dln.isnumber(c) for c in colorerr_cols]) |
-                       (colorerr_cols.upper() == 'EBV'))  ## Remove numbers and "EBV"
-        if len(bd)>0:
-            colorerr_cols = np.delete(colorerr_cols,bd)
-        ## use - and + signs to break apart the components that need to be squared
-        coloreqn_terms = np.char.array(re.split('[-+]',coloreqn)).upper()
-        ## remove any terms that don't have a COLORERR_COLS in them
-        okay = np.zeros(len(coloreqn_terms),bool)
-        for i in range(len(coloreqn_terms)):
-            for j in range(len(colorerr_cols)):
-                okay[i] |= (coloreqn_terms[i].find(colorerr_cols[j]) > -1)
-        bd, = np.where(okay == False)
-        if len(bd) > 0:
-            coloreqn_terms = np.delete(coloreqn_terms,bd)
-        ## Now create the equation, add in quadrature
-        colorerrcmd = 'np.sqrt( '+ '+'.join('('+coloreqn_terms.upper()+')**2') +' )'
-        #colorerrcmd = colorerrcmd.upper()
-        for i in range(len(colorerr_cols)):
-            colorerrcmd = colorerrcmd.replace(colorerr_cols[i],"err['E_"+colorerr_cols[i]+"'][gd]")
-        colorerr_gd = eval(colorerrcmd)
-        colorerr = np.zeros(ntab,float)+9.99
-        colorerr[gd] = colorerr_gd
+    modelmag[gd] = evalnode(eqn['model'],envgd)
+
+    ## Make the error columns
+    for t in eqn['colorerr']+eqn['modelerr']:
+        for c in exprnames(t):
+            if c!='COLORERR' and c not in envgd:
+                envgd[c] = _errvalue(tab,tabcols,c)[gd]
+
+    ## Calculate the color errors, add terms in quadrature
+    if eqn['usecolor'] and len(eqn['colorerr']) > 0:
+        colorerr_gd = np.sqrt(np.sum([np.asarray(evalnode(t,envgd),float)**2 for t in eqn['colorerr']],axis=0))
     else:
-        colorerr = np.zeros(ntab,float)
+        colorerr_gd = np.zeros(len(gd),float)
+    envgd['COLORERR'] = colorerr_gd
 
     ## The modelmag errors
-    ## get the columns
-    modelmagerr_cols = np.char.array(re.split('[-+*^]',modelmageqn)).upper()
-    modelmagerr_cols = np.unique(modelmagerr_cols)  # unique ones
-    bd, = np.where(np.array([dln.isnumber(c) for c in modelmagerr_cols]) |
-                   (modelmagerr_cols.upper() == 'EBV'))  ## Remove numbers and "EBV"
-    if len(bd)>0:
-        modelmagerr_cols = np.delete(modelmagerr_cols,bd)
-    ##   use - and + signs to break apart the components that need to be  squared
-    modelmageqn_terms = np.char.array(re.split('[-+]',modelmageqn)).upper()
-    ## remove any terms that don't have a COLORERR_COLS in them
-    okay = np.zeros(len(modelmageqn_terms),bool)
-    for i in range(len(modelmageqn_terms)):
-        for j in range(len(modelmagerr_cols)):
-            okay[i] |= (modelmageqn_terms[i].find(modelmagerr_cols[j]) > -1)
-    bd, = np.where(okay == False)
-    if len(bd) > 0:
-        modelmageqn_terms = np.delete(modelmageqn_terms,bd)
-    ## Now create the equation, add in quadrature 
-    modelmagerrcmd = 'np.sqrt( '+ '+'.join('('+modelmageqn_terms+')**2') +' )'
-    for i in range(len(modelmageqn_cols)):
-        modelmagerrcmd = modelmagerrcmd.replace(modelmageqn_cols[i],"err['E_"+modelmageqn_cols[i].upper()+"'][gd]")
-    modelmagerrcmd = modelmagerrcmd.replace('COLOR','COLORERR[gd]')
-    modelmagerr_gd = eval(modelmagerrcmd)
     modelmagerr = np.zeros(ntab,float)+99.90
-    modelmagerr[gd] = modelmagerr_gd
+    if len(eqn['modelerr']) > 0:
+        modelmagerr[gd] = np.sqrt(np.sum([np.asarray(evalnode(t,envgd),float)**2 for t in eqn['modelerr']],axis=0))
+    else:
+        modelmagerr[gd] = 0.0
 
-    ## combine modelmag and modelmagerr
     ## Combine mags and errors
-    mags = np.zeros((len(tab),3),float)
+    mags = np.zeros((ntab,3),float)
     mags[:,0] = modelmag
     mags[:,1] = modelmagerr
     mags[:,2] = color
-
-    # Change back to original column names
-    for n in colnames:
-        tab[n.upper()].name = n
-    
     return mags
+
+def modelmag(tab,instfilt,dec,eqnfile):
+    """
+    This calculates the model magnitudes for the NSC catalog
+    given a catalog with the appropriate information
+
+    Parameters
+    ----------
+    tab : table
+       Catalog of sources with appropriate magnitude
+         columns.
+    instfilt : str
+       Short instrument and filter name, e.g. 'c4d-g'.
+    dec : float
+       The declination of the exposure.
+    eqnfile : str
+       File with the model magnitude equations.
+
+    Returns
+    -------
+    model_mag : numpy array
+       An [Nsource,3] array with model magnitudes, errors and color.
+
+    Example
+    -------
+
+    model_mag = modelmag(cat,'c4d-g',-50.0,'modelmag_equations.txt')
+
+    By D. Nidever  Feb 2019
+    Translated to Python by D. Nidever, April 2022
+    """
+
+    # This calculates the model magnitude for stars given the
+    # the magnitudes in reference catalogs
+    # NUV - Galex NUV magnitude
+    # GMAG - Gaia G magnitude
+    # JMAG - 2MASS J magnitude
+    # KMAG - 2MASS Ks magnitude
+    # APASS_GMAG - APASS g magnitue
+    # APASS_RMAG - APASS r magnitude
+    # EBV  - E(B-V) reddening
+
+    ## Load the model magnitude equation information
+    ## band, dec range, color equation, color min/max range, quality cuts, model mag equation
+    ##  the equations are parsed and compiled once per file
+    eqn = getequation(eqnfile,instfilt,dec)
+    return evalmodelmag(tab,eqn)
+
+def modelmags(tab,instfilts,dec,eqnfile):
+    """
+    Calculate model magnitudes for several instrument-filter combinations
+    at once.
+
+    Parameters
+    ----------
+    tab : table
+       Catalog of sources with appropriate magnitude columns.
+    instfilts : list
+       List of short instrument and filter names, e.g. ['c4d-g','c4d-r'].
+    dec : float
+       The declination of the exposure.
+    eqnfile : str
+       File with the model magnitude equations.
+
+    Returns
+    -------
+    model_mags : dict
+       Dictionary of [Nsource,3] model magnitude arrays for each
+         instrument-filter.
+
+    Example
+    -------
+
+    model_mags = modelmags(cat,['c4d-g','c4d-r'],-50.0,'modelmag_equations.txt')
+
+    """
+    tabcols = {c.upper():c for c in tab.colnames}
+    out = {}
+    for instfilt in instfilts:
+        out[instfilt] = evalmodelmag(tab,getequation(eqnfile,instfilt,dec),tabcols=tabcols)
+    return out
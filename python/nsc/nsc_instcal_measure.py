@@ -23,6 +23,7 @@ import numpy as np
 import os
 import re
 from scipy.ndimage import convolve
+from scipy.spatial import cKDTree
 #from scipy.ndimage.filters import convolve
 import shutil
 import socket
@@ -32,8 +33,11 @@ import sys
 import time
 import warnings
 import requests
+import traceback
+import multiprocessing
+import tempfile
 from dlnpyutils.utils import *
-from . import phot,slurm_funcs,utils
+from . import phot,daosession,slurm_funcs,utils
 
 # Ignore these warnings, it's a bug
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
@@ -50,12 +54,141 @@ else:
 # Functions
 #-------------------------------------------------
 
+def chipworkers(nchips,ncpu=None,chipmem=1.0):
+    """
+    Number of chips to process at once, bounded by the number of cores
+    and by the memory that is currently available.
+
+    Parameters
+    ----------
+    nchips : int
+       Number of chips to process.
+    ncpu : int, optional
+       Maximum number of worker processes.  Default is the number of cores.
+    chipmem : float, optional
+       Approximate memory needed to process one chip in GB.  Default is 1.0.
+
+    Returns
+    -------
+    nworkers : int
+       The number of worker processes to use.
+
+    Example
+    -------
+
+    nworkers = chipworkers(61,ncpu=16)
+
+    """
+    if ncpu is None:
+        ncpu = os.cpu_count() or 1
+    nworkers = np.min([ncpu,nchips])
+    try:
+        availmem = os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')/1e9
+        nworkers = np.min([nworkers,int(availmem/chipmem)])
+    except (ValueError,OSError,AttributeError):
+        pass
+    return int(np.maximum(nworkers,1))
+
+
+def chipscratch(workdir,name,diskgb=0.5):
+    """
+    Create the scratch directory that a chip is staged and processed in.
+    RAM-backed storage (the NSC_SCRATCH environment variable or /dev/shm)
+    is used if it has enough free space, otherwise a subdirectory of the
+    exposure working directory.
+
+    Parameters
+    ----------
+    workdir : str
+       The exposure working directory.
+    name : str
+       Name of the chip scratch directory.
+    diskgb : float, optional
+       Approximate scratch space needed for one chip in GB.  Default is 0.5.
+
+    Returns
+    -------
+    chipdir : str
+       The absolute path of the new scratch directory.
+
+    Example
+    -------
+
+    chipdir = chipscratch(workdir,'c4d_160825_043133_ooi_z_v1_chip1')
+
+    """
+    roots = []
+    if os.environ.get('NSC_SCRATCH') is not None:
+        roots.append(os.environ['NSC_SCRATCH'])
+    roots.append('/dev/shm')
+    for root in roots:
+        try:
+            if os.path.isdir(root) and os.access(root,os.W_OK):
+                st = os.statvfs(root)
+                if st.f_bavail*st.f_frsize/1e9 > diskgb:
+                    return tempfile.mkdtemp(prefix=name+'.',dir=root)
+        except OSError:
+            pass
+    chipdir = os.path.join(workdir,name)
+    if os.path.exists(chipdir): shutil.rmtree(chipdir)
+    os.makedirs(chipdir)
+    return chipdir
+
+
+def _processchip(pars):
+    """ Process one chip of an exposure in its own scratch subdirectory.
+        This is run in a worker process by Exposure.process()."""
+    exp,extension = pars
+    t0 = time.time()
+    chipdir = chipscratch(exp.workdir,exp.base+'_chip'+str(extension),exp.chipdisk)
+    chiplogfile = os.path.join(exp.workdir,exp.base+'_chip'+str(extension)+'.log')
+    # The DAOPHOT tools read their option files from the
+    #  current directory, so each chip gets its own
+    os.chdir(chipdir)
+    logger = logging.getLogger('nsc_instcal_measure.chip'+str(extension))
+    logger.propagate = False
+    handler = logging.FileHandler(chiplogfile,mode='w')
+    handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.NOTSET)
+    exp.logger = logger
+    success = False
+    ccdnum = None
+    bl = False
+    timer = utils.StageTimer()
+    try:
+        with timer('chip'):
+            logger.info(" ")
+            logger.info("=== Processing subimage "+str(extension)+" ===")
+            with timer('loadchip'):
+                bl = exp.loadchip(extension)
+            if bl==True:
+                ccdnum = exp.chip.ccdnum
+                logger.info("CCDNUM = "+str(ccdnum))
+                exp.chip.process()
+                with exp.chip.timer('cleanup'):
+                    exp.chip.cleanup()
+                success = True
+    except:
+        logger.error(traceback.format_exc())
+    rows = timer.rows
+    if bl==True: rows += exp.chip.timer.rows
+    dt = time.time()-t0
+    logger.info("dt = "+str(dt)+" seconds")
+    handler.close()
+    logger.removeHandler(handler)
+    os.chdir(exp.workdir)
+    shutil.rmtree(chipdir,ignore_errors=True)
+    return extension,ccdnum,success,dt,chiplogfile,rows
+
+
 
 # Class to represent an exposure to process
 class Exposure:
 
     # Initialize Exposure object
-    def __init__(self,fluxfile,wtfile,maskfile,nscversion,host,delete=False):
+    def __init__(self,fluxfile,wtfile,maskfile,nscversion,host,delete=False,ncpu=1,chipmem=1.0,chipdisk=0.5,
+                 direct=False,aperphot='daophot',usesession=False,prefwhm=False,apcormethod='daogrow'):
         # Check that the files exist
         if os.path.exists(fluxfile) is False:
             print(fluxfile+" NOT found")
@@ -67,6 +200,16 @@ class Exposure:
             print(maskfile+" NOT found")
             return
         self.delete = delete  # delete original files
+        self.ncpu = ncpu      # maximum number of chips to process at once
+        self.chipmem = chipmem  # approximate memory (GB) needed per chip
+        self.chipdisk = chipdisk  # approximate scratch space (GB) needed per chip
+        self.chiplogfiles = []  # per-chip logs from parallel processing
+        self.direct = direct    # read HDUs directly from the original files, no copy
+        self.hduindex = {}      # HDU byte ranges of the working files
+        self.aperphot = aperphot  # aperture photometry code, 'daophot' or 'sep'
+        self.usesession = usesession  # run the DAOPHOT steps in one persistent DAOPHOT process per chip
+        self.prefwhm = prefwhm  # estimate the FWHM and PSF stars with sep instead of from the SE catalog/PICKPSF
+        self.apcormethod = apcormethod  # curve of growth code, 'daogrow' or 'python'
         # Setting up the object properties
         self.origfluxfile = fluxfile
         self.origwtfile = wtfile
@@ -86,6 +229,7 @@ class Exposure:
         self.keepdir = None     # where to keep the final files before bundling
         self.outdir = None
         self.chip = None
+        self.sexconfigdir = None  # SExtractor config directory shared by all chips, set by setup()
 
         # Get instrument
         head0 = fits.getheader(fluxfile,0)
@@ -111,6 +255,8 @@ class Exposure:
         basedir,tmpdir = utils.getnscdirs(nscversion,self.host)
         self.outdir = os.path.join(basedir,self.instrument,self.night[:4],
                                    self.night,self.base)
+        # Per-stage time and resource usage, for the exposure and all chips
+        self.timer = utils.StageTimer(exposure=self.base,instrument=self.instrument)
         
     # Setup
     def setup(self):
@@ -174,6 +320,13 @@ class Exposure:
             shutil.move(self.origmaskfile,newmaskfile)
             self.origmaskfile = newmaskfile
             os.symlink(os.path.basename(self.origmaskfile),maskfile)
+        elif self.direct:
+            # Only the bytes of each chip's HDU are read later on
+            #  calibrate() gets the original filenames from these lines
+            self.logger.info("Copying InstCal images skipped, reading HDUs directly from the original files")
+            self.logger.info("  "+self.origfluxfile)
+            self.logger.info("  "+self.origwtfile)
+            self.logger.info("  "+self.origmaskfile)
         else:
             if self.host=="gp09" or self.host=="gp07":
                 self.logger.info("Copying InstCal images from mass store archive")
@@ -193,11 +346,28 @@ class Exposure:
             if (os.path.basename(self.origmaskfile) != maskfile):
                 os.symlink(os.path.basename(self.origmaskfile),maskfile)
 
-        # Set local working filenames
-        self.fluxfile = fluxfile
-        self.wtfile = wtfile
-        self.maskfile = maskfile
+        # Set local working filenames, the chips are processed in
+        #  other directories so use absolute paths
+        if self.direct and not self.delete:
+            self.fluxfile = os.path.abspath(self.origfluxfile)
+            self.wtfile = os.path.abspath(self.origwtfile)
+            self.maskfile = os.path.abspath(self.origmaskfile)
+        else:
+            self.fluxfile = os.path.join(tmpdir,fluxfile)
+            self.wtfile = os.path.join(tmpdir,wtfile)
+            self.maskfile = os.path.join(tmpdir,maskfile)
+        # Index the HDU byte ranges so each chip only reads its own HDU
+        for f in [self.fluxfile,self.wtfile,self.maskfile]:
+            try:
+                self.hduindex[f] = utils.fitsindex(f)
+            except:
+                self.logger.warning("Could not index the HDUs of "+f)
         
+        # Stage the SExtractor config files once for all chips
+        configdir = os.path.join(basedir,"config")
+        if os.path.exists(configdir):
+            self.sexconfigdir = phot.sexconfig(configdir,cachedir=tmpdir,logger=self.logger)
+
         # Make final output directory
         if not os.path.exists(self.outdir):
             os.makedirs(self.outdir)   # will make multiple levels of directories if necessary
@@ -213,11 +383,12 @@ class Exposure:
             self.logger.warning("Local working filenames not set.  Make sure to run setup() first")
             return(False)
         try:
-            flux,fhead = fits.getdata(self.fluxfile,extension,header=True)
-            fhead0 = fits.getheader(self.fluxfile,0)  # add PDU info
+            # Each HDU is only read and decompressed once, here
+            flux,fhead = utils.readhdu(self.fluxfile,extension,self.hduindex.get(self.fluxfile))
+            dum,fhead0 = utils.readhdu(self.fluxfile,0,self.hduindex.get(self.fluxfile))  # add PDU info
             fhead.extend(fhead0,unique=True)
-            wt,whead = fits.getdata(self.wtfile,extension,header=True)
-            mask,mhead = fits.getdata(self.maskfile,extension,header=True)
+            wt,whead = utils.readhdu(self.wtfile,extension,self.hduindex.get(self.wtfile))
+            mask,mhead = utils.readhdu(self.maskfile,extension,self.hduindex.get(self.maskfile))
         except:
             self.logger.error("No extension "+str(extension))
             return(False)
@@ -244,6 +415,11 @@ class Exposure:
         self.chip.nscversion = self.nscversion
         self.chip.outdir = self.outdir
         self.chip.keepdir = self.keepdir
+        self.chip.aperphot = self.aperphot
+        self.chip.usesession = self.usesession
+        self.chip.prefwhm = self.prefwhm
+        self.chip.apcormethod = self.apcormethod
+        self.chip.sexconfigdir = self.sexconfigdir
         # Add logger information
         self.chip.logger = self.logger
         return True
@@ -254,37 +430,97 @@ class Exposure:
         self.logger.info("Processing ALL extension images")
         self.logger.info("-------------------------------------------------")
 
+        # Process the chips in parallel
+        nworkers = 1
+        if self.ncpu is None or self.ncpu > 1:
+            nworkers = chipworkers(self.nexten-1,self.ncpu,self.chipmem)
+        if nworkers > 1:
+            self.processparallel(nworkers)
+            return
+
         # LOOP through the HDUs/chips
         #----------------------------
         #for i in [int(sys.argv[6])]: #ktedit:createpsf_test,  only analyze 1 chip!
+        nfail = 0
         for i in range(1,self.nexten):
             t0 = time.time()
             self.logger.info(" ")
             self.logger.info("=== Processing subimage "+str(i)+" ===")
-            # Load the chip
-            bl = self.loadchip(i)
-            self.logger.info("CCDNUM = "+str(self.chip.ccdnum))
-            if bl==True:
-                # Process it
-                self.chip.process()
-                # Clean up
-                self.chip.cleanup()
+            # Stage the chip in its own (RAM-backed if possible) scratch directory
+            chipdir = chipscratch(self.workdir,self.base+'_chip'+str(i),self.chipdisk)
+            os.chdir(chipdir)
+            bl = False
+            success = False
+            try:
+                with self.timer('chip',extension=i):
+                    # Load the chip
+                    with self.timer('loadchip',extension=i):
+                        bl = self.loadchip(i)
+                    if bl==True:
+                        self.logger.info("CCDNUM = "+str(self.chip.ccdnum))
+                        # Process it
+                        self.chip.process()
+                        # Clean up
+                        with self.chip.timer('cleanup'):
+                            self.chip.cleanup()
+                        success = True
+            except Exception:
+                # Keep going with the other chips, like processparallel()
+                self.logger.error(traceback.format_exc())
+            finally:
+                if success==False:
+                    nfail += 1
+                if bl==True:
+                    self.timer.extend(self.chip.timer.rows,extension=i,ccdnum=self.chip.ccdnum)
+                os.chdir(self.workdir)
+                shutil.rmtree(chipdir,ignore_errors=True)
             self.logger.info("dt = "+str(time.time()-t0)+" seconds")
-            if 2==1:
-                chiptimes = Table.read(basedir+'lists/nsc_dr3_chiptimes.fits')
-                chiptimes.add_row([(str(self.fluxfile).strip().split('/')[-1]).split('.')[0],i,
-                                   int(self.chip.ccdnum),int(nsrc),int(t1_check-t0)])
-                chiptimes = Table(np.unique(chiptimes))
-                chiptimes.write(basedir+'lists/nsc_dr3_chiptimes.fits',overwrite=True)
+        if nfail > 0:
+            self.logger.warning(str(nfail)+" chips failed")
+
+    # Process the chips in parallel, each in its own scratch subdirectory
+    def processparallel(self,nworkers):
+        self.logger.info("Processing "+str(self.nexten-1)+" chips with "+str(nworkers)+" worker processes")
+        # The logger does not get pickled with the object
+        logger = self.logger
+        self.logger = None
+        pars = [(self,i) for i in range(1,self.nexten)]
+        ctx = multiprocessing.get_context('spawn')
+        results = []
+        try:
+            with ctx.Pool(nworkers) as pool:
+                for res in pool.imap_unordered(_processchip,pars):
+                    extension,ccdnum,success,dt,chiplogfile,rows = res
+                    logger.info("Subimage {:d} CCDNUM={:} success={:} dt={:.1f} seconds".format(extension,ccdnum,success,dt))
+                    self.timer.extend(rows,extension=extension,ccdnum=ccdnum)
+                    results.append(res)
+        finally:
+            self.logger = logger
+        results.sort(key=lambda r:r[0])
+        self.chiplogfiles = [r[4] for r in results]
+        nfail = np.sum([r[2]==False for r in results])
+        if nfail > 0:
+            self.logger.warning(str(nfail)+" chips failed")
 
     # Teardown
     def teardown(self):
+        # Merge the per-chip logs into the exposure log
+        if len(self.chiplogfiles) > 0:
+            for h in self.logger.handlers: h.flush()
+            with open(self.logfile,'a') as f:
+                for chiplogfile in self.chiplogfiles:
+                    if os.path.exists(chiplogfile):
+                        with open(chiplogfile,'r') as fc:
+                            f.write(fc.read())
         # Move the final log file
         shutil.move(self.logfile,os.path.join(self.keepdir,self.base+".log"))
         # Bundle files in the "keep" directory
-        utils.concatmeas(self.keepdir,self.base)
+        with self.timer('concatmeas'):
+            utils.concatmeas(self.keepdir,self.base)
+        # Write the stage telemetry table
+        self.timer.write(os.path.join(self.keepdir,self.base+'_telemetry.fits'))
         # Move the final bundled files
-        finalfiles = [os.path.join(self.keepdir,self.base+f) for f in ['_meas.fits','.tgz','.log']]
+        finalfiles = [os.path.join(self.keepdir,self.base+f) for f in ['_meas.fits','_header.fits','_telemetry.fits','.tgz','.log']]
         for f in finalfiles:
             if os.path.exists(f):
                 self.logger.info('Moving '+f+' to '+self.outdir)
@@ -320,8 +556,10 @@ class Exposure:
 
     # RUN all steps to process this exposure
     def run(self):
-        self.setup()
-        self.process()
+        with self.timer('setup'):
+            self.setup()
+        with self.timer('process'):
+            self.process()
         self.teardown()
 
 def fixdecamheader(header):
@@ -364,6 +602,9 @@ class Chip:
         self.daofile = self.dir+"/"+self.base+"_dao.fits"
         self.sexcatfile = None
         self.sexcat = None
+        self.sexconfigdir = None  # shared SExtractor config directory, set by Exposure.setup() or runsex()
+        self.alscat = None        # ALLSTAR catalog of all iterations, set by allstar() and combine_cats()
+        self.newalscat = None     # ALLSTAR catalog of the current iteration
         self.seeing = None
         self.apcorr = None
         #-----------------------------------------------------------#ktedit:sex2 T
@@ -389,6 +630,13 @@ class Chip:
         #self._sexmaglim2 = None   #ktedit:sex2; set by runsex() when run on ALLSTAR PSF-subtracted image
         #self._daomaglim2 = None   #ktedit:sex2; set by daoaperphot() when run on 2nd SExtractor cat
         self.sexiter = 1          #ktedit:sex2; to keep track of which SExtractor run we're on
+        self.aperphot = 'daophot' # aperture photometry code, 'daophot' (PHOTOMETRY) or 'sep' (phot.sepaperphot)
+        self.usesession = False   # run the DAOPHOT steps in one persistent DAOPHOT process
+        self.daosession = None    # the DaophotSession, set by startdaosession()
+        self.prefwhm = False      # estimate the FWHM and PSF stars with sep instead of from the SE catalog
+        self.psfcands = None      # PSF candidates, set by sepfwhm()
+        self.apcormethod = 'daogrow'  # curve of growth code, 'daogrow' (DAOGROW) or 'python' (phot.curveofgrowth)
+        self.timer = utils.StageTimer()  # per-stage time and resource usage
         # Logger
         self.logger = None
     
@@ -637,9 +885,11 @@ class Chip:
         #--------------------------------------------------------------------------------------------ktedit:sex2 B
         basedir, tmpdir = utils.getnscdirs(self.nscversion,self.host)
         configdir = basedir+"config/"
+        if self.sexconfigdir is None:
+            self.sexconfigdir = phot.sexconfig(configdir,logger=self.logger)
         sexcat, maglim = phot.runsex(infile,self.wtfile,self.maskfile,meta,sexcatfile,configdir,
                                      offset=offset,sexiter=self.sexiter,dthresh=dthresh,
-                                     logger=self.logger,bindir=self.bindir) #ktedit:sex2
+                                     logger=self.logger,bindir=self.bindir,sexdir=self.sexconfigdir) #ktedit:sex2
         #--------------------------------------------------------------------------------------------ktedit:sex2 T
         sexcat.add_column(np.repeat(self.sexiter,len(sexcat)),name="NDET_ITER") # keep track of what SExtractor iteration each source is from
         sexcat.add_column(np.zeros(len(sexcat)),name="REPEAT")                  # keep track of sources that were detected in multiple iterations
@@ -647,40 +897,35 @@ class Chip:
         #  0 = source only detected once
         #  1 = source detected in multiple iterations (all iterations but last), will be removed from sexcat
         #  2 = source detected in multiple iterations (last iteration source was detected in)
-        temp_sexcat = Table.read(sexcatfile,2)
-        temp_sexcat.add_column(np.repeat(self.sexiter,len(temp_sexcat)),name="NDET_ITER")
-        temp_sexcat.add_column(np.zeros(len(temp_sexcat)),name="REPEAT")
-        temp_sexcat.write(sexcatfile,overwrite=True)
+        #  the catalogs of all iterations are combined in memory in self.sexcat, the files are not rewritten
         # --If first SExtractor iteration, define cat
         if self.sexiter==1:
             self.sexcatfile = sexcatfile
             self.sexcat = sexcat
             self._sexmaglim = maglim
-            # Set the FWHM as well
-            fwhm = phot.sexfwhm(sexcat,logger=self.logger)
-            self.meta['FWHM'] = fwhm
+            # Set the FWHM as well, unless sepfwhm() already did
+            if self.psfcands is None:
+                fwhm = phot.sexfwhm(sexcat,logger=self.logger)
+                self.meta['FWHM'] = fwhm
         # --If 2nd+ SExtractor iteration, compare sources with
         # those from previous iteration and combine catalogs 
         else: 
             sexcat = vstack([self.sexcat,sexcat])
             # lastsex -> newsexcat, restsex -> prevsexcat   
-            newsexcat = sexcat[sexcat['NDET_ITER']==self.sexiter]
-            prevsexcat = sexcat[sexcat['NDET_ITER']==(self.sexiter-1)]
-            for newsource in newsexcat:
-                dpix = 2
-                prevsexcat_close = prevsexcat[(prevsexcat['X_IMAGE']<(newsource['X_IMAGE']+dpix)) & 
-                                              (prevsexcat['X_IMAGE']>(newsource['X_IMAGE']-dpix)) & 
-                                              (prevsexcat['Y_IMAGE']<(newsource['Y_IMAGE']+dpix)) & 
-                                              (prevsexcat['Y_IMAGE']>(newsource['Y_IMAGE']-dpix))]
-                if len(prevsexcat_close)>0:
-                    for oldsource in prevsexcat_close:
-                        d_btwn_centers = np.sqrt((newsource['X_IMAGE']-oldsource['X_IMAGE'])**2 + 
-                                                 (newsource['Y_IMAGE']-oldsource['Y_IMAGE'])**2)
-                        if d_btwn_centers <= dpix:
-                            old_repeat_index = int(np.where(sexcat['NUMBER']==oldsource['NUMBER'])[0])
-                            new_repeat_index = int(np.where(sexcat['NUMBER']==newsource['NUMBER'])[0])
-                            sexcat[old_repeat_index]['REPEAT'] = 1
-                            sexcat[new_repeat_index]['REPEAT'] = 2
+            newind, = np.where(sexcat['NDET_ITER']==self.sexiter)
+            prevind, = np.where(sexcat['NDET_ITER']==(self.sexiter-1))
+            # all new/previous pairs within dpix of each other
+            dpix = 2
+            xnew,ynew = np.array(sexcat['X_IMAGE'][newind]),np.array(sexcat['Y_IMAGE'][newind])
+            xprev,yprev = np.array(sexcat['X_IMAGE'][prevind]),np.array(sexcat['Y_IMAGE'][prevind])
+            close = cKDTree(np.vstack((xprev,yprev)).T).query_ball_point(np.vstack((xnew,ynew)).T,dpix)
+            inew = np.repeat(np.arange(len(newind)),[len(c) for c in close])
+            iprev = np.concatenate(close).astype(int) if len(inew)>0 else np.zeros(0,int)
+            pair = (np.abs(xnew[inew]-xprev[iprev])<dpix) & (np.abs(ynew[inew]-yprev[iprev])<dpix)
+            repeat = np.array(sexcat['REPEAT'])
+            repeat[newind[inew[pair]]] = 2
+            repeat[prevind[iprev[pair]]] = 1
+            sexcat['REPEAT'] = repeat
             self.sexcat = sexcat[sexcat['REPEAT']!=1]
 
         #--------------------------------------------------------------------------------------------ktedit:sex2 B
@@ -701,6 +946,21 @@ class Chip:
         psfcat = phot.sexpickpsf(self.sexcat,fwhm,self.meta,base+".lst",
                                  nstars=nstars,logger=self.logger)
 
+    # Determine FWHM and PSF candidates with sep
+    #-------------------------------------------
+    #  quick estimate from the bright stars, used instead of the FWHM
+    #  from the SExtractor catalog and DAOPHOT PICKPSF.  The first
+    #  SExtractor pass still runs, it gives the detection catalog
+    def sepfwhm(self,nstars=500):
+        fwhm, psfcat = phot.sepfwhm(self.fluxfile,self.maskfile,self.meta,nstars=nstars,
+                                    logger=self.logger)
+        if fwhm is None:
+            self.logger.info("sep FWHM failed.  Using the SExtractor FWHM")
+            return
+        self.meta['FWHM'] = fwhm
+        self.seeing = fwhm
+        self.psfcands = psfcat
+
     # Make DAOPHOT option files
     #--------------------------
     #def mkopt(self,**kwargs):
@@ -719,10 +979,25 @@ class Chip:
     def daofind(self):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        cat = phot.daofind(self.daofile,outfile=daobase+".coo",logger=self.logger,bindir=self.bindir)
+        cat = phot.daofind(self.daofile,outfile=daobase+".coo",logger=self.logger,bindir=self.bindir,
+                           session=self.daosession)
+
+    # Persistent DAOPHOT session
+    #---------------------------
+    #  the DAOPHOT steps run in one DAOPHOT process that keeps the image attached
+    def startdaosession(self):
+        self.stopdaosession()
+        self.logger.info("Starting persistent DAOPHOT session")
+        self.daosession = daosession.DaophotSession(bindir=self.bindir,logger=self.logger)
+
+    def stopdaosession(self):
+        if self.daosession is not None:
+            self.daosession.close()
+            self.daosession = None
 
     # DAOPHOT aperture photometry
     #----------------------------
+    #  uses DAOPHOT PHOTOMETRY or phot.sepaperphot depending on self.aperphot
     def daoaperphot(self):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
@@ -735,8 +1010,13 @@ class Chip:
             coofile = daobase+str(self.sexiter)+".coo"
             outfile = daobase+str(self.sexiter)+".ap"
         #----------------------------------------------------------------#ktedit:sex2 B
-        apcat, maglim = phot.daoaperphot(imfile,coofile,outfile=outfile,optfile=daobase+".opt",
-                                         logger=self.logger,bindir=self.bindir) #ktedit:sex2
+        if self.aperphot=='sep':
+            apcat, maglim = phot.sepaperphot(imfile,coofile,outfile=outfile,optfile=daobase+".opt",
+                                             logger=self.logger)
+        else:
+            apcat, maglim = phot.daoaperphot(imfile,coofile,outfile=outfile,optfile=daobase+".opt",
+                                             logger=self.logger,bindir=self.bindir,
+                                             session=self.daosession) #ktedit:sex2
         #self._daomaglim = maglim
         if self.sexiter==1: self._daomaglim = maglim #ktedit:sex2
         #else: self._daomaglim2 = maglim            #ktedit:sex2
@@ -747,8 +1027,15 @@ class Chip:
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
         if maglim is None: maglim=self.maglim
+        # Use the sep candidates if we have enough of them
+        if self.psfcands is not None:
+            psfcat = phot.seppickpsf(self.psfcands,daobase+".ap",daobase+".lst",maglim,
+                                     nstars,logger=self.logger)
+            if psfcat is not None and len(psfcat)>=10:
+                return
+            self.logger.info("Too few sep PSF stars.  Using DAOPHOT PICKPSF")
         psfcat = phot.daopickpsf(self.daofile,daobase+".ap",maglim,daobase+".lst",nstars,
-                                 logger=self.logger,bindir=self.bindir)
+                                 logger=self.logger,bindir=self.bindir,session=self.daosession)
 
     # Run DAOPHOT PSF
     #-------------------
@@ -756,7 +1043,8 @@ class Chip:
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
         psfcat = phot.daopsf(self.daofile,daobase+".lst",outfile=daobase+".psf",
-                             verbose=verbose,logger=self.logger,bindir=self.bindir)
+                             verbose=verbose,logger=self.logger,bindir=self.bindir,
+                             session=self.daosession)
 
     # Subtract neighbors of PSF stars
     #--------------------------------
@@ -764,14 +1052,16 @@ class Chip:
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
         psfcat = phot.subpsfnei(self.daofile,daobase+".lst",daobase+".nei",
-                                daobase+"a.fits",logger=self.logger,bindir=self.bindir)
+                                daobase+"a.fits",logger=self.logger,bindir=self.bindir,
+                                session=self.daosession)
 
     # Create DAOPHOT PSF
     #-------------------
     def createpsf(self,listfile=None,apfile=None,doiter=True,maxiter=5,minstars=6,subneighbors=True,verbose=False):
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-        subit = phot.createpsf(daobase+".fits",daobase+".ap",daobase+".lst",meta=self.meta,logger=self.logger)
+        subit = phot.createpsf(daobase+".fits",daobase+".ap",daobase+".lst",meta=self.meta,logger=self.logger,
+                               session=self.daosession)
         self.subiter=subit
         
     # Run ALLSTAR
@@ -794,41 +1084,34 @@ class Chip:
         alscat = phot.allstar(imfile,daobase+".psf",apfile=apfile,subfile=subfile,
                               outfile=outfile,optfile=daobase+".als.opt",meta=meta,
                               logger=self.logger,bindir=self.bindir) #ktedit:sex2
+        self.newalscat = alscat
+        if self.sexiter==1: self.alscat = alscat
 
 
-    # Combine total + new SExtractor & ALLSTAR catalog files #ktedit:sex2; this function is new
+    # Combine total + new SExtractor & ALLSTAR catalogs #ktedit:sex2; this function is new
     #-----------------------------------------------------
+    #  the catalogs are kept in memory, nothing reads the combined DAOPHOT files
     def combine_cats(self,type):
-        daobase = os.path.basename(self.daofile)
-        daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
-
+        # SExtractor catalogs are combined (and repeats removed) by runsex()
         if type=="sexcat":
-            file1 = daobase+".coo"                                      # total SExcat stored in this file
-            file2 = daobase+str(self.sexiter)+".coo"                    # new SExcat stored in this file
-            # must also combie .fits format of SE cat
-            file3 = "flux_sex.cat.fits"
-            file4 = "flux_sex"+str(self.sexiter)+".cat.fits"
-            sexcat1 = Table.read(file3)
-            sexcat2 = Table.read(file4)
-            sexcat_total = vstack([sexcat1,sexcat2])
-            sexcat_total.write(file3,overwrite=True)
-
+            return
         elif type=="alscat":
-            file1 = daobase+".als"                                      # total ALLSTAR cat stored in this file
-            file2 = daobase+str(self.sexiter)+".als"                    # new ALLSTAR cat stored in this file
-
-        cat1 = readlines(file1)
-        cat2 = readlines(file2)
-        combined_cat = cat1+cat2[3:]                                    # combine the catalogs 
-        writelines(file1,combined_cat,overwrite=True)
+            if self.newalscat is None:
+                self.logger.warning("No ALLSTAR catalog for iteration "+str(self.sexiter))
+                return
+            self.alscat = vstack([self.alscat,self.newalscat])
 
     # Get aperture correction
     #------------------------
-    def getapcor(self):
+    #  method is 'daogrow' (DAOGROW program) or 'python' (phot.curveofgrowth),
+    #  the default is self.apcormethod
+    def getapcor(self,method=None):
+        if method is None: method = self.apcormethod
         daobase = os.path.basename(self.daofile)
         daobase = os.path.splitext(os.path.splitext(daobase)[0])[0]
         apcorr = phot.apcor(daobase+"a.fits",daobase+".lst",daobase+".psf",self.meta,
-                            optfile=daobase+'.opt',alsoptfile=daobase+".als.opt",logger=self.logger)
+                            optfile=daobase+'.opt',alsoptfile=daobase+".als.opt",logger=self.logger,
+                            method=method,aperphot=self.aperphot)
         self.apcorr = apcorr
         self.meta['apcor'] = (apcorr,"Aperture correction in mags")
 
@@ -844,12 +1127,12 @@ class Chip:
         if outfile is None: outfile=self.base+".cat.fits"
 
         # Check that we have the SE and ALS information
-        if (self.sexcat is None) | (os.path.exists(daobase+".als") is None):
+        if (self.sexcat is None) | (self.alscat is None):
             self.logger.warning("SE catalog or ALS catalog NOT found")
             return
 
-        # Load ALS catalog
-        als = Table(phot.daoread(daobase+".als")) 
+        # ALS catalog of all iterations
+        als = Table(self.alscat,copy=True)
         nals = len(als)
         # Apply aperture correction
         if self.apcorr is None:
@@ -921,6 +1204,12 @@ class Chip:
     # Process a single chip
     #----------------------
     def process(self):
+        try:
+            self._process()
+        finally:
+            self.stopdaosession()
+
+    def _process(self):
 
         # Set up SE iteration
         sexiter_endflag = 0
@@ -935,7 +1224,11 @@ class Chip:
             else:
                 sex_dt = 1.1
 
-            self.runsex(dthresh=sex_dt,bindir=self.bindir)
+            if self.sexiter==1 and self.prefwhm:
+                with self.timer('sepfwhm',iter=self.sexiter):
+                    self.sepfwhm()
+            with self.timer('runsex',iter=self.sexiter):
+                self.runsex(dthresh=sex_dt,bindir=self.bindir)
 
             # Get the info for this iteration's catalog
             nowcat = self.sexcat[self.sexcat['NDET_ITER']==self.sexiter]  # cat for current SE iteration
@@ -951,8 +1244,11 @@ class Chip:
 
             # for first iteration only, make DAO-ready files
             if self.sexiter==1:
-                self.mkopt()
-                self.mkdaoim()
+                with self.timer('mkopt',iter=self.sexiter):
+                    self.mkopt()
+                with self.timer('mkdaoim',iter=self.sexiter):
+                    self.mkdaoim()
+                if self.usesession: self.startdaosession()
             
             # Convert SE cat to DAO format
             #self.daodetect()
@@ -962,19 +1258,25 @@ class Chip:
                 sdao_ofile = "flux_dao.coo"          # select aperphot output filename
             else:
                 sdao_ofile = "flux_dao"+str(self.sexiter)+".coo"
-            self.sextodao(outfile=sdao_ofile)
+            with self.timer('sextodao',iter=self.sexiter):
+                self.sextodao(outfile=sdao_ofile)
 
-            self.daoaperphot()
+            with self.timer('daoaperphot',iter=self.sexiter):
+                self.daoaperphot()
 
             # For first iteration only, fit PSF 
             if self.sexiter==1:
-                self.daopickpsf()   
-                self.createpsf()
-
-            # Combine SE cats, run ALLSTAR, combine ALLSTAR cats
-            if self.sexiter>1: self.combine_cats(type="sexcat")           
-            self.allstar()
-            if self.sexiter>1: self.combine_cats(type="alscat")                      
+                with self.timer('daopickpsf',iter=self.sexiter):
+                    self.daopickpsf()   
+                with self.timer('createpsf',iter=self.sexiter):
+                    self.createpsf()
+
+            # Run ALLSTAR, combine ALLSTAR cats (the SE cats are combined by runsex)
+            with self.timer('allstar',iter=self.sexiter):
+                self.allstar()
+            if self.sexiter>1:
+                with self.timer('combine_alscat',iter=self.sexiter):
+                    self.combine_cats(type="alscat")                      
 
             # Check to see if we've run enough SExtractor iterations
             # Requirements to end:
@@ -987,8 +1289,10 @@ class Chip:
             self.sexiter += 1
 
         # Get aperture correction, create final cat from SE + ALLSTAR cats
-        self.getapcor()
-        self.finalcat()
+        with self.timer('getapcor'):
+            self.getapcor()
+        with self.timer('finalcat'):
+            self.finalcat()
 
         # David's notes:------------------------------------------------------------------------------------
 
@@ -1051,7 +1355,7 @@ class Chip:
         #    outsubfile = self.keepdir+self.bigbase+"_"+str(self.ccdnum)+"_"+str(i)+"s.fits"
         #    if os.path.exists(outsubfile): os.remove(outsubfile)
         #    shutil.copyfile(daobase+str(i)+"s.fits",outsubfile)
-        # Copy SE config file
+        # Copy SE config file, with the settings of the last SE run on this chip
         outconfigfile = os.path.join(self.keepdir,self.bigbase+"_"+str(self.ccdnum)+".sex.config")
         if os.path.exists(outconfigfile): os.remove(outconfigfile)
         shutil.copyfile("default.config",outconfigfile)
@@ -1102,6 +1406,12 @@ if __name__ == "__main__":
     parser.add_argument('--host',type=str,nargs=1,default="None",help='hostname, default "None", other options supported are "cca","tempest_katie","tempest_group","gp09/7"')
     parser.add_argument('--x',action='store_true', help='Exposure version is of format "vX"')
     parser.add_argument('-r','--redo', action='store_true', help='Redo exposures that were previously processed')
+    parser.add_argument('--ncpu',type=int,nargs=1,default=[1],help='Number of chips to process in parallel, default 1')
+    parser.add_argument('--direct',action='store_true', help='Read the chip HDUs directly from the input files instead of copying them')
+    parser.add_argument('--aperphot',type=str,nargs=1,default=['daophot'],help='Aperture photometry code, "daophot" (default) or "sep"')
+    parser.add_argument('--session',action='store_true', help='Run the DAOPHOT steps of each chip in one persistent DAOPHOT process')
+    parser.add_argument('--prefwhm',action='store_true', help='Estimate the FWHM and PSF stars with sep instead of from the SExtractor catalog and PICKPSF (SExtractor still runs for the detections)')
+    parser.add_argument('--apcor',type=str,nargs=1,default=['daogrow'],help='Curve of growth code for the aperture correction, "daogrow" (default) or "python"')
     args = parser.parse_args()
 
 
@@ -1112,6 +1422,12 @@ if __name__ == "__main__":
     if host=="None": host = None
     x = args.x                               # if called, exposure version is of format "vX"
     redo = args.redo                         # if called, redo = True
+    ncpu = args.ncpu[0]                      # number of chips to process in parallel
+    direct = args.direct                     # if called, read HDUs directly from the input files
+    aperphot = args.aperphot[0]              # aperture photometry code, "daophot" or "sep"
+    usesession = args.session                # if called, use a persistent DAOPHOT session per chip
+    prefwhm = args.prefwhm                   # if called, estimate the FWHM and PSF stars with sep
+    apcormethod = args.apcor[0]              # curve of growth code, "daogrow" or "python"
     print("version = ",version," host = ",host," x = ",x," redo = ",redo)
     
     # Get NSC directories
@@ -1149,7 +1465,8 @@ if __name__ == "__main__":
     t0 = time.time()
     
     # Create the Exposure object
-    exp = Exposure(fluxfile,wtfile,maskfile,nscversion=version,host=host)
+    exp = Exposure(fluxfile,wtfile,maskfile,nscversion=version,host=host,ncpu=ncpu,direct=direct,aperphot=aperphot,
+                   usesession=usesession,prefwhm=prefwhm,apcormethod=apcormethod)
     # Run
     exp.run()
 
@@ -26,9 +26,14 @@ import logging
 #from scipy.signal import convolve2d
 from dlnpyutils.utils import *
 from scipy.ndimage.filters import convolve
+from scipy.optimize import least_squares
+from scipy.spatial import cKDTree
 import astropy.stats
 import struct
 import tempfile
+import hashlib
+import getpass
+import sep
 import time
 import traceback
 from .slurm_funcs import *
@@ -311,11 +316,91 @@ def aperswrite(filename=None,apertures=None):
     f.close()
 
 
+# Read DAOPHOT apertures file
+def apersread(filename):
+    '''
+    Read the photometry aperture radii from a DAOPHOT apertures file
+    (as written by aperswrite).  The sky annulus radii (IS/OS) are not returned.
+
+    Parameters
+    ----------
+    filename : str
+        The filename of the apertures file.
+
+    Returns
+    -------
+    apertures : numpy array
+        The aperture radii in pixels.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        apertures = apersread("photo.opt")
+
+    '''
+    apertures = []
+    for line in readlines(filename):
+        arr = line.split('=')
+        if len(arr)<2: continue
+        if arr[0].strip().upper() in ['IS','OS']: continue
+        apertures.append(float(arr[1]))
+    return np.array(apertures)
+
+
 # Read DAOPHOT files
+def _daoparse(lines,dtype,lengths):
+    '''
+    Parse fixed-width DAOPHOT catalog lines into a numpy structured array.
+    All the lines are packed into one 2D byte array and each column is
+    converted with a single astype() call.  Blank or missing fields are
+    set to zero.
+
+    Parameters
+    ----------
+    lines : list
+        The data lines (bytes).
+    dtype : numpy dtype
+        The output structured dtype, one (scalar) field per width.
+    lengths : numpy array
+        The width in characters of each field.
+
+    Returns
+    -------
+    cat : numpy structured array
+        The parsed catalog.
+
+    Example
+    -------
+
+    cat = _daoparse(lines,dtype,lengths)
+
+    '''
+    nlines = len(lines)
+    cat = np.zeros(nlines,dtype=dtype)
+    if nlines==0:
+        return cat
+    lengths = np.asarray(lengths)
+    lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
+    hi = lo+lengths
+    width = np.maximum(np.max([len(l) for l in lines]),hi[-1])
+    buf = np.array(lines,dtype='S'+str(width)).view(np.uint8).reshape(nlines,width)
+    names = cat.dtype.names
+    for j in range(len(names)):
+        field = np.ascontiguousarray(buf[:,lo[j]:hi[j]])
+        blank = np.all((field==32) | (field==0),axis=1)
+        if np.sum(blank)>0:
+            field[blank,0] = ord('0')
+        vals = field.view('S'+str(lengths[j])).ravel()
+        cat[names[j]] = vals.astype(float).astype(cat.dtype[names[j]])
+    return cat
+
+
 def daoread(fil):
     '''
     This program reads in DAOPHOT-style files and return an astropy table.
-    The supported types are .coo, .lst, .ap (in development), and .als.
+    The supported types are .coo, .lst, .ap, .tot and .als.
 
     Parameters
     ----------
@@ -346,13 +431,14 @@ def daoread(fil):
     if os.path.exists(fil) is False:
         print(fil+" NOT found")
         return None
-    lines = readlines(fil)
+    with open(fil,'rb') as f:
+        lines = f.read().splitlines()
     nstars = len(lines)-3
-    if nstars == 0:
-        print("No stars in "+file)
+    if nstars <= 0:
+        print("No stars in "+fil)
         return None
     # Check header
-    line2 = lines[1]
+    line2 = lines[1].decode()
     nl = int(line2.strip().split(' ')[0])
     # NL  is a code indicating the file type:
     # NL = 3 a group file
@@ -361,22 +447,19 @@ def daoread(fil):
     # NL = 0 a file without a header
     
     # Check number of columns
-    arr1 = lines[3].split()
-    if len(arr1)==0: arr1 = lines[4].split()
+    arr1 = lines[3].decode().split()
+    if len(arr1)==0: arr1 = lines[4].decode().split()
     ncols = len(arr1)
+    # Data lines, ignore trailing blank lines
+    datalines = lines[3:]
+    while len(datalines)>0 and datalines[-1].strip()==b'':
+        datalines = datalines[:-1]
 
     # NL = 1  coo file
     if (nl==1) & (ncols==7):
         dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('SHARP',float),('ROUND',float),('ROUND2',float)])
-        cat = np.zeros(nstars,dtype=dtype)
         lengths = np.array([7,9,9,9,9,9,9])
-        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
-        hi = lo+lengths
-        names = cat.dtype.names
-        for i in range(nstars):
-            line1 = lines[i+3]
-            for j in range(len(names)):
-                cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
+        cat = _daoparse(datalines,dtype,lengths)
     # NL = 1  tot file
     elif (nl==1) & (ncols==9) & (arr1[-1].isdigit() is True):
         # NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD
@@ -385,28 +468,13 @@ def daoread(fil):
         #     11  454.570   37.310  13.9710   0.0084  164.683   14.040  -0.0690        6
         #     36  287.280   93.860  14.5110   0.0126  165.018   14.580  -0.0690        6
         dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float),('MAGFAP',float),('APCORR',float),('FINALAP',int)])
-        cat = np.zeros(nstars,dtype=dtype)
         lengths = np.array([7,9,9,9,9,9,9,9,9])
-        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
-        hi = lo+lengths
-        names = cat.dtype.names
-        for i in range(nstars):
-            line1 = lines[i+3]
-            for j in range(len(names)):
-                cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
-
+        cat = _daoparse(datalines,dtype,lengths)
     # NL = 1  als file
     elif (nl==1) & (ncols==9) & (arr1[-1].isdigit() is False):
         dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float),('ITER',float),('CHI',float),('SHARP',float)])
-        cat = np.zeros(nstars,dtype=dtype)
         lengths = np.array([7,9,9,9,9,9,9,9,9])
-        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
-        hi = lo+lengths
-        names = cat.dtype.names
-        for i in range(nstars):
-            line1 = lines[i+3]
-            for j in range(len(names)):
-                cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
+        cat = _daoparse(datalines,dtype,lengths)
     # NL = 2  aperture photometry
     elif nl==2:
         #
@@ -420,58 +488,34 @@ def daoread(fil):
         #                   Sky, St.Dev. of sky, skew of sky, Mag1err, Mag2err, etc.
         ncols = len(lines[4].split())
         naper = ncols-3   # apertures
-        nstars = int((numlines(fil)-3.0)/3.0)  # stars
-        dtype = np.dtype([('ID',int),('X',float),('Y',float),('SKY',float),('SKYSIG',float),('SKYSKEW',float),('MAG',float,naper),('ERR',float,naper)])
-        cat = np.zeros(nstars,dtype=dtype)
-        # for line 1
+        nstars = int((len(lines)-3.0)/3.0)  # stars
+        magnames = ['MAG'+f for f in (np.arange(naper)+1).astype(str)]
+        errnames = ['ERR'+f for f in (np.arange(naper)+1).astype(str)]
+        # line 1, ID, X, Y, Mag1, Mag2, etc..
+        dtype1 = np.dtype([('ID',int),('X',float),('Y',float)]+[(n,float) for n in magnames])
         lengths1 = np.concatenate([np.array([7,9,9]),np.zeros(naper,dtype=int)+9])
-        dtype1 = np.concatenate([np.array([7,9,9]),np.zeros(naper,dtype=int)+9])
-        lo1 = np.concatenate((np.array([0]), np.cumsum(lengths1[0:-1])))
-        hi1 = lo1+lengths1
-        names1 = ['ID','X','Y']+['MAG'+f for f in (np.arange(naper)+1).astype(str)]
-        # for line 2
+        cat1 = _daoparse(lines[4:4+3*nstars:3],dtype1,lengths1)
+        # line 2, Sky, St.Dev. of sky, skew of sky, Mag1err, Mag2err, etc.
+        dtype2 = np.dtype([('SKY',float),('SKYSIG',float),('SKYSKEW',float)]+[(n,float) for n in errnames])
         lengths2 = np.concatenate([np.array([14,6,6]),np.zeros(naper,dtype=int)+9])
-        lo2 = np.concatenate((np.array([0]), np.cumsum(lengths2[0:-1])))
-        hi2 = lo2+lengths2
-        names1 = ['SKY','SKYSIG','SKYSKEW']+['ERR'+f for f in (np.arange(naper)+1).astype(str)]
-        for i in range(nstars):
-            # line 1
-            # ID, X, Y, Mag1, Mag2, etc.. 
-            line1 = lines[i*3+4]
-            cat[i]['ID'] = int(line1[lo1[0]:hi1[0]])
-            cat[i]['X'] = float(line1[lo1[1]:hi1[1]])
-            cat[i]['Y'] = float(line1[lo1[2]:hi1[2]])
-            mag = np.zeros(naper,dtype=float)
-            for j in range(naper):
-                mag[j] = np.array(line1[lo1[j+3]:hi1[j+3]],dtype=float)
-            cat[i]['MAG'] = mag
-            # line 2
-            # Sky, St.Dev. of sky, skew of sky, Mag1err, Mag2err, etc.  
-            line2 = lines[i*3+5]
-            cat[i]['SKY'] = float(line2[lo2[0]:hi2[0]])
-            cat[i]['SKYSIG'] = float(line2[lo2[1]:hi2[1]])
-            cat[i]['SKYSKEW'] = float(line2[lo2[2]:hi2[2]])
-            err = np.zeros(naper,dtype=float)
-            for j in range(naper):
-                err[j] = np.array(line2[lo2[j+3]:hi2[j+3]],dtype=float)
-            cat[i]['ERR'] = err
+        cat2 = _daoparse(lines[5:5+3*nstars:3],dtype2,lengths2)
+        dtype = np.dtype([('ID',int),('X',float),('Y',float),('SKY',float),('SKYSIG',float),('SKYSKEW',float),('MAG',float,naper),('ERR',float,naper)])
+        cat = np.zeros(nstars,dtype=dtype)
+        for n in ['ID','X','Y']:
+            cat[n] = cat1[n]
+        for n in ['SKY','SKYSIG','SKYSKEW']:
+            cat[n] = cat2[n]
+        cat['MAG'] = np.vstack([cat1[n] for n in magnames]).T.reshape(nstars,naper)
+        cat['ERR'] = np.vstack([cat2[n] for n in errnames]).T.reshape(nstars,naper)
     # NL = 3  list
     elif nl==3:
         dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float)])
-        cat = np.zeros(nstars,dtype=dtype)
-        lengths = np.array([7,9,9,9,9,9,9])
-        lo = np.concatenate((np.array([0]), np.cumsum(lengths[0:-1])))
-        hi = lo+lengths
-        names = cat.dtype.names
-        for i in range(nstars):
-            line1 = lines[i+3]
-            nline1 = len(line1)
-            for j in range(len(names)):
-                # someimtes lst files are missing the SKY column
-                if hi[j]<=nline1:
-                    cat[i][names[j]] = np.array(line1[lo[j]:hi[j]],dtype=dtype[names[j]])
-                else:
-                    print('Warning: cannot read column '+names[j]+' for line '+str(i+1))
+        lengths = np.array([7,9,9,9,9,9])
+        # sometimes lst files are missing the SKY column
+        nshort = np.sum(np.array([len(l) for l in datalines]) < np.sum(lengths))
+        if nshort>0:
+            print('Warning: cannot read column SKY for '+str(nshort)+' lines')
+        cat = _daoparse(datalines,dtype,lengths)
     else:
         print("Cannot load this file")
         return None
@@ -479,6 +523,32 @@ def daoread(fil):
     return Table(cat)
 
 
+def _daowrite(f,fmt,cols):
+    '''
+    Write DAOPHOT catalog rows.  The rows are formatted in one pass and
+    written with a single call.
+
+    Parameters
+    ----------
+    f : file object
+        The open output file.
+    fmt : str
+        The format string for one row (without the newline).
+    cols : list
+        List of column arrays or scalars, one for each format field.
+
+    Example
+    -------
+
+    _daowrite(f,"%7d %8.3f",[cat['NUMBER'],cat['X_IMAGE']])
+
+    '''
+    nrows = np.max([np.size(c) for c in cols])
+    cols = [np.broadcast_to(np.asarray(c),(nrows,)).tolist() for c in cols]
+    if nrows > 0:
+        f.write('\n'.join(map(fmt.__mod__,zip(*cols)))+'\n')
+
+
 # Make meta-data dictionary for an image:
 def makemeta(fluxfile=None,header=None):
     '''
@@ -710,9 +780,8 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
         f.write("\n")
         #f.write("  3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n")
         # Write the data
-        for e in cat:
-            f.write("%7d %8.2f %8.2f %8.3f %8.3f %8.3f %8.3f\n" %
-                    (e["NUMBER"],e["X_IMAGE"],e["Y_IMAGE"],e["MAG_AUTO"],0.6,0.0,0.0))
+        _daowrite(f,"%7d %8.2f %8.2f %8.3f %8.3f %8.3f %8.3f",
+                  [cat["NUMBER"],cat["X_IMAGE"],cat["Y_IMAGE"],cat["MAG_AUTO"],0.6,0.0,0.0])
         f.close()
 
     # "lst" file from PICKPSF
@@ -732,9 +801,8 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
         f.write("\n")
         #f.write("  3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n")
         # Write the data
-        for e in cat:
-            f.write("%7d %8.3f %8.3f %8.3f %8.3f %8.3f\n" %
-                    (e["NUMBER"],e["X_IMAGE"]+1,e["Y_IMAGE"]+1,e["MAG_AUTO"],e["MAGERR_AUTO"],0.3))
+        _daowrite(f,"%7d %8.3f %8.3f %8.3f %8.3f %8.3f",
+                  [cat["NUMBER"],np.asarray(cat["X_IMAGE"])+1,np.asarray(cat["Y_IMAGE"])+1,cat["MAG_AUTO"],cat["MAGERR_AUTO"],0.3])
         f.close()
 
     # "ap" file from PHOTOMETRY
@@ -759,9 +827,8 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
         f.write("\n")
         #f.write("  3  2046  4094  1472.8 38652.0   80.94    3.00    3.91    1.55    3.90\n")
         # Write the data
-        for e in cat:
-            f.write("%7d %8.3f %8.3f %8.3f %8.4f %8.3f %8.0f %8.3f %8.3f\n" %
-                    (e["NUMBER"],e["X_IMAGE"]+1,e["Y_IMAGE"]+1,e["MAG_AUTO"],e["MAGERR_AUTO"],1500.0,1,1.0,0.0))
+        _daowrite(f,"%7d %8.3f %8.3f %8.3f %8.4f %8.3f %8.0f %8.3f %8.3f",
+                  [cat["NUMBER"],np.asarray(cat["X_IMAGE"])+1,np.asarray(cat["Y_IMAGE"])+1,cat["MAG_AUTO"],cat["MAGERR_AUTO"],1500.0,1,1.0,0.0])
         f.close()
 
     # Not supported
@@ -770,10 +837,128 @@ def sextodao(cat=None,meta=None,outfile=None,format="lst",naxis1=None,naxis2=Non
         return
 
 
+# Shared Source Extractor configuration
+#--------------------------------------
+def sexconfig(configdir=None,cachedir=None,logger=None):
+    '''
+    Stage the static Source Extractor configuration files (default.config,
+    default.conv, default.nnw and default.param) in a shared directory named
+    after a hash of their contents.  The directory is only created once, so
+    all chips and iterations that use the same configuration share the same
+    read-only files.  The file names in default.config are replaced with their
+    absolute paths.
+
+    Parameters
+    ----------
+    configdir : str
+              The directory that contains the Source Extractor configuration files.
+    cachedir : str, optional
+             The directory in which to create the shared directory.  The default
+             is "nsc_sexconfig_<username>" in the system temporary directory.
+    logger : logger object, optional
+           The Logger to use for logging output.
+
+    Returns
+    -------
+    sexdir : str
+           The absolute path of the shared configuration directory.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        sexdir = sexconfig("/data/config/")
+
+    '''
+
+    if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+    if cachedir is None:
+        # per-user, another user can't write to our directory
+        try:
+            username = getpass.getuser()
+        except Exception:
+            username = str(os.getuid())
+        cachedir = os.path.join(tempfile.gettempdir(),"nsc_sexconfig_"+username)
+    names = ["default.config","default.conv","default.nnw","default.param"]
+
+    # Hash of the file contents
+    contents = {}
+    md5 = hashlib.md5()
+    for n in names:
+        with open(os.path.join(configdir,n),'rb') as f:
+            contents[n] = f.read()
+        md5.update(n.encode()+b'\0'+contents[n])
+    sexdir = os.path.abspath(os.path.join(cachedir,"sexconfig_"+md5.hexdigest()[0:16]))
+    if os.path.exists(os.path.join(sexdir,"default.config")):
+        return sexdir
+
+    # Write the files to a temporary directory and move it into place,
+    #  another process might be doing the same thing at the same time
+    logger.info("Staging SExtractor configuration files in "+sexdir)
+    os.makedirs(cachedir,exist_ok=True)
+    tmpdir = tempfile.mkdtemp(prefix=".sexconfig",dir=cachedir)
+    lines = contents["default.config"].decode().splitlines()
+    for i,l in enumerate(lines):
+        for key,n in [("PARAMETERS_NAME","default.param"),("FILTER_NAME","default.conv"),
+                      ("STARNNW_NAME","default.nnw")]:
+            if re.search('^'+key+r'\s',l):
+                lines[i] = key+"    "+os.path.join(sexdir,n)
+    contents["default.config"] = ("\n".join(lines)+"\n").encode()
+    for n in names:
+        with open(os.path.join(tmpdir,n),'wb') as f:
+            f.write(contents[n])
+        os.chmod(os.path.join(tmpdir,n),0o444)
+    os.chmod(tmpdir,0o755)
+    try:
+        os.rename(tmpdir,sexdir)
+    except OSError:
+        # Somebody else got there first
+        shutil.rmtree(tmpdir,ignore_errors=True)
+        if os.path.exists(os.path.join(sexdir,"default.config")) is False:
+            raise
+    return sexdir
+
+
+def sexconfigwrite(sexdir=None,sexopts=None,outfile=None):
+    '''
+    Write the shared default.config with the settings of one Source Extractor
+    run (given on its command line) filled in, as a record of that run.
+
+    Parameters
+    ----------
+    sexdir : str
+           The shared configuration directory from sexconfig().
+    sexopts : list
+            List of (keyword, value) pairs given on the command line.
+    outfile : str
+            The output configuration filename.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        sexconfigwrite(sexdir,[("DETECT_THRESH","1.1")],"chip.sex.config")
+
+    '''
+
+    lines = readlines(os.path.join(sexdir,"default.config"))
+    opts = dict(sexopts)
+    for i,l in enumerate(lines):
+        key = l.split()[0] if len(l.split())>0 else ''
+        if key in opts:
+            lines[i] = key+"    "+opts.pop(key)
+    # Settings that are not in default.config
+    lines += [k+"    "+v for k,v in sexopts if k in opts]
+    with open(outfile,'w') as f:
+        f.write("\n".join(lines)+"\n")
+
+
 # Run Source Extractor
 #---------------------
 def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,configdir=None,
-           offset=0,sexiter=1,dthresh=2.0,logfile=None,logger=None,bindir=None): #ktedit:sex2
+           offset=0,sexiter=1,dthresh=2.0,logfile=None,logger=None,bindir=None,cachedir=None,sexdir=None): #ktedit:sex2
     '''
     Run Source Extractor on an exposure.  The program is configured to work with files
     created by the NOAO Community Pipeline.
@@ -803,6 +988,11 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    cachedir : str, optional
+           The directory for the shared configuration files (see sexconfig).
+    sexdir : str, optional
+           The shared configuration directory already created by sexconfig().  By
+           default it is created (or found) from `configdir` and `cachedir`.
 
     Returns
     -------
@@ -812,6 +1002,7 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
         The magnitude limit of the exposure.
 
     The catalog is written to `outfile` and the output of Source Extractor to `logfile`.
+    The full configuration of the run is written to "default.config".
 
     Example
     -------
@@ -859,19 +1050,18 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
     if logfile is None: logfile=base+"_sex.log"
 
     # Working filenames
+    #  SExtractor reads the flux image directly, only the
+    #  weight and flag images need to be modified
     sexbase = base+"_sex"
-    sfluxfile = sexbase+".flux.fits"
     swtfile = sexbase+".wt.fits"
     smaskfile = sexbase+".mask.fits"
 
     if os.path.exists(outfile): os.remove(outfile)
-    if os.path.exists(sfluxfile): os.remove(sfluxfile)
     if os.path.exists(swtfile): os.remove(swtfile)
     if os.path.exists(smaskfile): os.remove(smaskfile)
     if os.path.exists(logfile): os.remove(logfile)
 
     # Load the data
-    flux,fhead = fits.getdata(fluxfile,header=True)
     wt,whead = fits.getdata(wtfile,header=True)
     mask,mhead = fits.getdata(maskfile,header=True)
 
@@ -920,100 +1110,32 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
     #  set wt=0 for mask>0 pixels
     wt[ (mask>0) | (wt<0) ] = 0   # CP sets bad pixels to wt=0 or sometimes negative
 
-    # Write out the files
-    shutil.copy(fluxfile,sfluxfile)
+    # Write out the weight file
     fits.writeto(swtfile,wt,header=whead,output_verify='warn')
 
 
-    # 3b) Make SExtractor config files
-    # Copy the default files
-    shutil.copyfile(configdir+"default.conv","default.conv")
-    shutil.copyfile(configdir+"default.nnw","default.nnw")
-    shutil.copyfile(configdir+"default.param","default.param")
-
-    # Read in configuration file and modify for this image
-    lines = readlines(configdir+'default.config')
-
-    # Gain, saturation, pixscale
-
-    # Things to change
-    # SATUR_LEVEL     59000.00         # level (in ADUs) at which arises saturation
-    # GAIN            43.52             # detector gain in e-/ADU.
-    # SEEING_FWHM     1.46920            # stellar FWHM in arcsec
-    # WEIGHT_IMAGE  F4-00507860_01_comb.mask.fits
-    # CHECKIMAGE_TYPE  SEGMENTATION
-    # CHECKIMAGE_NAME segment.fits
-    # DETECT_THRESH    1.1 originally, will be changed depending on density/fwhm #ktedit:sex2
-    # ANALYSIS_THRESH   same as DETECT_THRESH                                    #ktedit:sex2
-
-    filter_name = ''
-    cnt = 0
-    for l in lines:
-        # CATALOG_NAME
-        m = re.search('^CATALOG_NAME',l)
-        if m != None:
-            lines[cnt] = "CATALOG_NAME     "+outfile+"         # name of the output catalog\n"
-        # FLAG_IMAGE
-        m = re.search('^FLAG_IMAGE',l)
-        if m != None:
-            lines[cnt] = "FLAG_IMAGE     "+smaskfile+"         # filename for an input FLAG-image\n"
-        # WEIGHT_IMAGE
-        m = re.search('^WEIGHT_IMAGE',l)
-        if m != None:
-            lines[cnt] = "WEIGHT_IMAGE     "+swtfile+"  # Weight image name\n"
-        # SATUR_LEVEL
-        m = re.search('^SATUR_LEVEL',l)
-        if m != None:
-            lines[cnt] = "SATUR_LEVEL     "+str(meta["saturate"])+"         # level (in ADUs) at which arises saturation\n"
-        # Gain
-        m = re.search('^GAIN',l)
-        if m != None:
-            lines[cnt] = "GAIN            "+str(meta["gain"])+"            # detector gain in e-/ADU.\n"
-       
-        #-----------------------------------------------------------#ktedit:sex2 T
-        # Check_image                                               #ktedit:sex2 (for visual analysis purposes)
-        m = re.search('^CHECKIMAGE_TYPE',l)
-        if m != None:
-            lines[cnt] = "CHECKIMAGE_TYPE SEGMENTATION"
-        # Check_image name 
-        m = re.search('^CHECKIMAGE_NAME',l)
-        if m != None:
-            lines[cnt] = "CHECKIMAGE_NAME seg_"+str(sexiter)+".fits"
-        
-        # DETECT_THRESH                                             #ktedit:sex2 (may be changed after first sexiteration)
-        m = re.search('^DETECT_THRESH',l)
-        if m != None:
-            lines[cnt] = "DETECT_THRESH   "+str(dthresh)+"             # <sigmas> or <threshold>,<ZP> in mag.arcsec-2"
-        # ANALYSIS_THRESH
-        m = re.search('^ANALYSIS_THRESH',l)
-        if m != None:
-            lines[cnt] = "ANALYSIS_THRESH "+str(dthresh)+"             # <sigmas> or <threshold>,<ZP> in mag.arcsec-2"
-        #-----------------------------------------------------------#ktedit:sex2 B        
-
-        # SEEING_FWHM
-        m = re.search('^SEEING_FWHM',l)
-        if m != None:
-            lines[cnt] = "SEEING_FWHM     "+str(meta["cpfwhm"])+"            # stellar FWHM in arcsec\n"
-        # PHOT_APERTURES, aperture diameters in pixels
-        m = re.search('^PHOT_APERTURES',l)
-        if m != None:
-            aper_world = np.array([ 0.5, 1.0, 2.0, 3.0, 4.0]) * 2  # radius->diameter, 1, 2, 4, 6, 8"
-            aper_pix = aper_world / meta["pixscale"]
-            lines[cnt] = "PHOT_APERTURES  "+', '.join(np.array(np.round(aper_pix,2),dtype='str'))+"            # MAG_APER aperture diameter(s) in pixels\n"            
-        # Filter name
-        m = re.search('^FILTER_NAME',l)
-        if m != None:
-            filter_name = (l.split())[1]
-        cnt = cnt+1
-
-    # Add newlines
-    lines = [line + '\n' for line in lines]
-    # Write out the new config file
-    if os.path.exists("default.config"):
-        os.remove("default.config")
-    fo = open('default.config', 'w')
-    fo.writelines(lines)
-    fo.close()
+    # 3b) SExtractor config files
+    #  the static files are shared by all runs in a cached directory, the
+    #  settings for this image are given on the command line
+    if sexdir is None:
+        sexdir = sexconfig(configdir,cachedir=cachedir,logger=logger)
+    aper_world = np.array([ 0.5, 1.0, 2.0, 3.0, 4.0]) * 2  # radius->diameter, 1, 2, 4, 6, 8"
+    aper_pix = aper_world / meta["pixscale"]
+    sexopts = [("CATALOG_NAME",outfile),
+               ("FLAG_IMAGE",smaskfile),
+               ("WEIGHT_IMAGE",swtfile),
+               ("SATUR_LEVEL",str(meta["saturate"])),
+               ("GAIN",str(meta["gain"])),
+               ("CHECKIMAGE_TYPE","SEGMENTATION"),          #ktedit:sex2 (for visual analysis purposes)
+               ("CHECKIMAGE_NAME","seg_"+str(sexiter)+".fits"),
+               ("DETECT_THRESH",str(dthresh)),              #ktedit:sex2 (may be changed after first sexiteration)
+               ("ANALYSIS_THRESH",str(dthresh)),
+               ("SEEING_FWHM",str(meta["cpfwhm"])),
+               ("PHOT_APERTURES",','.join(np.array(np.round(aper_pix,2),dtype='str'))),  # diameters in pixels
+               ("PARAMETERS_NAME",os.path.join(sexdir,"default.param")),
+               ("FILTER_NAME",os.path.join(sexdir,"default.conv")),
+               ("STARNNW_NAME",os.path.join(sexdir,"default.nnw"))]
+    filter_name = os.path.join(sexdir,"default.conv")
 
     # Convolve the mask file with the convolution kernel to "grow" the regions
     # around bad pixels the SE already does to the weight map
@@ -1048,8 +1170,13 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
     try:
         # Save the SExtractor info to a logfile
         sf = open(logfile,'w')
-        retcode = subprocess.call([bindir+"sex",sfluxfile,"-c","default.config"],stdout=sf,
-                                  stderr=subprocess.STDOUT)
+        cmd = [bindir+"sex",fluxfile,"-c",os.path.join(sexdir,"default.config")]
+        for k,v in sexopts: cmd += ["-"+k,v]
+        # Record the full configuration of this run
+        sexconfigwrite(sexdir,sexopts,"default.config")
+        sf.write(" ".join(cmd)+"\n")
+        sf.flush()
+        retcode = subprocess.call(cmd,stdout=sf,stderr=subprocess.STDOUT)
         sf.close()
         if retcode < 0:
             logger.error("Child was terminated by signal"+str(-retcode))
@@ -1092,9 +1219,8 @@ def runsex(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,config
         maglim = None
 
     # Delete temporary files
-    if os.path.exists(sfluxfile): os.remove(sfluxfile)
     if os.path.exists(smaskfile): os.remove(smaskfile)
-    if os.path.exists(smaskfile): os.remove(swtfile)
+    if os.path.exists(swtfile): os.remove(swtfile)
     #os.remove("default.conv")
     
     return cat,maglim
@@ -1153,6 +1279,58 @@ def sexfwhm(cat=None,logger=None):
     return medfwhm
 
 
+def _psfselect(x,y,mag,snr,cand,nx,ny,fwhm,nstars=100,ngrid=None):
+    '''
+    Select isolated PSF stars spread across the image.  `x`, `y`, `mag` and
+    `snr` are for all the sources, `cand` selects the candidates and `fwhm`
+    is in pixels.  Candidates with a brighter source within 2 FWHM are
+    removed and the rest are scored by S/N divided by the crowding, the
+    distance-weighted flux ratio of the neighbors within the PSF radius
+    (4 FWHM).  The image is split into an `ngrid` x `ngrid` grid (about four
+    stars per cell by default) and the best star of every cell is taken
+    first, then the second best, and so on.
+
+    Returns the index array of the selected stars, in order of preference.
+    '''
+
+    x,y,mag,snr = [np.asarray(a,float) for a in [x,y,mag,snr]]
+    cand = np.arange(len(x))[cand]
+    if len(cand)==0:
+        return cand
+    # Neighbors of the candidates within the PSF radius
+    rpsf = 4.0*fwhm
+    tree = cKDTree(np.vstack((x,y)).T)
+    neilist = tree.query_ball_point(np.vstack((x[cand],y[cand])).T,rpsf)
+    nnei = np.array([len(n) for n in neilist])
+    cind = np.repeat(np.arange(len(cand)),nnei)
+    nind = np.concatenate(neilist).astype(int) if len(cind)>0 else np.zeros(0,int)
+    other = (nind != cand[cind])
+    cind,nind = cind[other],nind[other]
+    dist = np.sqrt((x[nind]-x[cand][cind])**2+(y[nind]-y[cand][cind])**2)
+    with np.errstate(over='ignore',invalid='ignore'):
+        fratio = np.nan_to_num(10**(-0.4*(mag[nind]-mag[cand][cind])),nan=0.0,posinf=1e10)
+    # Brighter neighbor within the fitting region
+    bad = np.zeros(len(cand),bool)
+    bad[cind[(dist < 2.0*fwhm) & (fratio > 1)]] = True
+    # Crowding, the neighbor flux weighted by distance
+    crowd = np.bincount(cind,weights=fratio*(1-dist/rpsf),minlength=len(cand))
+    score = np.maximum(snr[cand],0)/(1+crowd)
+    cand,score = cand[~bad],score[~bad]
+    if len(cand)==0:
+        return cand
+    # Spread them over the image, best of each grid cell first
+    if ngrid is None: ngrid = int(np.clip(np.round(np.sqrt(nstars/4.0)),1,10))
+    gx = np.clip((x[cand]*ngrid/nx).astype(int),0,ngrid-1)
+    gy = np.clip((y[cand]*ngrid/ny).astype(int),0,ngrid-1)
+    cell = gy*ngrid+gx
+    si = np.lexsort((-score,cell))
+    start = np.searchsorted(cell[si],cell[si])
+    rank = np.zeros(len(cand),int)
+    rank[si] = np.arange(len(cand))-start
+    order = np.lexsort((-score,rank))
+    return cand[order][0:nstars]
+
+
 # Pick PSF candidates using SE catalog
 #-------------------------------------
 def sexpickpsf(cat=None,fwhm=None,meta=None,outfile=None,nstars=100,logger=None):
@@ -1236,7 +1414,7 @@ def sexpickpsf(cat=None,fwhm=None,meta=None,outfile=None,nstars=100,logger=None)
     if ngdcat<10:
         logger.info("Too few PSF stars on first try. Loosening cuts")
         gdcat = ((cat['MAG_AUTO']< 50) & (cat['MAGERR_AUTO']<0.15) & 
-                 (cat['FWHM_WORLD']*3600.>0.2*self.seeing) & (cat['FWHM_WORLD']*3600.<1.8*fwhm) &
+                 (cat['FWHM_WORLD']*3600.>0.2*fwhm) & (cat['FWHM_WORLD']*3600.<1.8*fwhm) &
                  (cat['MAG_AUTO']>(minmag+0.5)) & (cat['MAG_AUTO']<(maxmag-0.5)))
         ngdcat = np.sum(gdcat)
     # No candidates
@@ -1244,10 +1422,14 @@ def sexpickpsf(cat=None,fwhm=None,meta=None,outfile=None,nstars=100,logger=None)
         logger.error("No good PSF stars found")
         raise
 
-    # Candidate PSF stars, use only Nstars, and sort by magnitude
-    si = np.argsort(cat[gdcat]['MAG_AUTO'])
-    psfcat = cat[gdcat][si]
-    if ngdcat>nstars: psfcat=psfcat[0:nstars]
+    # Candidate PSF stars, isolated and spread over the chip, use only Nstars
+    snr = 1.0857/np.maximum(np.array(cat['MAGERR_AUTO']),1e-5)
+    ind = _psfselect(np.array(cat['X_IMAGE']),np.array(cat['Y_IMAGE']),np.array(cat['MAG_AUTO']),
+                     snr,gdcat,meta['NAXIS1'],meta['NAXIS2'],fwhm/meta['pixscale'],nstars=nstars)
+    if len(ind)==0:
+        logger.error("No isolated PSF stars found")
+        raise Exception("No isolated PSF stars found")
+    psfcat = cat[ind]
     logger.info(str(len(psfcat))+" PSF stars found")
 
     # Output them in DAO format
@@ -1263,6 +1445,262 @@ def sexpickpsf(cat=None,fwhm=None,meta=None,outfile=None,nstars=100,logger=None)
     
 
 
+# Determine seeing FWHM and PSF candidates with sep
+#-------------------------------------------------
+def sepfwhm(fluxfile=None,maskfile=None,meta=None,nsig=10.0,subsample=2,blocksize=512,
+            nstars=100,logger=None):
+    '''
+    Quick estimate of the seeing FWHM and a list of PSF star candidates with
+    sep background and extraction.  Only every `subsample`-th block of the
+    chip (in a checkerboard pattern) is used, and only the bright sources are
+    extracted, so this takes a fraction of a second.
+
+    Parameters
+    ----------
+    fluxfile : str
+             The filename of the flux FITS image.
+    maskfile : str, optional
+             The filename of the mask FITS image.  Pixels with mask>0 are ignored.
+    meta : astropy header
+         The meta-data dictionary for the image (pixscale, gain, saturate).
+    nsig : float, optional
+         The detection threshold in sigma.  Default is 10.
+    subsample : int, optional
+         Use one out of every `subsample` blocks.  Default is 2.
+    blocksize : int, optional
+         The size of the blocks in pixels.  Default is 512.
+    nstars : int, optional, default is 100
+           The maximum number of PSF candidates to return.
+    logger : logging object
+          The logger to use for logging information.
+
+    Returns
+    -------
+    fwhm : float
+         The seeing FWHM in arcsec.
+    psfcat : astropy Table
+         The table of PSF star candidates (1-based X/Y, FWHM in pixels), brightest first.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        fwhm, psfcat = sepfwhm("flux.fits","mask.fits",meta)
+
+    '''
+
+    if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+    logger.info("-- Estimating FWHM with sep --")
+
+    # Not enough inputs
+    if fluxfile is None:
+        logger.warning("No fluxfile input")
+        return None,None
+    if meta is None:
+        logger.warning("No meta-data dictionary input")
+        return None,None
+    if os.path.exists(fluxfile) is False:
+        logger.warning(fluxfile+" NOT found")
+        return None,None
+
+    # Load the data
+    im = fits.getdata(fluxfile).astype(np.float32)
+    if maskfile is not None:
+        bad = (fits.getdata(maskfile) > 0)
+    else:
+        bad = np.zeros(im.shape,bool)
+    bad |= ~np.isfinite(im)
+    im[bad] = 0.0
+    ny,nx = im.shape
+    pixscale = meta['pixscale']
+    gain = meta['gain']
+    saturate = meta.get('saturate',np.inf)
+
+    # Extract the bright sources in a checkerboard of blocks
+    t0 = time.time()
+    nbx = int(np.ceil(nx/blocksize))
+    nby = int(np.ceil(ny/blocksize))
+    out = []
+    for j in range(nby):
+        for i in range(nbx):
+            if (i+j) % subsample != 0: continue
+            x0,y0 = i*blocksize,j*blocksize
+            data = np.ascontiguousarray(im[y0:y0+blocksize,x0:x0+blocksize])
+            bmask = np.ascontiguousarray(bad[y0:y0+blocksize,x0:x0+blocksize])
+            if np.sum(~bmask) < 0.5*bmask.size: continue
+            bkg = sep.Background(data,mask=bmask,bw=64,bh=64)
+            sub = data-bkg.back()
+            try:
+                objs = sep.extract(sub,nsig,err=bkg.globalrms,mask=bmask,minarea=5)
+            except Exception as e:   # too many sources or deblending overflow
+                logger.info("sep extract failed on block %d,%d: %s" % (i,j,str(e)))
+                continue
+            if len(objs)==0: continue
+            x,y = objs['x'],objs['y']
+            rmax = np.maximum(6.0*objs['a'],3.0)
+            flux,fluxerr,aflag = sep.sum_circle(sub,x,y,rmax,err=bkg.globalrms,gain=gain,mask=bmask)
+            r50,rflag = sep.flux_radius(sub,x,y,rmax,0.5,normflux=flux,subpix=5)
+            peak = data[objs['ycpeak'],objs['xcpeak']]
+            gd = ((objs['flag']==0) & (aflag==0) & (rflag==0) & (flux > 0) & (r50 > 0) &
+                  (peak < 0.8*saturate))
+            # FWHM from the area above half maximum, this does not depend on the profile shape
+            hw = int(np.clip(np.ceil(2.5*np.median(r50[gd])),3,25)) if np.sum(gd)>0 else 3
+            xi,yi = objs['xcpeak'],objs['ycpeak']
+            gd &= (xi >= hw) & (xi < data.shape[1]-hw) & (yi >= hw) & (yi < data.shape[0]-hw)
+            if np.sum(gd)==0: continue
+            xi,yi,r50 = xi[gd],yi[gd],r50[gd]
+            yy,xx = np.mgrid[-hw:hw+1,-hw:hw+1]
+            stamps = sub[yi[:,None,None]+yy,xi[:,None,None]+xx]
+            rr = np.sqrt((xi[:,None,None]+xx-x[gd][:,None,None])**2+(yi[:,None,None]+yy-y[gd][:,None,None])**2)
+            area = np.sum((stamps >= 0.5*stamps.max(axis=(1,2))[:,None,None]) & (rr < 2.5*r50[:,None,None]),axis=(1,2))
+            out.append([x[gd]+x0,y[gd]+y0,2.0*np.sqrt(area/np.pi),flux[gd],fluxerr[gd]])
+    if len(out)==0:
+        logger.warning("No sources found")
+        return None,None
+    x,y,fwhmpix,flux,fluxerr = [np.concatenate(c) for c in zip(*out)]
+    if len(x) < 5:
+        logger.warning("Only "+str(len(x))+" sources found")
+        return None,None
+
+    # The stars are the tight locus at the small end of the FWHM distribution
+    snr = flux/np.maximum(fluxerr,1e-10)
+    gd = (snr > 2*nsig)
+    if np.sum(gd) < 10: gd = np.ones(len(x),bool)
+    medfwhm = np.median(fwhmpix[gd])
+    for it in range(3):
+        sig = np.maximum(1.4826*np.median(np.abs(fwhmpix[gd]-medfwhm)),0.03*medfwhm)
+        star = gd & (np.abs(fwhmpix-medfwhm) < 3*sig)
+        medfwhm = np.median(fwhmpix[star])
+    fwhm = medfwhm*pixscale
+    logger.info('FWHM = %5.2f arcsec (%d sources, %.2f sec)' % (fwhm,np.sum(star),time.time()-t0))
+
+    # PSF candidates, stars with no other source nearby
+    #  sources in the unused blocks are unknown, so stay away from the block edges
+    rnei = 3.0*medfwhm
+    dist,ind = cKDTree(np.vstack((x,y)).T).query(np.vstack((x,y)).T,k=2)
+    xb,yb = x % blocksize, y % blocksize
+    isolated = ((dist[:,1] > rnei) & (xb > rnei) & (xb < blocksize-rnei) &
+                (yb > rnei) & (yb < blocksize-rnei))
+    psfind, = np.where(star & isolated)
+    psfind = psfind[np.argsort(-flux[psfind])][0:nstars]
+    psfcat = Table()
+    psfcat['X'] = x[psfind]+1      # DAOPHOT is 1-based
+    psfcat['Y'] = y[psfind]+1
+    psfcat['MAG'] = 25.0-2.5*np.log10(flux[psfind])
+    psfcat['ERR'] = 1.0857/snr[psfind]
+    psfcat['FWHM'] = fwhmpix[psfind]
+    logger.info(str(len(psfcat))+" PSF candidates found")
+
+    return fwhm, psfcat
+
+
+# Pick PSF stars using the sep candidates
+#----------------------------------------
+def seppickpsf(psfcat=None,catfile=None,outfile=None,maglim=None,nstars=100,dcr=1.0,
+               naxis1=None,naxis2=None,logger=None):
+    '''
+    Pick PSF stars from the candidates found by sepfwhm.  The candidates are
+    matched to the aperture photometry catalog so the IDs agree, the isolated
+    ones spread over the image are picked (see _psfselect), and written to a
+    DAOPHOT-style .lst file.  This replaces DAOPHOT PICKPSF.
+
+    Parameters
+    ----------
+    psfcat : astropy Table
+           The PSF candidates from sepfwhm.
+    catfile : str
+           The DAOPHOT aperture photometry (.ap) file.
+    outfile : str
+           The filename of the DAOPHOT-style lst file to write the PSF stars to.
+    maglim : float, optional
+           The magnitude limit for this image.  Stars fainter than maglim-1 are not used.
+    nstars : int, optional, default is 100
+           The number of PSF stars to pick.
+    dcr : float, optional
+        The matching radius in pixels.  Default is 1.0.
+    naxis1, naxis2 : int, optional
+        The size of the image.  By default it is taken from the catalog header.
+    logger : logging object
+          The logger to use for logging information.
+
+    Returns
+    -------
+    cat : astropy Table
+        The list of PSF stars.
+
+    The table of PSF stars is also written to `outfile`.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        psfcat = seppickpsf(cands,"image.ap","image.lst",19.5)
+
+    '''
+
+    if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+    logger.info("-- Picking PSF stars from the sep candidates --")
+
+    # Not enough inputs
+    if psfcat is None or len(psfcat)==0:
+        logger.warning("No PSF candidates input")
+        return None
+    if catfile is None:
+        logger.warning("No catalog filename input")
+        return None
+    if outfile is None:
+        logger.warning("No outfile input")
+        return None
+    if os.path.exists(catfile) is False:
+        logger.warning(catfile+" NOT found")
+        return None
+    if os.path.exists(outfile): os.remove(outfile)
+
+    # Match to the aperture photometry catalog
+    apcat = daoread(catfile)
+    mag = np.array(apcat['MAG'][:,0])
+    err = np.array(apcat['ERR'][:,0])
+    dist,ind = cKDTree(np.vstack((apcat['X'],apcat['Y'])).T).query(
+        np.vstack((psfcat['X'],psfcat['Y'])).T,distance_upper_bound=dcr)
+    ind = np.unique(ind[np.isfinite(dist)])
+    gd = (mag[ind] < 50) & (err[ind] < 1)
+    if maglim is not None: gd &= (mag[ind] < maglim-1.0)
+    ind = ind[gd]
+    if len(ind)==0:
+        logger.warning("No PSF candidates matched to "+catfile)
+        return None
+
+    # Isolated stars spread over the image
+    with open(catfile,'r') as f:
+        head = [f.readline(),f.readline()]
+    if naxis1 is None: naxis1 = int(head[1].split()[1])
+    if naxis2 is None: naxis2 = int(head[1].split()[2])
+    cand = np.zeros(len(apcat),bool)
+    cand[ind] = True
+    fwhm = np.median(psfcat['FWHM'])
+    ind = _psfselect(apcat['X'],apcat['Y'],mag,1.0857/np.maximum(err,1e-5),cand,naxis1,naxis2,
+                     fwhm,nstars=nstars)
+    if len(ind)==0:
+        logger.warning("No isolated PSF stars found")
+        return None
+    logger.info(str(len(ind))+" PSF stars picked")
+
+    # Write the .lst file, the header is copied from the .ap file
+    f = open(outfile,'w')
+    f.write(head[0])
+    f.write("  3"+head[1][3:])
+    f.write("\n")
+    _daowrite(f,"%7d %8.3f %8.3f %8.3f %8.3f %8.3f",
+              [apcat['ID'][ind],apcat['X'][ind],apcat['Y'][ind],mag[ind],err[ind],apcat['SKY'][ind]])
+    f.close()
+
+    # Return the catalog
+    logger.info("Output file = "+outfile)
+    return daoread(outfile)
+
+
 # Make DAOPHOT option files
 #--------------------------
 def mkopt(base=None,meta=None,VA=1,LO=7.0,TH=3.5,LS=0.2,HS=1.0,LR=-1.0,HR=1.0,
@@ -1532,9 +1970,8 @@ def mkdaoim(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,logge
             logger.warning(f+" NOT found")
             return None
 
-    # Load the FITS files
+    # Load the FITS files, the weight image is not needed
     flux,fhead = fits.getdata(fluxfile,header=True)
-    wt,whead = fits.getdata(wtfile,header=True)
     mask,mhead = fits.getdata(maskfile,header=True)
 
     # Set bad pixels to saturation value
@@ -1616,9 +2053,69 @@ def mkdaoim(fluxfile=None,wtfile=None,maskfile=None,meta=None,outfile=None,logge
     fits.writeto(outfile,flux,fhead,overwrite=True)
 
 
+# Run DAOPHOT commands
+#---------------------
+def _rundaophot(imfile,optfile,timfile,toptfile,cmds,scriptfile,logfile,bindir,session=None,
+                logger=None,name="DAOPHOT",errmsg="DAOPHOT failed",outfiles=None):
+    """
+    Run a list of DAOPHOT commands (each a list of the command name and its answers)
+    on an image, either in a persistent DaophotSession or in a new DAOPHOT process
+    started from a shell script.  The output is appended to `logfile`.  `outfiles`
+    lists the output file of each command.  If the session does not create one of
+    them, the session is restarted and the commands are run with the script instead.
+    """
+    # Use the persistent session
+    if session is not None:
+        try:
+            session.run(imfile,optfile,cmds,logfile=logfile,outfiles=outfiles)
+            return
+        except Exception as e:
+            logger.warning(name+" failed in the DAOPHOT session: "+str(e)+".  Running it in a new DAOPHOT process")
+        try:
+            session.restart()
+        except Exception as e:
+            logger.warning("Could not restart the DAOPHOT session: "+str(e))
+        # Remove partial outputs, DAOPHOT won't overwrite them
+        for f in (outfiles or []):
+            if f is not None and os.path.exists(f): os.remove(f)
+
+    # Lines for the DAOPHOT script
+    lines = "#!/bin/sh\n" \
+            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
+            "OPTIONS\n" \
+            ""+toptfile+"\n" \
+            "\n" \
+            "ATTACH "+timfile+"\n"
+    lines += "".join([l+"\n" for c in cmds for l in c])
+    lines += "EXIT\n" \
+             "EXIT\n" \
+             "END_DAOPHOT\n"
+    # Write the script
+    f = open(scriptfile,'w')
+    f.writelines(lines)
+    f.close()
+    os.chmod(scriptfile,509)
+
+    # Run the script
+    try:
+        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
+        if retcode < 0:
+            logger.error("Child was terminated by signal"+str(-retcode))
+        else:
+            pass
+    except OSError as e:
+        logger.error(name+" failed:"+str(e))
+        logger.error(e)
+        traceback.print_exc()
+        raise Exception(errmsg)
+
+    # Delete the script
+    if os.path.exists(scriptfile): os.remove(scriptfile)
+
+
 # DAOPHOT FIND detection
 #-----------------------
-def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindir=None):
+def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindir=None,session=None):
     '''
     This runs DAOPHOT FIND on an image.
 
@@ -1640,6 +2137,9 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindi
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    session : DaophotSession, optional
+           Run the commands in this persistent DAOPHOT session instead of
+           starting a new DAOPHOT process.
 
     Returns
     -------
@@ -1693,41 +2193,16 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindi
     os.symlink(imfile,timfile)
     os.symlink(optfile,toptfile)
 
-    # Lines for the DAOPHOT script
-    lines = "#!/bin/sh\n" \
-            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
-            "OPTIONS\n" \
-            ""+toptfile+"\n" \
-            "\n" \
-            "ATTACH "+timfile+"\n" \
-            "FIND\n" \
-            "1,1\n" \
-            ""+toutfile+"\n" \
-            "y\n" \
-            "EXIT\n" \
-            "EXIT\n" \
-            "END_DAOPHOT\n"
-    # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    # DAOPHOT commands
+    cmds = [["FIND","1,1",toutfile,"y"]]
 
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=False)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT detection failed:"+str(e))
-        logger.error(e)
-        traceback.print_exc()        
-        raise Exception("DAOPHOT failed")
+    # Run DAOPHOT
+    _rundaophot(imfile,optfile,timfile,toptfile,cmds,scriptfile,logfile,bindir,session=session,
+                logger=logger,name="DAOPHOT detection",errmsg="DAOPHOT failed",
+                outfiles=[toutfile])
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -1760,9 +2235,6 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindi
         logger.error("Output file "+outfile+" NOT Found")
         raise Exception("Output not found")
 
-    # Delete the script
-    os.remove(scriptfile)
-
     # Load and return the catalog
     logger.info("Output file = "+outfile)
     return daoread(outfile)
@@ -1771,7 +2243,7 @@ def daofind(imfile=None,optfile=None,outfile=None,logfile=None,logger=None,bindi
 # DAOPHOT aperture photometry
 #----------------------------
 def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=None,
-                apersfile=None,logfile=None,logger=None,bindir=None):
+                apersfile=None,logfile=None,logger=None,bindir=None,session=None):
     '''
     This runs DAOPHOT aperture photometry on an image.
 
@@ -1801,6 +2273,9 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    session : DaophotSession, optional
+           Run the commands in this persistent DAOPHOT session instead of
+           starting a new DAOPHOT process.
 
     Returns
     -------
@@ -1885,26 +2360,8 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
     #f.write("OS = %7.4f\n" % apertures[nap-1])
     #f.close()
 
-    # Lines for the DAOPHOT script
-    lines = "#!/bin/sh\n" \
-            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
-            "OPTIONS\n" \
-            ""+toptfile+"\n" \
-            "\n" \
-            "ATTACH "+timfile+"\n" \
-            "PHOTOMETRY\n" \
-            ""+tapersfile+"\n" \
-            " \n" \
-            ""+tcoofile+"\n" \
-            ""+toutfile+"\n" \
-            "EXIT\n" \
-            "EXIT\n" \
-            "END_DAOPHOT\n"
-    # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    # DAOPHOT commands
+    cmds = [["PHOTOMETRY",tapersfile," ",tcoofile,toutfile]]
 
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
@@ -1919,18 +2376,10 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
     else:
         movedpsf = False
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT aperture photometry failed:"+str(e))
-        logger.error(e)
-        traceback.print_exc()        
-        raise Exception("DAOPHOT failed")
+    # Run DAOPHOT
+    _rundaophot(imfile,optfile,timfile,toptfile,cmds,scriptfile,logfile,bindir,session=session,
+                logger=logger,name="DAOPHOT aperture photometry",errmsg="DAOPHOT failed",
+                outfiles=[toutfile])
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -1957,9 +2406,6 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
         logger.error("Output file "+outfile+" NOT Found")
         raise Exception("Output not found")
 
-    # Delete the script
-    os.remove(scriptfile)
-
     # Move PSF file back
     if movedpsf is True: os.rename(psftemp,base+".psf")
 
@@ -1968,10 +2414,242 @@ def daoaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=Non
     return daoread(outfile), maglim
 
 
+# Read DAOPHOT option file
+def optread(filename):
+    '''
+    Read a DAOPHOT/ALLSTAR option file into a dictionary.
+
+    Parameters
+    ----------
+    filename : str
+        The filename of the option file.
+
+    Returns
+    -------
+    opt : dict
+        The option values, keys are the upper-case two-letter option names.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        opt = optread("image.opt")
+
+    '''
+    opt = {}
+    for line in readlines(filename):
+        arr = line.split('=')
+        if len(arr)<2: continue
+        try:
+            opt[arr[0].strip().upper()] = float(arr[1])
+        except ValueError:
+            pass
+    return opt
+
+
+def _skymode(vals):
+    '''
+    DAOPHOT-style sky estimate for each row of a 2D array of sky annulus pixels
+    (NaN for unused pixels).  Outliers are clipped at 3 sigma around the median
+    and the mode is estimated as 3*median-2*mean (or the mean if it is lower).
+
+    Returns the sky, sky sigma, sky skewness and number of sky pixels.
+    '''
+    vals = vals.copy()
+    for i in range(3):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore",category=RuntimeWarning)
+            med = np.nanmedian(vals,axis=1)
+            sig = np.nanstd(vals,axis=1)
+        bad = np.abs(vals-med.reshape(-1,1)) > 3*sig.reshape(-1,1)
+        vals[bad] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore",category=RuntimeWarning)
+        med = np.nanmedian(vals,axis=1)
+        mean = np.nanmean(vals,axis=1)
+        sig = np.nanstd(vals,axis=1)
+        skew = np.nanmean((vals-mean.reshape(-1,1))**3,axis=1)/sig**3
+    nsky = np.sum(np.isfinite(vals),axis=1)
+    sky = np.where(mean < med, mean, 3*med-2*mean)
+    return sky,sig,skew,nsky
+
+
+# Aperture photometry in python
+#------------------------------
+def sepaperphot(imfile=None,coofile=None,apertures=None,outfile=None,optfile=None,
+                apersfile=None,nchunk=1000,logger=None):
+    '''
+    Multi-aperture photometry with sep.sum_circle.  This is an in-process
+    alternative to daoaperphot that uses the DAOPHOT sky annulus, bad pixel
+    rules, magnitude zero-point (25) and error model, and writes a DAOPHOT .ap file.
+
+    Parameters
+    ----------
+    imfile : str
+           The filename of the DAOPHOT-ready FITS image.
+    coofile : str, optional
+            The filename of the catalog of sources for which to obtain aperture photometry.
+            By default it is assumed that this is the base name of `imfile` with a ".coo" suffix.
+    apertures : list or array, optional
+             The list of aperture to use.  The last two are used as the inner and outer sky radius.
+             The default apertures are: apertures = [3.0, 6.0803, 9.7377, 15.5952, 19.7360, 40.0, 50.0]
+    outfile : str, optional
+            The output filename of the aperture photometry catalog.  By default this is
+            the base name of `imfile` with a ".ap" suffix.
+    optfile : str, optional
+            The option file for `imfile`.  By default it is assumed that this is
+            the base name of `imfile` with a ".opt" suffix.
+    apersfile : str, optional
+              The file that the apertures are written to.
+    nchunk : int, optional
+           The number of stars to measure the sky for at a time.  Default is 1000.
+    logger : logging object
+           The logger to use for the loggin information.
+
+    Returns
+    -------
+    cat : astropy table
+        The aperture photometry catalog.
+    maglim : float
+        The 5 sigma magnitude limit in the first aperture.
+
+    The output catalog will also be created.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        cat, maglim = sepaperphot("image.fits","image.coo")
+
+    '''
+
+    if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+    logger.info("-- Running python aperture photometry --")
+
+    # Make sure we have the image file name
+    if imfile is None:
+        logger.warning("No image filename input")
+        return None
+
+    # Set up filenames, make sure they don't exist
+    base = os.path.basename(imfile)
+    base = os.path.splitext(os.path.splitext(base)[0])[0]
+    if optfile is None: optfile = base+".opt"
+    if coofile is None: coofile = base+".coo"
+    if outfile is None: outfile = base+".ap"
+    if apersfile is None: apersfile = base+".apers"
+    for f in [outfile,apersfile]:
+        if os.path.exists(f): os.remove(f)
+
+    # Check that necessary files exist
+    for f in [imfile,optfile,coofile]:
+        if os.path.exists(f) is False:
+            logger.warning(f+" NOT found")
+            return None
+    logger.info("coofile = "+coofile)
+
+    # Apertures, the last two are inner and outer sky apertures
+    if apertures is None:
+        apertures = [3.000, 6.0803, 9.7377, 15.5952, 19.7360, 40.0000, 50.0000]
+    aperswrite(apersfile,apertures)
+    apertures = np.array(apertures,float)
+    rapers = apertures[0:-2]
+    rin,rout = apertures[-2],apertures[-1]
+    naper = len(rapers)
+
+    # Load the image, options and star list
+    im,head = fits.getdata(imfile,header=True)
+    im = np.ascontiguousarray(im,dtype=np.float64)
+    ny,nx = im.shape
+    opt = optread(optfile)
+    gain = opt.get('GA',1.0)
+    rdnoise = opt.get('RE',0.0)
+    lobad = opt.get('LO',7.0)
+    hibad = opt.get('HI',np.inf)
+    coo = daoread(coofile)
+    nstars = len(coo)
+    x = np.array(coo['X'],float)-1     # DAOPHOT is 1-based
+    y = np.array(coo['Y'],float)-1
+
+    # Sky in the annulus, done in chunks of stars
+    #  pixel offsets of the annulus
+    irad = int(np.ceil(rout))
+    yy,xx = np.mgrid[-irad:irad+1,-irad:irad+1]
+    rr = np.sqrt(xx**2+yy**2)
+    annind = (rr >= rin) & (rr <= rout)
+    dx = xx[annind]
+    dy = yy[annind]
+    sky = np.zeros(nstars,float)
+    skysig = np.zeros(nstars,float)
+    skyskew = np.zeros(nstars,float)
+    nsky = np.zeros(nstars,int)
+    xr = np.round(x).astype(int)
+    yr = np.round(y).astype(int)
+    for lo in range(0,nstars,nchunk):
+        hi = np.minimum(lo+nchunk,nstars)
+        px = xr[lo:hi].reshape(-1,1)+dx.reshape(1,-1)
+        py = yr[lo:hi].reshape(-1,1)+dy.reshape(1,-1)
+        inside = (px >= 0) & (px < nx) & (py >= 0) & (py < ny)
+        vals = im[np.clip(py,0,ny-1),np.clip(px,0,nx-1)]
+        vals[~inside | (vals > hibad)] = np.nan
+        sky[lo:hi],skysig[lo:hi],skyskew[lo:hi],nsky[lo:hi] = _skymode(vals)
+
+    # Bad pixels, above HIGHBAD or LO sigma below the median sky
+    lowbad = np.nanmedian(sky)-lobad*np.nanmedian(skysig)
+    badmask = (im > hibad) | (im < lowbad) | ~np.isfinite(im)
+    im[~np.isfinite(im)] = 0.0
+
+    # Aperture sums, all stars at once for each aperture
+    mag = np.zeros((nstars,naper),float)+99.999
+    err = np.zeros((nstars,naper),float)+9.9999
+    skyvar = skysig**2
+    for j in range(naper):
+        flux,fluxerr,flag = sep.sum_circle(im,x,y,rapers[j],mask=badmask,subpix=5)
+        area = np.pi*rapers[j]**2
+        flux = flux-area*sky
+        # DAOPHOT error model, sky noise + poisson noise + error in the sky
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore",category=RuntimeWarning)
+            error1 = area*skyvar
+            error2 = np.maximum(flux,0)/gain
+            error3 = skyvar*area**2/np.maximum(nsky,1)
+            magerr = 1.0857*np.sqrt(error1+error2+error3)/flux
+            good = ((flag & sep.APER_HASMASKED)==0) & ((flag & sep.APER_TRUNC)==0) & (flux > 0) & \
+                   np.isfinite(sky) & (nsky > 0)
+            mag[good,j] = 25.0-2.5*np.log10(flux[good])
+            err[good,j] = np.minimum(magerr[good],9.9999)
+
+    # 5 sigma magnitude limit in the first aperture
+    area1 = np.pi*rapers[0]**2
+    skynoise = np.sqrt(area1*np.nanmedian(skyvar)*(1+area1/np.maximum(np.median(nsky),1)))
+    maglim = 25.0-2.5*np.log10(5*skynoise)
+    logger.info("Estimated magnitude limit (Aperture 1): %6.2f" % maglim)
+
+    # Write the .ap file
+    #  the header values are NX, NY, LOWBAD, HIGHBAD, THRESH, AP1, PH/ADU, RNOISE and FRAD
+    f = open(outfile,'w')
+    f.write(" NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n")
+    f.write("  2 %5d %5d %7.1f %7.1f %7.2f %7.2f %7.2f %7.2f %7.2f\n" %
+            (nx,ny,lowbad,hibad if np.isfinite(hibad) else 99999.0,opt.get('TH',3.5),rapers[0],
+             gain,rdnoise,opt.get('FI',3.0)))
+    f.write("\n")
+    fmt = "\n%7d%9.3f%9.3f"+"%9.3f"*naper+"\n%14.3f%6.2f%6.2f"+"%9.4f"*naper
+    cols = [coo['ID'],x+1,y+1]+[mag[:,j] for j in range(naper)]
+    cols += [sky,np.minimum(skysig,99.99),np.clip(skyskew,-9.99,99.99)]+[err[:,j] for j in range(naper)]
+    _daowrite(f,fmt,[np.nan_to_num(np.asarray(c),nan=99.999) for c in cols])
+    f.close()
+
+    # Return the catalog
+    logger.info("Output file = "+outfile)
+    return daoread(outfile), maglim
+
+
 # Pick PSF stars using DAOPHOT
 #-----------------------------
 def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,
-               optfile=None,logfile=None,logger=None,bindir=None):
+               optfile=None,logfile=None,logger=None,bindir=None,session=None):
     '''
     This runs DAOPHOT aperture photometry on an image.
 
@@ -1999,6 +2677,9 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    session : DaophotSession, optional
+           Run the commands in this persistent DAOPHOT session instead of
+           starting a new DAOPHOT process.
 
     Returns
     -------
@@ -2064,41 +2745,16 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,
     if numlines(tcatfile)<200:
         usemaglim = maglim
 
-    # Lines for the DAOPHOT script
-    lines = "#!/bin/sh\n" \
-            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
-            "OPTIONS\n" \
-            ""+toptfile+"\n" \
-            "\n" \
-            "ATTACH "+timfile+"\n" \
-            "PICKPSF\n" \
-            ""+tcatfile+"\n" \
-            ""+str(nstars)+","+str(usemaglim)+"\n" \
-            ""+toutfile+"\n" \
-            "EXIT\n" \
-            "EXIT\n" \
-            "END_DAOPHOT\n"
-    # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    # DAOPHOT commands
+    cmds = [["PICKPSF",tcatfile,str(nstars)+","+str(usemaglim),toutfile]]
 
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT PICKPSF failed:"+str(e))
-        logger.error(e)
-        traceback.print_exc()
-        raise Exception("DAOPHOT failed")
+    # Run DAOPHOT
+    _rundaophot(imfile,optfile,timfile,toptfile,cmds,scriptfile,logfile,bindir,session=session,
+                logger=logger,name="DAOPHOT PICKPSF",errmsg="DAOPHOT failed",
+                outfiles=[toutfile])
 
     # Check that the output file exists
     if os.path.exists(toutfile) is True:
@@ -2118,9 +2774,6 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,
         logger.error("Output file "+outfile+" NOT Found")
         raise Exception("DAOPHOT failed")
 
-    # Delete the script
-    os.remove(scriptfile)
-
     # Return the catalog
     logger.info("Output file = "+outfile)
     return daoread(outfile)
@@ -2129,7 +2782,7 @@ def daopickpsf(imfile=None,catfile=None,maglim=None,outfile=None,nstars=100,
 # Run DAOPHOT PSF
 #-------------------
 def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfile=None,
-           logfile=None,verbose=False,logger=None,bindir=None):
+           logfile=None,verbose=False,logger=None,bindir=None,session=None):
     '''
     This runs DAOPHOT PSF to create a .psf file.
 
@@ -2161,6 +2814,9 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    session : DaophotSession, optional
+           Run the commands in this persistent DAOPHOT session instead of
+           starting a new DAOPHOT process.
 
     Returns
     -------
@@ -2232,42 +2888,16 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
     os.symlink(listfile,tlistfile)
     os.symlink(apfile,tapfile)
 
-    # Lines for the DAOPHOT script
-    lines = "#!/bin/sh\n" \
-            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
-            "OPTIONS\n" \
-            ""+toptfile+"\n" \
-            "\n" \
-            "ATTACH "+timfile+"\n" \
-            "PSF\n" \
-            ""+tapfile+"\n" \
-            ""+tlistfile+"\n" \
-            ""+toutfile+"\n" \
-            "\n" \
-            "EXIT\n" \
-            "EXIT\n" \
-            "END_DAOPHOT\n"
-    # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    # DAOPHOT commands
+    cmds = [["PSF",tapfile,tlistfile,toutfile,""]]
 
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False: shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("DAOPHOT PSF failed:"+str(e))
-        logger.error(e)
-        traceback.print_exc()
-        raise Exception("DAOPHOT failed")
+    # Run DAOPHOT
+    _rundaophot(imfile,optfile,timfile,toptfile,cmds,scriptfile,logfile,bindir,session=session,
+                logger=logger,name="DAOPHOT PSF",errmsg="DAOPHOT failed",
+                outfiles=[toutfile])
 
     # Check that the output file exists
     if (os.path.exists(toutfile)) is True and (os.path.getsize(toutfile)!=0):
@@ -2303,9 +2933,6 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
         logger.error("Output file "+outfile+" NOT Found")
         raise Exception("DAOPHOT output not found")
 
-    # Delete the script
-    os.remove(scriptfile)
-
     # Return the parameter and profile error information
     logger.info("Output file = "+outfile)
     return pararr, parchi, profs
@@ -2314,7 +2941,7 @@ def daopsf(imfile=None,listfile=None,apfile=None,optfile=None,neifile=None,outfi
 # Subtract neighbors of PSF stars
 #--------------------------------
 def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,psffile=None,
-              nstfile=None,grpfile=None,logfile=None,logger=None,bindir=None):
+              nstfile=None,grpfile=None,logfile=None,logger=None,bindir=None,session=None):
     '''
     This subtracts neighbors of PSF stars so that an improved PSF can be made.
 
@@ -2350,6 +2977,9 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
     bindir : str, optional
            The path to whatever directory ("/home/x25h971/bin/" for katie on tempest)
            you keep your SE command in
+    session : DaophotSession, optional
+           Run the commands in this persistent DAOPHOT session instead of
+           starting a new DAOPHOT process.
 
     Returns
     -------
@@ -2421,53 +3051,19 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
     os.symlink(photfile,tphotfile)
     os.symlink(psffile,tpsffile)
 
-    # Lines for the DAOPHOT script
-    lines = "#!/bin/sh\n" \
-            ""+bindir+"daophot << END_DAOPHOT >> "+logfile+"\n" \
-            "OPTIONS\n" \
-            ""+toptfile+"\n" \
-            "\n" \
-            "ATTACH "+timfile+"\n" \
-            "GROUP\n" \
-            ""+tphotfile+"\n" \
-            ""+tpsffile+"\n" \
-            "5.\n" \
-            ""+tgrpfile+"\n" \
-            "NSTAR\n" \
-            ""+tpsffile+"\n" \
-            ""+tgrpfile+"\n" \
-            ""+tnstfile+"\n" \
-            "SUBSTAR\n" \
-            ""+tpsffile+"\n" \
-            ""+tnstfile+"\n" \
-            "y\n" \
-            ""+tlistfile+"\n" \
-            ""+toutfile+"\n" \
-            "\n" \
-            "EXIT\n" \
-            "END_DAOPHOT\n"
-    # Write the script
-    f = open(scriptfile,'w')
-    f.writelines(lines)
-    f.close()
-    os.chmod(scriptfile,509)
+    # DAOPHOT commands
+    cmds = [["GROUP",tphotfile,tpsffile,"5.",tgrpfile],
+            ["NSTAR",tpsffile,tgrpfile,tnstfile],
+            ["SUBSTAR",tpsffile,tnstfile,"y",tlistfile,toutfile,""]]
 
     # Copy option file to daophot.opt
     if os.path.exists("daophot.opt") is False:
         shutil.copyfile(base+".opt","daophot.opt")
 
-    # Run the script
-    try:
-        retcode = subprocess.call(["./"+scriptfile],stderr=subprocess.STDOUT,shell=True)
-        if retcode < 0:
-            logger.error("Child was terminated by signal"+str(-retcode))
-        else:
-            pass
-    except OSError as e:
-        logger.error("PSF star neighbor subtracting failed:"+str(e))
-        logger.error(e)
-        traceback.print_exc()
-        raise Exception("PSF subtraction failed")
+    # Run DAOPHOT
+    _rundaophot(imfile,optfile,timfile,toptfile,cmds,scriptfile,logfile,bindir,session=session,
+                logger=logger,name="PSF star neighbor subtracting",errmsg="PSF subtraction failed",
+                outfiles=[tgrpfile,tnstfile,toutfile])
 
     # Check that the output file exists
     if os.path.exists(toutfile):
@@ -2481,9 +3077,6 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
         logger.error("Output file "+outfile+" NOT Found")
         raise Exception("PSF subtraction failed")
 
-    # Delete the script
-    os.remove(scriptfile)
-
     # Print final output filename
     logger.info("Output file = "+outfile)
 
@@ -2493,7 +3086,7 @@ def subpsfnei(imfile=None,listfile=None,photfile=None,outfile=None,optfile=None,
 def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,maxiter=5,
               minstars=6,nsigrej=2,subneighbors=True,subfile=None,optfile=None,neifile=None,
               nstfile=None,grpfile=None,meta=None,logfile=None,verbose=False,logger=None,
-              submaxit=5,subminit=2):#ktedit:cpsf
+              submaxit=5,subminit=2,session=None):#ktedit:cpsf
     '''
     Iteratively create a DAOPHOT PSF for an image.
 
@@ -2548,6 +3141,9 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
            The maximum number of times to iterate the entire flag & neighbor subtraction process
     subminit : int, optional, default = 2 #ktedit:cpsf
            The minimum number of times to iterate the entire flag & neighbor subtraction process
+    session : DaophotSession, optional
+           Run DAOPHOT PSF and the neighbor subtraction in this persistent DAOPHOT
+           session instead of starting a new DAOPHOT process for each step.
 
     Returns
     -------
@@ -2646,7 +3242,7 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
             logger.info("Iter = "+str(niter))
             # Run DAOPSF
             try:
-                pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,logger=logger)
+                pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,logger=logger,session=session)
                 chi = np.min(parchi)
                 mean_chi = np.mean(profs['SIG'])
                 logger.info("mean chi = "+str(mean_chi))
@@ -2665,7 +3261,7 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
                     opttable[14] = 'AN = '+newanpsf
                     writelines(optfile,opttable,overwrite=True)                    
                     logger.info('Retrying DAOPHOT PSF with AN='+newanpsf)
-                    pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,logger=logger)
+                    pararr, parchi, profs = daopsf(imfile,wlistfile,apfile,logger=logger,session=session)
                     chi = np.min(parchi)
                     mean_chi = np.mean(profs['SIG'])     
                     logger.info("mean chi = "+str(mean_chi))
@@ -2713,7 +3309,8 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
             subfile = base+"a.fits"
             #subfile = base+str(subiter)+"a.fits" #ktedit:cpsf
             try:
-                subpsfnei(imfile,wlistfile,neifile,subfile,psffile=psffile,logger=logger)
+                subpsfnei(imfile,wlistfile,neifile,subfile,psffile=psffile,logger=logger,
+                          session=session)
             except:
                 logger.error("Subtracting neighbors failed.  Keeping original PSF file")
                 traceback.print_exc()                
@@ -2729,7 +3326,7 @@ def createpsf(imfile=None,apfile=None,listfile=None,psffile=None,doiter=True,max
                 os.rename(subfile,imfile) 
                 logger.info(imfile+" once again moved to temp_"+imfile+", "+subfile+" moved to "+imfile) 
                 try:
-                    spararr, sparchi, sprofs = daopsf(imfile,wlistfile,apfile,logger=logger)
+                    spararr, sparchi, sprofs = daopsf(imfile,wlistfile,apfile,logger=logger,session=session)
                     chi = np.min(sparchi)
 
                     subsigs, profsind, sprofsind = np.intersect1d(profs['ID'],sprofs['ID'],return_indices=True)  
@@ -3117,9 +3714,254 @@ def daogrow(photfile,aperfile,meta,nfree=3,fixedvals=None,maxerr=0.2,logfile=Non
     return daoread(outfile)
 
 
+# Analytic curve of growth
+def cogfrac(r,ri,pars):
+    '''
+    The fraction of a star's light inside radius r for a Stetson (1990)
+    style stellar profile.  The profile is a Moffat function plus a Gaussian
+    and an exponential, all scaled by the seeing radius ri:
+
+      S(r) = B*M(r;A) + (1-B)*[(1-C)*G(r;D) + C*H(r;E)]
+
+    A is the Moffat exponent, B the Moffat fraction, C the exponential fraction
+    of the rest, D the Gaussian sigma and E the exponential scale length (both
+    in units of ri).  E=0 means the exponential light is all at the center.
+
+    Parameters
+    ----------
+    r : numpy array
+        The radii in pixels.
+    ri : float
+        The seeing radius in pixels.
+    pars : list or array
+        The five profile parameters [A, B, C, D, E].
+
+    Returns
+    -------
+    frac : numpy array
+        The fraction of the light inside each radius.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        frac = cogfrac(apertures,2.5,[1.03,0.2,0.1,0.6,0.0])
+
+    '''
+    A,B,C,D,E = pars
+    r = np.asarray(r,float)
+    fm = 1-(1+(r/ri)**2)**(1-A)
+    fg = 1-np.exp(-0.5*(r/(D*ri))**2)
+    if E > 0:
+        fh = 1-(1+r/(E*ri))*np.exp(-r/(E*ri))
+    else:
+        fh = np.ones(r.shape,float)
+    return B*fm + (1-B)*((1-C)*fg + C*fh)
+
+
+# Curve of growth analysis in python
+#-----------------------------------
+def curveofgrowth(photfile,aperfile,meta,nfree=3,fixedvals=None,maxerr=0.2,logger=None):
+    '''
+    Calculate total magnitudes from multi-aperture photometry with a curve of growth.
+    This is a pure python alternative to DAOGROW.  One analytic profile (see cogfrac)
+    is fit to the aperture-to-aperture magnitude differences of all stars at once.
+    Like DAOGROW, the total magnitude of each star is its magnitude in one aperture plus
+    the model correction from that aperture to infinity, using the aperture with the
+    smallest combined photometric and curve of growth model error.
+
+    Parameters
+    ----------
+    photfile : str
+             The aperture photometry file.
+    aperfile : str
+             The file containing the apertures used for the aperture photometry.
+    meta : astropy header
+           The meta-data dictionary for the image.
+    nfree : float, optional, default = 3
+          The number of profile parameters to fit.  Max is 5.
+    fixedvals : float, optional
+          The values for the parameters that are fixed.  Should have 5-nfree elements.
+          By default they are [1.03, 0.2, 0.1, 0.6, 0.0].
+    maxerr : float, optional, default = 0.2
+           The maximum magnitude error to use.
+    logger : logging object
+           The logger to use for the logging information.
+
+    Returns
+    -------
+    totcat : astropy table
+           The aperture corrected photometry (.tot) catalog.
+    Also, the .tot file is created.
+
+    Example
+    -------
+
+    .. code-block:: python
+
+        totcat = curveofgrowth("im101a.ap","photo.opt",meta)
+
+    '''
+    if logger is None: logger=basiclogger('phot')   # set up basic logger if necessary
+    logger.info("-- Running curve of growth analysis --")
+
+    # Make sure we have photfile
+    if photfile is None:
+        logger.warning("No photfile input")
+        return None
+    # Make sure we have aperfile
+    if aperfile is None:
+        logger.warning("No aperfile input")
+        return None
+    # Make sure we have the meta-data dictionary
+    if meta is None:
+        logger.warning("No meta input")
+        return None
+    # Checked number of elements for fixedvals
+    if fixedvals is not None:
+        if len(fixedvals) != 5-nfree:
+            logger.warning("Fixedvals must have 5-nfree elements."+str(len(fixedvals))+" found.")
+            return None
+    # Check that necessary files exist
+    for f in [photfile,aperfile]:
+        if os.path.exists(f) is False:
+            logger.warning(f+" NOT found")
+            return None
+
+    base = os.path.basename(photfile)
+    base = os.path.splitext(os.path.splitext(base)[0])[0]
+    outfile = base+".tot"
+    if os.path.exists(outfile): os.remove(outfile)
+
+    # Load the aperture photometry and radii
+    apcat = daoread(photfile)
+    apertures = apersread(aperfile)
+    nstars = len(apcat)
+    mag = np.array(apcat['MAG']).reshape(nstars,-1)
+    err = np.array(apcat['ERR']).reshape(nstars,-1)
+    naper = mag.shape[1]
+    if len(apertures) < naper:
+        raise ValueError(aperfile+" has "+str(len(apertures))+" apertures but "+photfile+
+                         " has photometry for "+str(naper))
+    apertures = np.asarray(apertures[0:naper],float)
+    good = np.isfinite(mag) & np.isfinite(err) & (mag < 90) & (err < maxerr)
+    # Only use apertures out to the first bad one
+    good = np.cumprod(good,axis=1).astype(bool)
+
+    # Aperture-to-aperture magnitude differences for all stars
+    dgood = good[:,1:] & good[:,:-1]
+    dmag = (mag[:,1:]-mag[:,:-1])[dgood]
+    derr = np.sqrt(err[:,1:]**2+err[:,:-1]**2)[dgood]
+    derr = np.maximum(derr,0.001)
+    aperind = np.repeat(np.arange(naper-1).reshape(1,-1),nstars,axis=0)[dgood]
+
+    # The free and fixed parameters
+    allpars = np.array([1.03, 0.2, 0.1, 0.6, 0.0])
+    if fixedvals is not None:
+        allpars[nfree:] = fixedvals
+    lbounds = np.array([1.001, 0.0, 0.0, 0.05, 0.0])
+    ubounds = np.array([10.0, 1.0, 1.0, 10.0, 10.0])
+    # Initial seeing radius from the FWHM (arcsec)
+    ri0 = 3.0
+    if meta.get('FWHM') is not None and meta.get('PIXSCALE') is not None:
+        ri0 = np.maximum(0.71*meta['FWHM']/meta['PIXSCALE'],0.5)
+
+    def cogmodel(x):
+        pars = allpars.copy()
+        pars[0:nfree] = x[1:]
+        frac = cogfrac(apertures,np.exp(x[0]),pars)
+        return -2.5*np.log10(frac[1:]/frac[:-1]),pars,np.exp(x[0])
+
+    def cogresid(x):
+        dmodel,pars,ri = cogmodel(x)
+        return (dmag-dmodel[aperind])/derr
+
+    totmag = np.zeros(nstars,float)+np.nan
+    toterr = np.zeros(nstars,float)+np.nan
+    magfap = np.zeros(nstars,float)+99.999
+    apcorr = np.zeros(nstars,float)
+    finalap = np.zeros(nstars,int)
+    if len(dmag) > nfree+1:
+        x0 = np.concatenate(([np.log(ri0)],allpars[0:nfree]))
+        x0[1:] = np.clip(x0[1:],lbounds[0:nfree],ubounds[0:nfree])
+        lb = np.concatenate(([np.log(0.1)],lbounds[0:nfree]))
+        ub = np.concatenate(([np.log(100.0)],ubounds[0:nfree]))
+        try:
+            res = least_squares(cogresid,x0,bounds=(lb,ub),loss='soft_l1')
+            dmodel,pars,ri = cogmodel(res.x)
+            chisq = np.sum(res.fun**2)/np.maximum(len(dmag)-nfree-1,1)
+            logger.info("Curve of growth: Ri=%.3f A=%.3f B=%.3f C=%.3f D=%.3f E=%.3f chisq=%.2f" %
+                        ((ri,)+tuple(pars)+(chisq,)))
+            # Error of the model correction from each aperture outward.  The
+            #  residuals of a star are correlated from step to step (e.g. PSF
+            #  variations), so use the scatter of the summed residuals from
+            #  each aperture out to the star's last good aperture, minus the
+            #  photometric errors, plus the uncertainty of the mean profile
+            frac = cogfrac(apertures,ri,pars)
+            corr = 2.5*np.log10(frac)
+            resid2d = np.zeros((nstars,naper-1),float)
+            resid2d[dgood] = dmag-dmodel[aperind]
+            cumresid = np.flip(np.cumsum(np.flip(resid2d,axis=1),axis=1),axis=1)
+            lastap = np.sum(good,axis=1)-1
+            modelerr = np.zeros(naper,float)
+            for k in range(naper-1):
+                ind, = np.where(lastap > k)
+                if len(ind) < 3:
+                    modelerr[k] = 0.1   # poorly constrained
+                    continue
+                sig = mad(cumresid[ind,k])
+                obsvar = np.median(err[ind,k]**2+err[ind,lastap[ind]]**2)
+                modelerr[k] = np.sqrt(np.maximum(sig**2-obsvar,0.0)+sig**2/len(ind))
+            # Total magnitude, like DAOGROW, from the aperture that gives
+            #  the smallest combined photometric and model error
+            toterr2 = np.where(good,err**2+modelerr.reshape(1,-1)**2,np.inf)
+            ngood = lastap+1
+            gdstar, = np.where(ngood > 0)
+            best = np.argmin(toterr2[gdstar],axis=1)
+            finalap[gdstar] = best+1
+            magfap[gdstar] = mag[gdstar,best]
+            apcorr[gdstar] = corr[best]
+            totmag[gdstar] = magfap[gdstar]+apcorr[gdstar]
+            toterr[gdstar] = np.sqrt(toterr2[gdstar,best])
+            bdstar, = np.where(ngood == 0)
+            totmag[bdstar] = 99.999
+            toterr[bdstar] = 9.9999
+        except:
+            logger.warning("Curve of growth fit failed")
+            traceback.print_exc()
+    else:
+        logger.warning("Not enough good aperture photometry for the curve of growth")
+
+    # Write the .tot file
+    dtype = np.dtype([('ID',int),('X',float),('Y',float),('MAG',float),('ERR',float),('SKY',float),
+                      ('MAGFAP',float),('APCORR',float),('FINALAP',int)])
+    totcat = np.zeros(nstars,dtype=dtype)
+    for n in ['ID','X','Y','SKY']:
+        totcat[n] = apcat[n]
+    totcat['MAG'] = totmag
+    totcat['ERR'] = toterr
+    totcat['MAGFAP'] = magfap
+    totcat['APCORR'] = apcorr
+    totcat['FINALAP'] = finalap
+    # Header from the aperture photometry file with NL=1
+    with open(photfile,'r') as f:
+        head = [f.readline(),f.readline()]
+    head[1] = '  1'+head[1][3:]
+    f = open(outfile,'w')
+    f.write(head[0]+head[1]+"\n")
+    _daowrite(f,"%7d %8.3f %8.3f %8.4f %8.4f %8.3f %8.3f %8.4f %8d",
+              [totcat[n] for n in totcat.dtype.names])
+    f.close()
+    logger.info("Output file = "+outfile)
+
+    return Table(totcat)
+
+
 # Calculate aperture corrections
 #-------------------------------
-def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfile=None,logger=None):
+def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfile=None,logger=None,
+          method='daogrow',aperphot='daophot'):
     '''
     Calculate the aperture correction for an image.
 
@@ -3142,6 +3984,12 @@ def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfi
             run.  By default this is the base name of `imfile` with a ".daogrow.log" suffix.
     logger : logging object
            The logger to use for the loggin information.
+    method : str, optional
+           The curve of growth code to use, 'daogrow' (the DAOGROW program,
+           the default) or 'python' (curveofgrowth).
+    aperphot : str, optional
+           The aperture photometry code, 'daophot' (daoaperphot, the default)
+           or 'sep' (sepaperphot).
 
     Returns
     -------
@@ -3199,27 +4047,35 @@ def apcor(imfile=None,listfile=None,psffile=None,meta=None,optfile=None,alsoptfi
     apertures = [3.0, 3.7965, 4.8046, 6.0803, 7.6947, 9.7377, 12.3232, 15.5952, 19.7360, \
                  24.9762, 31.6077, 40.0000, 50.0000]
     apersfile = base+".apers"
-    apcat, maglim = daoaperphot(imfile,listfile,apertures,optfile=optfile,
-                                apersfile=apersfile,logger=logger)
+    if aperphot=='sep':
+        apcat, maglim = sepaperphot(imfile,listfile,apertures,optfile=optfile,
+                                    apersfile=apersfile,logger=logger)
+    else:
+        apcat, maglim = daoaperphot(imfile,listfile,apertures,optfile=optfile,
+                                    apersfile=apersfile,logger=logger)
 
     # Step 2: Get PSF photometry from the same image
     psfcat = allstar(imfile,psffile,base+".ap",optfile=alsoptfile,logger=logger)
 
-    # Step 3: Run DAOGROW
+    # Step 3: Run DAOGROW (or the python curve of growth fitter)
     #  it creates a .tot, .cur, .poi files
     #  use .tot and .als files to calculate delta mag for each star (see mkdel.pro)
     #  and then a total aperture correction for all the stars.
-    totcat = daogrow(base+".ap",apersfile,meta,logger=logger)
+    if method=='python':
+        growfunc = curveofgrowth
+    else:
+        growfunc = daogrow
+    totcat = growfunc(base+".ap",apersfile,meta,logger=logger)
     # Check that the magnitudes arent' all NANs, this can sometimes happen
     if np.sum(np.isnan(totcat['MAG'])) > 0:
-        logger.info("DAOGROW .tot file has NANs.  Trying 2 free parameters instead.")
-        totcat = daogrow(base+".ap",apersfile,meta,nfree=2,logger=logger)
+        logger.info("Curve of growth magnitudes have NANs.  Trying 2 free parameters instead.")
+        totcat = growfunc(base+".ap",apersfile,meta,nfree=2,logger=logger)
     if np.sum(np.isnan(totcat['MAG'])) > 0:
-        logger.info("DAOGROW .tot file has NANs.  Trying 4 free parameters instead.")
-        totcat = daogrow(base+".ap",apersfile,meta,nfree=4,logger=logger)
+        logger.info("Curve of growth magnitudes have NANs.  Trying 4 free parameters instead.")
+        totcat = growfunc(base+".ap",apersfile,meta,nfree=4,logger=logger)
 
     # Step 4: Calculate median aperture correction
-    totcat = daoread(base+".tot")
+    totcat = totcat[totcat['MAG'] < 50]
     # Match up with the stars we are deleting
     mid, ind1, ind2 = np.intersect1d(psfcat['ID'],totcat['ID'],return_indices=True)
     apcorr = np.median(psfcat[ind1]['MAG']-totcat[ind2]['MAG'])
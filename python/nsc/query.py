@@ -8,12 +8,11 @@ from astropy.io import fits,ascii
 from astropy.table import Table,vstack,Column
 import subprocess
 from dlnpyutils import utils as dln,coords
-from dustmaps.sfd import SFDQuery
 from astroquery.vizier import Vizier
 from astropy.coordinates import Angle,SkyCoord
 import healpy as hp
 import astropy.units as u
-from . import utils,modelmag
+from . import utils,modelmag,extinction
 
 Vizier.TIMEOUT = 600
 Vizier.ROW_LIMIT = -1
@@ -537,6 +536,12 @@ def getexttype(cenra,cendec,radius):
     #     data available 
     # 3 - RJCE GLIMPSE, GLIMPSE data available 
     # 4 - RJCE SAGE, SAGE data available 
+
+    # Already figured out for this region
+    ext_type = extinction.getexttypecache(cenra,cendec,radius)
+    if ext_type is not None:
+        return ext_type
+
     ext_type = 0 
     cencoo = SkyCoord(ra=cenra,dec=cendec,unit='deg')
     cengl = cencoo.galactic.l.deg
@@ -547,9 +552,7 @@ def getexttype(cenra,cendec,radius):
     x = np.linspace(-radius,radius,100).reshape(-1,1) + np.zeros(100,float).reshape(1,-1)
     y = np.zeros(100,float).reshape(-1,1) + np.linspace(-radius,radius,100)
     rr,dd = coords.rotsphcen(x,y,cenra,cendec,gnomic=True,reverse=True)
-    coo = SkyCoord(ra=rr,dec=dd,unit='deg')
-    sfd = SFDQuery()
-    ebv_grid = sfd(coo)
+    ebv_grid = extinction.getebv(rr.flatten(),dd.flatten())
     maxebv = np.max(ebv_grid) 
 
     # Check if there is any GLIMPSE data available 
@@ -598,6 +601,8 @@ def getexttype(cenra,cendec,radius):
     # SFD, |b|>16 and RLMC>5.0 and RSMC>4.0 and max(EBV)<0.2 
     if ext_type == 0: 
         ext_type = 1 
+
+    extinction.setexttypecache(cenra,cendec,radius,ext_type)
      
     return ext_type 
 
@@ -1176,9 +1181,7 @@ def getreddening(ref,ext_type):
     """
      
     # Add SFD reddening
-    coo = SkyCoord(ra=ref['ra'],dec=ref['dec'],unit='deg')
-    sfd = SFDQuery()
-    ebv = sfd(coo)
+    ebv = extinction.getebv(ref['ra'],ref['dec'])
     ref['ebv_sfd'] = ebv 
      
     # Start with SFD extinction for all 
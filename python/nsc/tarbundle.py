@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import os
+import io
+import re
+import json
+import tarfile
+from astropy.io import fits
+
+# Suffix of the member index sidecar file written next to a tar bundle
+INDEXSUFFIX = '.index.json'
+
+def istarfile(filename):
+    """ Check if this is a tarred exposure bundle (.tar, .tar.gz or .tgz)."""
+    if os.path.isdir(filename):
+        return False
+    return filename.endswith('.tar.gz') or filename.endswith('.tgz') or filename.endswith('.tar')
+
+
+def tarbase(filename):
+    """ Return the exposure base name of a tar bundle."""
+    base = os.path.basename(filename)
+    for ext in ['.tar.gz','.tgz','.tar']:
+        if base.endswith(ext):
+            return base[:-len(ext)]
+    return base
+
+
+def tarindex(filename,writeindex=True):
+    """
+    Get the list of regular-file members in a tar bundle with their data
+    offsets.  The index is read from the sidecar file if one exists and is
+    newer than the tar file, otherwise the tar file is scanned once and
+    the sidecar is written (if possible).
+
+    Parameters
+    ----------
+    filename : str
+       The tar file name.
+    writeindex : bool, optional
+       Write the sidecar index file if it does not exist.  Default is True.
+
+    Returns
+    -------
+    index : dict
+       Dictionary of member name -> (offset_data, size).
+
+    Example
+    -------
+
+    index = tarindex('c4d_160825_043133_ooi_z_v1.tar.gz')
+
+    """
+    indexfile = filename+INDEXSUFFIX
+    if os.path.exists(indexfile) and os.path.getmtime(indexfile) >= os.path.getmtime(filename):
+        try:
+            with open(indexfile,'r') as f:
+                index = json.load(f)
+            return {k:tuple(v) for k,v in index.items()}
+        except:
+            pass
+    # Scan the tar file headers, this reads through the stream once
+    index = {}
+    with tarfile.open(filename,'r:*') as tf:
+        for m in tf:
+            if m.isreg():
+                index[m.name] = (m.offset_data,m.size)
+    if writeindex:
+        try:
+            with open(indexfile,'w') as f:
+                json.dump(index,f)
+        except OSError:
+            pass
+    return index
+
+
+class TarBundle(object):
+    """
+    Read-only random access to the members of a tarred exposure bundle.
+    Members are returned as bytes or in-memory objects and are never
+    extracted to disk.
+
+    Parameters
+    ----------
+    filename : str
+       The tar file name (.tar, .tar.gz or .tgz).
+    writeindex : bool, optional
+       Write the member index sidecar file.  Default is True.
+
+    Example
+    -------
+
+    bundle = TarBundle(expdir)
+    hdu = bundle.fitsopen(bundle.find('_meas.fits'))
+
+    """
+
+    def __init__(self,filename,writeindex=True):
+        if os.path.exists(filename)==False:
+            raise ValueError(filename+' NOT FOUND')
+        self.filename = filename
+        self.base = tarbase(filename)
+        self.index = tarindex(filename,writeindex=writeindex)
+        self._tf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def __contains__(self,name):
+        return name in self.index
+
+    @property
+    def names(self):
+        """ Member names sorted by their position in the archive."""
+        return sorted(self.index,key=lambda n:self.index[n][0])
+
+    @property
+    def tarfile(self):
+        if self._tf is None:
+            self._tf = tarfile.open(self.filename,'r:*')
+        return self._tf
+
+    def close(self):
+        if self._tf is not None:
+            self._tf.close()
+            self._tf = None
+
+    def find(self,suffix):
+        """ Return the first member whose basename is base+suffix, or None."""
+        for n in self.names:
+            if os.path.basename(n) == self.base+suffix:
+                return n
+        return None
+
+    def chipnames(self):
+        """ Return the individual chip catalog members (base_N.fits), sorted by ccdnum."""
+        pattern = re.compile('^'+re.escape(self.base)+r'_([0-9]{1,2})\.fits$')
+        out = []
+        for n in self.index:
+            m = pattern.match(os.path.basename(n))
+            if m is not None:
+                out.append((int(m.group(1)),n))
+        out.sort()
+        return [n for c,n in out]
+
+    def read(self,name):
+        """ Return the contents of a member as bytes."""
+        if name not in self.index:
+            raise KeyError(name+' not in '+self.filename)
+        offset,size = self.index[name]
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.offset_data = offset
+        info.type = tarfile.REGTYPE
+        return self.tarfile.extractfile(info).read()
+
+    def readmany(self,names):
+        """ Return a dictionary of member contents.  Members are read in
+            archive order so a compressed stream is only decompressed once."""
+        names = sorted(names,key=lambda n:self.index[n][0])
+        return {n:self.read(n) for n in names}
+
+    def readlines(self,name):
+        """ Return a text member as a list of lines."""
+        return self.read(name).decode(errors='replace').splitlines()
+
+    def fitsopen(self,name):
+        """ Open a FITS member as an in-memory HDUList."""
+        return fits.open(io.BytesIO(self.read(name)))
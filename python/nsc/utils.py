@@ -9,7 +9,7 @@ __authors__ = 'David Nidever <dnidever@noao.edu>'
 __version__ = '20180823'  # yyyymmdd
 
 from astropy.io import fits
-from astropy.table import Table, Column
+from astropy.table import Table, Column, vstack
 from astropy import modeling
 from astropy.convolution import Gaussian1DKernel, Gaussian2DKernel, convolve
 import astropy.stats
@@ -39,6 +39,14 @@ from requests.adapters import HTTPAdapter, Retry
 import subprocess
 import warnings
 import traceback
+import shutil
+import gzip
+import io
+import tarfile
+import resource
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # Ignore these warnings, it's a bug
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
@@ -125,6 +133,134 @@ def func_poly2d(x,y,*args):
 
     return a
 
+def poly2d_design(x,y,npars):
+    """ Design matrix for the linear func_poly2d() model, columns in coefficient order."""
+    x = np.asarray(x)
+    y = np.asarray(y)
+    one = np.ones(x.shape,float)
+    if npars==1:
+        cols = [one]
+    elif npars==3:
+        cols = [one,x,y]
+    elif npars==4:
+        cols = [one,x,x*y,y]
+    elif npars==6:
+        cols = [one,x,x**2,x*y,y,y**2]
+    else:
+        raise Exception('Only 1, 3, 4 and 6 parameters supported')
+    return np.stack(cols,axis=-1)
+
+def fit_poly2d_batch(xlist,ylist,zlist,sigmalist,nparslist,masklist=None,niter=0,nsig=3.0):
+    """
+    Closed-form weighted linear least-squares fits of the func_poly2d()
+    surface for many independent datasets (e.g. chips) at once.
+
+    Datasets with the same number of parameters are padded to a common
+    length and solved together through their stacked normal equations.
+    Optionally, points deviating by more than nsig robust sigma from the
+    fit are rejected and the fit is repeated.
+
+    Parameters
+    ----------
+    xlist : list
+       List of X arrays, one per dataset.
+    ylist : list
+       List of Y arrays.
+    zlist : list
+       List of arrays of the values to fit.
+    sigmalist : list
+       List of uncertainty arrays.
+    nparslist : list
+       Number of polynomial parameters for each dataset (1, 3, 4 or 6).
+    masklist : list, optional
+       List of boolean arrays of the points to use initially.  Default
+         is to use all points.
+    niter : int, optional
+       Number of outlier-rejection iterations.  Default is 0.
+    nsig : float, optional
+       Outlier rejection threshold in robust sigma.  Default is 3.0.
+
+    Returns
+    -------
+    coefs : list
+       List of coefficient arrays.
+    covs : list
+       List of covariance matrices, scaled by the reduced chi-squared
+         like curve_fit() does.
+    masks : list
+       List of boolean arrays of the points used in the final fits.
+
+    Example
+    -------
+
+    coefs,covs,masks = fit_poly2d_batch(xlist,ylist,zlist,errlist,[4]*len(xlist))
+
+    """
+    ndata = len(xlist)
+    coefs = ndata*[None]
+    covs = ndata*[None]
+    masks = ndata*[None]
+    nparslist = np.array(nparslist)
+    for npars in np.unique(nparslist):
+        ind, = np.where(nparslist==npars)
+        nind = len(ind)
+        nmax = np.max([len(xlist[i]) for i in ind])
+        # Pad to a common length, padded points get zero weight
+        xx = np.zeros((nind,nmax),float)
+        yy = np.zeros((nind,nmax),float)
+        zz = np.zeros((nind,nmax),float)
+        wt = np.zeros((nind,nmax),float)
+        mask0 = np.zeros((nind,nmax),bool)
+        for j,i in enumerate(ind):
+            n = len(xlist[i])
+            xx[j,:n] = xlist[i]
+            yy[j,:n] = ylist[i]
+            zz[j,:n] = zlist[i]
+            wt[j,:n] = 1/np.asarray(sigmalist[i],float)**2
+            if masklist is None:
+                mask0[j,:n] = True
+            else:
+                mask0[j,:n] = masklist[i]
+        mask0 &= np.isfinite(wt) & np.isfinite(zz)
+        wt[~np.isfinite(wt)] = 0.0
+        zz[~np.isfinite(zz)] = 0.0
+        design = poly2d_design(xx,yy,npars)     # [nind,nmax,npars]
+        mask = mask0.copy()
+        for it in range(niter+1):
+            w = wt*mask
+            aw = design*w[:,:,None]
+            ata = np.einsum('cnp,cnq->cpq',aw,design)
+            atb = np.einsum('cnp,cn->cp',aw,zz)
+            cov0 = np.linalg.pinv(ata)
+            coef = np.einsum('cpq,cq->cp',cov0,atb)
+            resid = zz-np.einsum('cnp,cp->cn',design,coef)
+            if it==niter:
+                break
+            # Outlier rejection relative to the fit
+            rr = np.where(mask,resid,np.nan)
+            med = np.nanmedian(rr,axis=1)
+            sig = 1.4826*np.nanmedian(np.abs(rr-med[:,None]),axis=1)
+            sig = np.maximum(sig,1e-10)
+            newmask = mask0 & (np.abs(resid-med[:,None]) < nsig*sig[:,None])
+            # keep the old mask if too few points would be left
+            bad = np.sum(newmask,axis=1) <= npars
+            newmask[bad] = mask[bad]
+            if np.array_equal(newmask,mask):
+                break
+            mask = newmask
+        # Scale covariance by the reduced chi-squared like curve_fit
+        dof = np.sum(mask,axis=1)-npars
+        chisq = np.sum(wt*mask*resid**2,axis=1)
+        scale = np.zeros(nind,float)+np.inf
+        gdof = dof > 0
+        scale[gdof] = chisq[gdof]/dof[gdof]
+        for j,i in enumerate(ind):
+            n = len(xlist[i])
+            coefs[i] = coef[j]
+            covs[i] = cov0[j]*scale[j]
+            masks[i] = mask[j,:n]
+    return coefs,covs,masks
+
 
 
 # Size, number of elements
@@ -1935,9 +2071,195 @@ def file_isfits(filename):
     hdu.close()
     return True
 
-def concatmeas(expdir,base=None,deletetruncated=False):
+class ParallelGzipWriter(object):
+    """
+    Write-only gzip file object that compresses in parallel.  The input
+    is cut into blocks that are compressed by a thread pool (zlib releases
+    the GIL) and written in order as consecutive gzip members, which
+    gzip, tar and python's gzip/tarfile modules read as one stream.
+
+    Parameters
+    ----------
+    filename : str
+       Output filename.
+    ncpu : int, optional
+       Number of compression threads.  Default is the number of cpus.
+    blocksize : int, optional
+       Uncompressed block size in bytes.  Default is 4 MB.
+    compresslevel : int, optional
+       The gzip compression level.  Default is 6.
+
+    Example
+    -------
+
+    with ParallelGzipWriter('files.tgz') as f:
+        f.write(data)
+
+    """
+
+    def __init__(self,filename,ncpu=None,blocksize=4194304,compresslevel=6):
+        if ncpu is None:
+            ncpu = os.cpu_count() or 1
+        self.ncpu = int(np.maximum(ncpu,1))
+        self.blocksize = blocksize
+        self.compresslevel = compresslevel
+        self._fp = open(filename,'wb')
+        self._buf = bytearray()
+        self._pool = ThreadPoolExecutor(self.ncpu)
+        self._pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def _compress(self,block):
+        return gzip.compress(block,compresslevel=self.compresslevel,mtime=0)
+
+    def _drain(self,nkeep):
+        # Write finished blocks in order, keep at most nkeep in flight
+        while len(self._pending) > nkeep:
+            self._fp.write(self._pending.popleft().result())
+
+    def write(self,data):
+        self._buf += data
+        while len(self._buf) >= self.blocksize:
+            block = bytes(self._buf[:self.blocksize])
+            del self._buf[:self.blocksize]
+            self._pending.append(self._pool.submit(self._compress,block))
+            self._drain(2*self.ncpu)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._fp is None:
+            return
+        if len(self._buf) > 0:
+            self._pending.append(self._pool.submit(self._compress,bytes(self._buf)))
+            self._buf = bytearray()
+        self._drain(0)
+        self._pool.shutdown()
+        self._fp.close()
+        self._fp = None
+
+
+def mktarball(tarfilename,files,ncpu=None):
+    """
+    Create a gzipped tar file of a list of files (stored by basename)
+    using the in-process parallel gzip compressor.
+
+    Parameters
+    ----------
+    tarfilename : str
+       Output tar filename (.tgz or .tar.gz).
+    files : list
+       List of files to add.
+    ncpu : int, optional
+       Number of compression threads.  Default is the number of cpus.
+
+    Example
+    -------
+
+    mktarball('c4d_160825_043133_ooi_z_v1.tgz',files)
+
+    """
+    with ParallelGzipWriter(tarfilename,ncpu=ncpu) as fp:
+        with tarfile.open(fileobj=fp,mode='w|',format=tarfile.PAX_FORMAT) as tf:
+            for f in files:
+                tf.add(f,arcname=os.path.basename(f))
+
+
+def fitsindex(filename):
+    """
+    Get the byte range of every HDU in a FITS file.  Only the headers are read.
+
+    Parameters
+    ----------
+    filename : str
+       The FITS filename (this includes fpacked files).
+
+    Returns
+    -------
+    index : list
+       List of (header offset, data offset, data size) tuples, one per HDU.
+
+    Example
+    -------
+
+    index = fitsindex('c4d_160825_043133_ooi_z_v1.fits.fz')
+
+    """
+    with fits.open(filename) as hdulist:
+        nhdu = len(hdulist)
+        index = []
+        for i in range(nhdu):
+            info = hdulist.fileinfo(i)
+            index.append((info['hdrLoc'],info['datLoc'],info['datSpan']))
+    return index
+
+
+# Blank primary header, used to read a single extension on its own
+_BLANKPRIMARY = fits.PrimaryHDU().header.tostring().encode()
+
+def readhdu(filename,extension,index=None):
+    """
+    Read one HDU of a FITS file.  If the HDU byte index is given, only that
+    HDU's bytes are read, with a single contiguous read, and the other
+    HDUs are never touched.  This works well for fpacked files on network
+    file systems.
+
+    Parameters
+    ----------
+    filename : str
+       The FITS filename (this includes fpacked files).
+    extension : int
+       The HDU number.
+    index : list, optional
+       The HDU byte index from fitsindex().
+
+    Returns
+    -------
+    data : numpy array
+       The (decompressed) data.
+    header : Header
+       The header of the HDU.
+
+    Example
+    -------
+
+    flux,head = readhdu(fluxfile,5,index)
+
+    """
+    if index is None:
+        with fits.open(filename) as hdulist:
+            data = hdulist[extension].data
+            header = hdulist[extension].header.copy()
+        return data,header
+    hdrloc,datloc,datspan = index[extension]
+    with open(filename,'rb') as f:
+        f.seek(hdrloc)
+        buf = f.read(datloc+datspan-hdrloc)
+    if extension == 0:
+        hdulist = fits.open(io.BytesIO(buf))
+        hdu = hdulist[0]
+    else:
+        hdulist = fits.open(io.BytesIO(_BLANKPRIMARY+buf))
+        hdu = hdulist[1]
+    data = hdu.data
+    header = hdu.header.copy()
+    hdulist.close()
+    return data,header
+
+
+def concatmeas(expdir,base=None,deletetruncated=False,ncpu=None):
     """
     Combine multiple chip-level measurement files into a single multi-extension FITS file.
+    The chip catalogs are read once and written to <base>_meas.fits (tables) and
+    <base>_header.fits (chip headers).  The remaining files are bundled into <base>.tgz
+    with a parallel gzip compressor.
     """
     if os.path.exists(expdir)==False:
         print(expdir,'not found')
@@ -1945,35 +2267,33 @@ def concatmeas(expdir,base=None,deletetruncated=False):
 
     print('Concatenate FITS files for ',expdir)
     
-    curdir = os.getcwd()
-    
     # Is this a tar file
-    if os.path.isdir(expdir)==False and expdir.endswith('.tar.gz') or expdir.endswith('.tgz'):
+    if os.path.isdir(expdir)==False and (expdir.endswith('.tar.gz') or expdir.endswith('.tgz')):
         print('This is a tar file.  Uncompressing.')
-        tarfile = os.path.basename(expdir)
-        base = tarfile.replace('.tgz','').replace('.tar.gz','')
-        nightdir = os.path.abspath(os.path.dirname(expdir))
+        tarfilename = os.path.abspath(expdir)
+        base = os.path.basename(tarfilename).replace('.tgz','').replace('.tar.gz','')
+        nightdir = os.path.dirname(tarfilename)
         expdir = nightdir+'/'+base
-        os.chdir(nightdir)        
-        res = subprocess.run(['tar','xvf',tarfile],capture_output=True)
-        if res.returncode==0:
-            print('success: removing',tarfile)
-            os.remove(tarfile)
-        else:
-            print('problem untarring',tarfile)
-            import pdb; pdb.set_trace()
+        try:
+            with tarfile.open(tarfilename,'r:*') as tf:
+                tf.extractall(nightdir)
+        except:
+            print('problem untarring',tarfilename)
+            traceback.print_exc()
+            return
+        print('success: removing',tarfilename)
+        os.remove(tarfilename)
 
-    os.chdir(expdir)
+    expdir = os.path.abspath(expdir)
     if base is None:
         base = os.path.basename(expdir)
-    outfile = base+'_meas.fits'
+    outfile = os.path.join(expdir,base+'_meas.fits')
     if os.path.exists(outfile):
         print(outfile,'already exists')
-        os.chdir(curdir)
         return
-    fitsfiles1 = glob('*_?.fits')
+    fitsfiles1 = glob(os.path.join(expdir,'*_?.fits'))
     fitsfiles1.sort()
-    fitsfiles2 = glob('*_??.fits')
+    fitsfiles2 = glob(os.path.join(expdir,'*_??.fits'))
     fitsfiles2.sort()
     fitsfiles = fitsfiles1+fitsfiles2
     # c4d, too few files
@@ -1981,38 +2301,38 @@ def concatmeas(expdir,base=None,deletetruncated=False):
         #print(len(fitsfiles),'fits files found. not enough.  skipping')
         print(len(fitsfiles),'fits files found.  Truncated.  Deleting')
         shutil.rmtree(expdir)
-        os.chdir(curdir)
         return
     # ksb/k4m, too few files
     if len(fitsfiles)<4 and (expdir.find('/k4m/')>-1 or expdir.find('/ksb/')>-1):
         print(len(fitsfiles),'fits files found.  Truncated.  Deleting')
         shutil.rmtree(expdir)
-        os.chdir(curdir)
         return
+    # Open each chip file once and reuse its HDUs for both outputs,
+    #  the table data are only read when the output is written
     chdu = fits.HDUList()
     hhdu = fits.HDUList()
     hhdu.append(fits.PrimaryHDU())
+    inhdus = []
     for i in range(len(fitsfiles)):
         hdu1 = fits.open(fitsfiles[i])
-        tab1 = Table.read(fitsfiles[i])
+        inhdus.append(hdu1)
         base1 = os.path.basename(fitsfiles[i])
-        print('{:3d} {:s} {:8d}'.format(i+1,base1,len(tab1)))
+        print('{:3d} {:s} {:8d}'.format(i+1,base1,hdu1[1].header['NAXIS2']))
         ccdnum = base1[:-5].split('_')[-1]
-        newhdu = fits.table_to_hdu(Table(hdu1[1].data))
+        newhdu = fits.BinTableHDU(hdu1[1].data,header=hdu1[1].header)
         newhdu.header['extname'] = ccdnum
         newhdu.header['ccdnum'] = ccdnum
         newhead = hdu1[0].header.copy()
         newhead['extname'] = ccdnum
         chdu.append(newhdu)
         hhdu.append(fits.ImageHDU(header=newhead))
-        hdu1.close()
     print('Writing',outfile)
     chdu.writeto(outfile,overwrite=True)
-    chdu.close()
-    houtfile = base+'_header.fits'
+    houtfile = os.path.join(expdir,base+'_header.fits')
     print('Writing',houtfile)
     hhdu.writeto(houtfile,overwrite=True)
-    hhdu.close()
+    for hdu1 in inhdus:
+        hdu1.close()
     # Confirm that it is there
     if os.path.exists(outfile) and os.path.exists(houtfile):
         # Delete fits files
@@ -2020,29 +2340,225 @@ def concatmeas(expdir,base=None,deletetruncated=False):
         for f in fitsfiles:
             if os.path.exists(f): os.remove(f)
         # Tar up the rest of the files
-        # leave out meas.fits, log
-        logfile = base+'.log'
-        tarfile = base+'.tgz'
-        allfiles = glob('*')
+        # leave out meas.fits, header.fits, log
+        logfile = os.path.join(expdir,base+'.log')
+        tarfilename = os.path.join(expdir,base+'.tgz')
+        allfiles = glob(os.path.join(expdir,'*'))
         allfiles = [f for f in allfiles if os.path.isfile(f)]
+        allfiles = [f for f in allfiles if f not in [outfile,houtfile,logfile,tarfilename]]
         allfiles.sort()
-        if outfile in allfiles:
-            allfiles.remove(outfile)
-        if houtfile in allfiles:
-            allfiles.remove(houtfile)
-        if logfile in allfiles:
-            allfiles.remove(logfile)
-        if tarfile in allfiles:
-            allfiles.remove(tarfile)
-        cmd = ['tar','cvzf',tarfile]+allfiles
-        print('tarring',len(allfiles),'files in',tarfile)
-        res = subprocess.run(cmd,capture_output=True)
-        if res.returncode==0:
-            print('tar success')
-            print('Deleting tarred files')
-            for f in allfiles:
-                if os.path.exists(f): os.remove(f)
-    os.chdir(curdir)
+        print('tarring',len(allfiles),'files in',tarfilename)
+        try:
+            mktarball(tarfilename,allfiles,ncpu=ncpu)
+        except:
+            print('problem tarring',tarfilename)
+            traceback.print_exc()
+            if os.path.exists(tarfilename): os.remove(tarfilename)
+            return
+        print('tar success')
+        print('Deleting tarred files')
+        for f in allfiles:
+            if os.path.exists(f): os.remove(f)
+
+
+def resourceusage():
+    """
+    Snapshot of the resource usage of this process and its (waited for)
+    child processes.  Times are in seconds, memory in MB and I/O in bytes.
+    """
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    ruc = resource.getrusage(resource.RUSAGE_CHILDREN)
+    out = {'wall':time.time(),'cpu':ru.ru_utime+ru.ru_stime,
+           'childcpu':ruc.ru_utime+ruc.ru_stime,
+           'maxrss':ru.ru_maxrss/1024.0,'childmaxrss':ruc.ru_maxrss/1024.0,
+           'readbytes':0,'writebytes':0}
+    # Bytes read/written by this process (Linux), plus block I/O of the children
+    try:
+        with open('/proc/self/io','r') as f:
+            pio = dict(l.split(':') for l in f.read().splitlines())
+        out['readbytes'] = int(pio['rchar'])
+        out['writebytes'] = int(pio['wchar'])
+    except (OSError,KeyError,ValueError):
+        out['readbytes'] = ru.ru_inblock*512
+        out['writebytes'] = ru.ru_oublock*512
+    out['readbytes'] += ruc.ru_inblock*512
+    out['writebytes'] += ruc.ru_oublock*512
+    return out
+
+
+# Running peak memory of the open stages, see StageTimer
+_peakstack = []
+
+def readhwm():
+    """ Peak resident memory (VmHWM) of this process in MB, or None if not available."""
+    try:
+        with open('/proc/self/status','r') as f:
+            for l in f:
+                if l.startswith('VmHWM:'):
+                    return int(l.split()[1])/1024.0
+    except (OSError,ValueError,IndexError):
+        pass
+    return None
+
+def resethwm():
+    """ Reset the peak resident memory (VmHWM) of this process, returns True if it worked."""
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class StageTimer(object):
+    """
+    Record the wall time, CPU time, child-process CPU time, peak memory and
+    I/O of the stages of a processing run.
+
+    MAXRSS is the peak resident memory (MB) of this process during the
+    stage.  It is measured by resetting the Linux high-water mark at the
+    start of the stage, when that is not possible (MAXRSSSTAGE=False) it
+    is the high-water mark of the whole process lifetime.  CHILDMAXRSS is
+    the peak memory of the largest child process waited for so far.
+
+    Parameters
+    ----------
+    **tags : dict
+       Columns added to every row, e.g. exposure='c4d_160825_043133_ooi_z_v1'.
+
+    Example
+    -------
+
+    timer = StageTimer(exposure=base)
+    with timer('runsex',chip=ccdnum):
+        chip.runsex()
+    timer.write(base+'_telemetry.fits')
+
+    """
+
+    def __init__(self,**tags):
+        self.tags = tags
+        self.rows = []
+
+    def __repr__(self):
+        return "StageTimer object, "+str(len(self.rows))+" stages"
+
+    def __len__(self):
+        return len(self.rows)
+
+    @contextmanager
+    def __call__(self,stage,**tags):
+        """ Time one stage, the row is added even if the stage raises an exception."""
+        # The high-water mark is reset for this stage, keep the
+        #  peak so far of any enclosing stages
+        hwm = readhwm()
+        for p in _peakstack:
+            p[0] = np.maximum(p[0],hwm or 0.0)
+        reset = hwm is not None and resethwm()
+        peak = [0.0]
+        _peakstack.append(peak)
+        u0 = resourceusage()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            u1 = resourceusage()
+            _peakstack.remove(peak)
+            row = dict(self.tags)
+            row.update(tags)
+            row['stage'] = stage
+            row['success'] = success
+            for k in ['wall','cpu','childcpu','readbytes','writebytes']:
+                row[k] = u1[k]-u0[k]
+            hwm = readhwm()
+            if reset and hwm is not None:
+                row['maxrss'] = float(np.maximum(peak[0],hwm))
+                row['maxrssstage'] = True
+            else:
+                row['maxrss'] = u1['maxrss']
+                row['maxrssstage'] = False
+            row['childmaxrss'] = u1['childmaxrss']
+            self.rows.append(row)
+
+    def extend(self,rows,**tags):
+        """ Add rows from another timer (e.g. a chip processed in a worker process)."""
+        for r in rows:
+            row = dict(self.tags)
+            row.update(r)
+            row.update(tags)
+            self.rows.append(row)
+
+    def table(self):
+        """ Return the stages as an astropy table."""
+        if len(self.rows)==0:
+            return Table()
+        names = []
+        for r in self.rows:
+            names += [k for k in r if k not in names]
+        cols = {}
+        for n in names:
+            vals = [r.get(n) for r in self.rows]
+            if all(isinstance(v,(bool,np.bool_)) for v in vals if v is not None):
+                cols[n] = np.array([bool(v) for v in vals])
+            elif all(isinstance(v,(int,np.integer)) for v in vals if v is not None):
+                cols[n] = np.array([-1 if v is None else v for v in vals],int)
+            elif all(isinstance(v,(int,float,np.number)) for v in vals if v is not None):
+                cols[n] = np.array([np.nan if v is None else v for v in vals],float)
+            else:
+                cols[n] = np.array(['' if v is None else str(v) for v in vals])
+        return Table(cols,names=names)
+
+    def write(self,filename):
+        """ Write the stages to a FITS table."""
+        tab = self.table()
+        tab.write(filename,overwrite=True)
+        return tab
+
+
+def readtelemetry(files,groupby=['instrument','stage']):
+    """
+    Combine the stage telemetry tables of many exposures and summarize them.
+
+    Parameters
+    ----------
+    files : list
+       List of _telemetry.fits files.
+    groupby : list, optional
+       The columns to group the summary by.  Default is ['instrument','stage'].
+
+    Returns
+    -------
+    tab : astropy table
+       All of the rows.
+    summary : astropy table
+       Number of rows and total and median wall, cpu and child cpu time, and
+       maximum memory, for each group.
+
+    Example
+    -------
+
+    tab,summary = readtelemetry(glob('*/*_telemetry.fits'))
+
+    """
+    tabs = [Table.read(f) for f in files if os.path.exists(f)]
+    if len(tabs)==0:
+        return None,None
+    tab = vstack(tabs)
+    groupby = [g for g in groupby if g in tab.colnames]
+    grp = tab.group_by(groupby)
+    rows = []
+    for key,g in zip(grp.groups.keys,grp.groups):
+        row = {k:key[k] for k in groupby}
+        row['num'] = len(g)
+        for k in ['wall','cpu','childcpu']:
+            row[k+'_total'] = np.sum(g[k])
+            row[k+'_median'] = np.median(g[k])
+        row['maxrss'] = np.max(np.maximum(g['maxrss'],g['childmaxrss']))
+        rows.append(row)
+    summary = Table(rows=rows,names=list(rows[0].keys()))
+    summary.sort('wall_total',reverse=True)
+    return tab,summary
 
 
 # Get NSC directories
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import lsqr
+from scipy.sparse.csgraph import connected_components
+from dlnpyutils import utils as dln,coords
+
+def groupwtmean(x,err,group,errmethod='bootstrap',niter=100,seed=None):
+    """
+    Weighted means and uncertainties for many groups (e.g. chips) at once.
+    The data are sorted by group once and all groups are reduced together.
+
+    Parameters
+    ----------
+    x : numpy array
+       Values to average.
+    err : numpy array
+       Uncertainties of the values.
+    group : numpy array
+       Group label (e.g. ccdnum) for each value.
+    errmethod : str, optional
+       How to compute the uncertainty of the mean: "bootstrap" or
+         "analytic".  Default is "bootstrap".
+    niter : int, optional
+       Number of bootstrap resamples.  Default is 100.
+    seed : int, optional
+       Seed for the random number generator.  By default it is derived
+         from the data, like dln.bootstrap(), so results are reproducible.
+
+    Returns
+    -------
+    ugroup : numpy array
+       The unique group labels.
+    mean : numpy array
+       Weighted mean for each group.
+    meanerr : numpy array
+       Uncertainty of the weighted mean for each group.
+    count : numpy array
+       Number of values in each group.
+
+    Example
+    -------
+
+    ccdnum,zpterm,zptermerr,nstars = groupwtmean(diff,err,ccdnum)
+
+    """
+    x = np.asarray(x,float)
+    err = np.asarray(err,float)
+    group = np.asarray(group)
+    if len(x)==0:
+        return group[0:0],np.zeros(0,float),np.zeros(0,float),np.zeros(0,int)
+    si = np.argsort(group,kind='stable')
+    x = x[si]
+    wt = 1/err[si]**2
+    ugroup,start,count = np.unique(group[si],return_index=True,return_counts=True)
+    sumwt = np.add.reduceat(wt,start)
+    mean = np.add.reduceat(wt*x,start)/sumwt
+
+    # Analytic, same as dln.wtmean(error=True)
+    if errmethod=='analytic':
+        nrep = np.repeat(np.arange(len(ugroup)),count)
+        resid = x-mean[nrep]
+        meanerr = np.zeros(len(ugroup),float)
+        gd = count > 1
+        sumres = np.add.reduceat(resid**2*wt,start)
+        meanerr[gd] = np.sqrt(sumres[gd]*count[gd]/((count[gd]-1)*sumwt[gd]))/np.sqrt(count[gd])
+    # Bootstrap with a single resample matrix for all groups
+    #  each element is replaced by a random element of its own group
+    elif errmethod=='bootstrap':
+        if seed is None:
+            seed = int(np.abs(x[0])*1e5)
+        rng = np.random.default_rng(seed)
+        nrep = np.repeat(np.arange(len(ugroup)),count)
+        rndind = start[nrep] + (rng.random((niter,len(x)))*count[nrep]).astype(int)
+        bwt = wt[rndind]
+        btmean = np.add.reduceat(bwt*x[rndind],start,axis=1)/np.add.reduceat(bwt,start,axis=1)
+        meanerr = dln.mad(btmean-np.median(btmean,axis=0),axis=0,zero=True)
+    else:
+        raise ValueError(errmethod+' not supported')
+
+    return ugroup,mean,meanerr,count
+
+
+def fitzpterm(mstr,expinfo,chinfo,errmethod='bootstrap',minstars=5,nmatchcol='nrefmatch'):
+    """
+    Fit the global and chip-level zero-points.
+
+    Parameters
+    ----------
+    mstr : dict
+       Matched structure with "mag", "model", "err" and "ccdnum" arrays
+         (and "col").
+    expinfo : astropy table
+       Meta-data table for the entire exposure.
+    chinfo : astropy table
+       The table of meta-data for each chip.
+    errmethod : str, optional
+       Uncertainty method for the zero-points, "bootstrap" or
+         "analytic".  Default is "bootstrap".
+    minstars : int, optional
+       Minimum number of stars for a zero-point.  Default is 5.
+    nmatchcol : str, optional
+       Column of chinfo for the number of matched stars of each chip.
+         Default is "nrefmatch".
+
+    Returns
+    -------
+    expinfo : astropy table
+       Meta-data table for the entire exposure updated with
+         zero-point information.
+    chinfo : astropy table
+       The table of meta-data for each chip updated with
+         zero-point information.
+
+    Example
+    -------
+
+    expinfo,chinfo = fitzpterm(mstr,expinfo,chinfo)
+
+    """
+    n = len(mstr['mag'])
+    diff = np.asarray(mstr['model'] - mstr['mag'],float)
+    err = np.asarray(mstr['err'],float)
+    ccdnum = np.asarray(mstr['ccdnum'])
+    # Make a sigma cut
+    med = np.median(diff)
+    sig = dln.mad(diff)
+    gd = np.abs(diff-med) < 3*sig
+    if sig <= 0 or np.sum(gd) < minstars:
+        # Not enough good stars, leave the zero-points bad
+        expinfo['zpterm'] = 999999.
+        expinfo['zptermerr'] = 999999.
+        expinfo['zptermsig'] = 999999.
+        expinfo['nrefmatch'] = n
+        expinfo['ngoodrefmatch'] = np.sum(gd)
+        chinfo['zpterm'] = 999999.
+        chinfo['zptermerr'] = 999999.
+        return expinfo,chinfo
+    # Exposure level
+    _,zpterm,zptermerr,_ = groupwtmean(diff[gd],err[gd],np.zeros(np.sum(gd),int),errmethod=errmethod)
+    # Save in exposure table
+    expinfo['zpterm'] = zpterm[0]
+    expinfo['zptermerr'] = zptermerr[0]
+    expinfo['zptermsig'] = sig
+    expinfo['nrefmatch'] = n
+    expinfo['ngoodrefmatch'] = np.sum(gd)
+
+    # Measure chip-level zpterm and variations
+    uccd,nmatch = np.unique(ccdnum,return_counts=True)
+    if nmatchcol not in chinfo.colnames:
+        chinfo[nmatchcol] = 0
+    gccd,gzpterm,gzptermerr,ngd = groupwtmean(diff[gd],err[gd],ccdnum[gd],errmethod=errmethod)
+    for i in range(len(chinfo)):
+        ind, = np.where(gccd==chinfo['ccdnum'][i])
+        if len(ind)==0 or ngd[ind[0]] < minstars:
+            continue
+        chinfo['zpterm'][i] = gzpterm[ind[0]]
+        chinfo['zptermerr'][i] = gzptermerr[ind[0]]
+        chinfo[nmatchcol][i] = nmatch[uccd==chinfo['ccdnum'][i]][0]
+
+    # Measure spatial variations
+    gdchip, = np.where(chinfo['zpterm'] < 1000)
+    if len(gdchip) > 1:
+        expinfo['zpspatialvar_rms'] = np.std(chinfo['zpterm'][gdchip])
+        expinfo['zpspatialvar_range'] = np.max(chinfo['zpterm'][gdchip])-np.min(chinfo['zpterm'][gdchip])
+        expinfo['zpspatialvar_nccd'] = len(gdchip)
+
+    return expinfo,chinfo
+
+
+def crossmatch_exposures(ra,dec,expind,dcr=0.5):
+    """
+    Cross-match the sources of many overlapping exposures once and
+    assign a common star ID to detections of the same star.
+
+    Parameters
+    ----------
+    ra : numpy array
+       Right Ascension of all detections in degrees.
+    dec : numpy array
+       Declination of all detections in degrees.
+    expind : numpy array
+       Exposure index for each detection.
+    dcr : float, optional
+       Matching radius in arcsec.  Default is 0.5.
+
+    Returns
+    -------
+    starid : numpy array
+       Star index for each detection.
+    nstars : int
+       Number of unique stars.
+
+    Example
+    -------
+
+    starid,nstars = crossmatch_exposures(ra,dec,expind)
+
+    """
+    ra = np.asarray(ra,float)
+    dec = np.asarray(dec,float)
+    starid = np.zeros(len(ra),int)-1
+    index = dln.create_index(expind)
+    # Start with the exposure with the most detections
+    order = np.flip(np.argsort(index['num']))
+    starra = np.zeros(0,float)
+    stardec = np.zeros(0,float)
+    for i in order:
+        ind = index['index'][index['lo'][i]:index['hi'][i]+1]
+        left = np.ones(len(ind),bool)
+        if len(starra) > 0:
+            ind1,ind2,dist = coords.xmatch(starra,stardec,ra[ind],dec[ind],dcr,unique=True)
+            if len(ind1) > 0:
+                starid[ind[ind2]] = ind1
+                left[ind2] = False
+        # Add new stars
+        if np.sum(left) > 0:
+            nstars = len(starra)
+            starid[ind[left]] = nstars+np.arange(np.sum(left))
+            starra = np.append(starra,ra[ind[left]])
+            stardec = np.append(stardec,dec[ind[left]])
+    return starid,len(starra)
+
+
+def anchoredzp(starid,zpid,anchorzp):
+    """
+    Find the zero-points that are connected to an anchor through stars
+    that they have in common.  The others can't be calibrated by ubercal().
+
+    Parameters
+    ----------
+    starid : numpy array
+       Star index of each detection (e.g. from crossmatch_exposures).
+    zpid : numpy array
+       Zero-point index of each detection.
+    anchorzp : numpy array
+       Known zero-point for each zero-point index, NaN for those
+         that are free.
+
+    Returns
+    -------
+    connected : numpy array
+       Boolean array, True for the zero-points connected to an anchor.
+
+    Example
+    -------
+
+    connected = anchoredzp(starid,zpid,anchorzp)
+
+    """
+    starid = np.asarray(starid)
+    zpid = np.asarray(zpid)
+    anchorzp = np.asarray(anchorzp,float)
+    nzp = len(anchorzp)
+    nstar = np.max(starid)+1 if len(starid) > 0 else 0
+    # Graph of zero-points and stars, with an edge for each detection
+    graph = sparse.csr_matrix((np.ones(len(zpid)),(zpid,nzp+starid)),shape=(nzp+nstar,nzp+nstar))
+    ncomp,comp = connected_components(graph,directed=False)
+    anchored = np.zeros(ncomp,bool)
+    anchored[comp[np.where(np.isfinite(anchorzp))[0]]] = True
+    return anchored[comp[0:nzp]]
+
+
+def ubercal(mag,err,starid,zpid,anchorzp=None,anchorerr=0.001,niter=3,nsig=3.0,logger=None):
+    """
+    Solve for the zero-points of many overlapping exposures/chips
+    simultaneously (ubercal).  Each detection gives one equation,
+      mag + zpterm[zpid] = starmag[starid],
+    and the sparse linear system is solved with LSQR.  Zero-points
+    with a known calibration (anchors) are constrained to that value.
+
+    Parameters
+    ----------
+    mag : numpy array
+       Instrumental magnitude of each detection (corrected for
+         exposure time).
+    err : numpy array
+       Uncertainty of each detection.
+    starid : numpy array
+       Star index of each detection (e.g. from crossmatch_exposures).
+    zpid : numpy array
+       Zero-point index of each detection (e.g. exposure/chip pair).
+    anchorzp : numpy array, optional
+       Known zero-point for each zero-point index, NaN for those
+         that are free.  If there are no anchors the mean
+         zero-point is fixed to zero.
+    anchorerr : float, optional
+       Uncertainty of the anchor zero-points.  Default is 0.001 mag.
+    niter : int, optional
+       Number of outlier-rejection iterations.  Default is 3.
+    nsig : float, optional
+       Outlier rejection threshold in robust sigma.  Default is 3.0.
+    logger : logging object, optional
+       Logging object.
+
+    Returns
+    -------
+    zpterm : numpy array
+       Zero-point for each zero-point index.
+    zptermerr : numpy array
+       Approximate uncertainty (ignoring star magnitude errors).
+    nstars : numpy array
+       Number of multiply-observed stars that constrain each zero-point.
+    starmag : numpy array
+       Calibrated mean magnitude for each star.
+
+    Example
+    -------
+
+    zpterm,zptermerr,nstars,starmag = ubercal(mag,err,starid,zpid,anchorzp)
+
+    """
+    if logger is None:
+        logger = dln.basiclogger()
+    mag = np.asarray(mag,float)
+    err = np.asarray(err,float)
+    starid = np.asarray(starid)
+    zpid = np.asarray(zpid)
+    nstar = np.max(starid)+1
+    if anchorzp is None:
+        anchorzp = np.zeros(np.max(zpid)+1,float)+np.nan
+    anchorzp = np.asarray(anchorzp,float)
+    nzp = len(anchorzp)
+    anchor, = np.where(np.isfinite(anchorzp))
+
+    # Only stars with multiple detections constrain the zero-points
+    ndet = np.bincount(starid,minlength=nstar)
+    use = (ndet[starid] > 1) & np.isfinite(mag) & np.isfinite(err) & (err > 0)
+
+    x = None
+    for it in range(niter+1):
+        ind, = np.where(use)
+        nind = len(ind)
+        # Relabel stars so the unknowns are compact
+        ustar,sind = np.unique(starid[ind],return_inverse=True)
+        nustar = len(ustar)
+        wt = 1/err[ind]
+        # Detection rows:  starmag - zpterm = mag
+        rows = np.repeat(np.arange(nind),2)
+        cols = np.vstack((sind,nustar+zpid[ind])).T.flatten()
+        vals = np.vstack((wt,-wt)).T.flatten()
+        b = mag[ind]*wt
+        # Anchor or gauge rows
+        if len(anchor) > 0:
+            arows = nind+np.arange(len(anchor))
+            acols = nustar+anchor
+            avals = np.zeros(len(anchor),float)+1/anchorerr
+            ab = anchorzp[anchor]/anchorerr
+        else:
+            arows = np.zeros(nzp,int)+nind
+            acols = nustar+np.arange(nzp)
+            avals = np.ones(nzp,float)
+            ab = np.zeros(1,float)
+        rows = np.append(rows,arows)
+        cols = np.append(cols,acols)
+        vals = np.append(vals,avals)
+        b = np.append(b,ab)
+        amat = sparse.csr_matrix((vals,(rows,cols)),shape=(len(b),nustar+nzp))
+        x0 = None
+        if x is not None and len(x)==nustar+nzp:
+            x0 = x
+        x = lsqr(amat,b,atol=1e-10,btol=1e-10,iter_lim=10000,x0=x0)[0]
+        starmag1 = x[0:nustar]
+        zpterm = x[nustar:].copy()
+        resid = np.zeros(len(mag),float)+np.nan
+        resid[ind] = mag[ind]+zpterm[zpid[ind]]-starmag1[sind]
+        if it==niter:
+            break
+        # Reject outliers
+        sig = dln.mad(resid[ind]/err[ind])
+        newuse = use & (np.abs(resid/err) < nsig*np.maximum(sig,1.0))
+        newuse &= (np.bincount(starid[newuse],minlength=nstar)[starid] > 1)
+        logger.info('Ubercal iteration %d: %d detections, %d rejected' % (it+1,nind,nind-np.sum(newuse)))
+        if np.sum(newuse)==nind:
+            break
+        use = newuse
+
+    # Approximate zero-point uncertainties
+    sumwt = np.bincount(zpid[ind],weights=1/err[ind]**2,minlength=nzp)
+    nstars = np.bincount(zpid[ind],minlength=nzp)
+    zptermerr = np.zeros(nzp,float)+999999.
+    gd = sumwt > 0
+    zptermerr[gd] = 1/np.sqrt(sumwt[gd])
+    zpterm[~gd] = 999999.
+    if len(anchor) > 0:
+        zptermerr[anchor] = np.sqrt(zptermerr[anchor]**2+anchorerr**2)
+    starmag = np.zeros(nstar,float)+np.nan
+    starmag[ustar] = starmag1
+    logger.info('Ubercal solved for %d zero-points using %d stars and %d detections' % (np.sum(gd),nustar,nind))
+
+    return zpterm,zptermerr,nstars,starmag
@@ -0,0 +1,91 @@
+import os
+import sys
+import stat
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','python'))
+from nsc.daosession import DaophotSession
+
+# A stand-in for the daophot executable that follows its prompt dialogue.
+#  Like DAOPHOT, a blank line at the "Command:" prompt just prompts again,
+#  so the trailing "" answer of PSF gives an extra prompt.
+FAKEDAOPHOT = '''#!{python}
+import sys
+def ask(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if line == '': sys.exit(0)
+    return line.rstrip('\\n')
+while True:
+    cmd = ask('\\n Command:').strip().upper()
+    if cmd == 'EXIT':
+        break
+    elif cmd == '':
+        continue
+    elif cmd == 'OPTIONS':
+        ask(' File with parameters: ')
+        while ask(' OPT> ') != '': pass
+    elif cmd.startswith('ATTACH'):
+        sys.stdout.write('\\n Your picture is attached\\n')
+    elif cmd == 'FIND':
+        ask(' Number of frames averaged, summed: ')
+        out = ask(' File for the positions: ')
+        ask(' Are you happy with this? ')
+        open(out,'w').write('FIND output\\n')
+        sys.stdout.write('\\n FIND wrote '+out+'\\n')
+    elif cmd == 'PSF':
+        ask(' File with aperture results: ')
+        ask(' File with PSF stars: ')
+        out = ask(' File for the PSF: ')
+        open(out,'w').write('PSF output\\n')
+        sys.stdout.write('\\n PSF wrote '+out+'\\n')
+    elif cmd == 'PHOTOMETRY':
+        ask(' Enter table name: ')
+        ask(' Input position file: ')
+        ask(' Output file: ')
+        sys.stdout.write('\\n PHOTOMETRY failed\\n')
+    else:
+        sys.stdout.write('\\n Unrecognized command\\n')
+'''
+
+@pytest.fixture
+def session(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    daophot = tmp_path / 'daophot'
+    daophot.write_text(FAKEDAOPHOT.format(python=sys.executable))
+    daophot.chmod(daophot.stat().st_mode | stat.S_IEXEC)
+    (tmp_path / 'image.fits').write_text('')
+    (tmp_path / 'image.opt').write_text('FW = 3.0\n')
+    ses = DaophotSession(bindir=str(tmp_path)+'/',timeout=60.0)
+    yield ses
+    ses.close()
+
+def test_run_outputs_and_dialogue(session):
+    cmds = [['FIND','1,1','a.coo','y'],
+            ['PSF','a.ap','a.lst','a.psf',''],
+            ['FIND','1,1','b.coo','y']]
+    out = session.run('image.fits','image.opt',cmds,logfile='run.log',
+                      outfiles=['a.coo','a.psf','b.coo'])
+    for f in ['a.coo','a.psf','b.coo']:
+        assert os.path.exists(f)
+    # The output of each command is read up to its own prompt
+    assert out.count('Command:') == 3
+    assert out.index('FIND wrote a.coo') < out.index('PSF wrote a.psf') < out.index('FIND wrote b.coo')
+    # The extra prompt after PSF is drained, not taken as the output of the next FIND
+    out2 = session.command(['FIND','1,1','c.coo','y'],outfile='c.coo')
+    assert 'FIND wrote c.coo' in out2
+    assert 'b.coo' not in out2
+    log = open('run.log').read()
+    assert 'Your picture is attached' in log
+    assert 'PSF wrote a.psf' in log
+
+def test_missing_output(session):
+    with pytest.raises(Exception,match='did not create'):
+        session.run('image.fits','image.opt',[['PHOTOMETRY','a.als','a.coo','a.ap']],
+                    outfiles=['a.ap'])
+    # The session still works after a restart
+    session.restart()
+    assert session.alive
+    session.run('image.fits','image.opt',[['FIND','1,1','d.coo','y']],outfiles=['d.coo'])
+    assert os.path.exists('d.coo')